@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+"""Offline benchmarks of dcborgbackup.
+
+Runs dcborgbackup.py against stand-in borg, docker-compose, ssh and ping executables (fakebin.py) that simulate latency,
+output volume, lock contention and failures, and measures wall time, downtime, the overhead of every phase and the peak RSS of cmd_run.
+
+    python benchmarks/bench.py                              # all scenarios, results in benchmarks/results/
+    python benchmarks/bench.py -s single -s many --repeat 5
+    python benchmarks/bench.py --compare results/old.json results/new.json
+"""
+import argparse
+import copy
+import getpass
+import json
+import logging
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+REPODIR = os.path.dirname(BENCHDIR)
+TOOLS = ["borg", "docker-compose", "ssh", "ping"]
+
+# what the stand-ins do if a scenario doesn't say otherwise
+DEFAULT_FAKES = {
+    "borg": {
+        "lock_wait": 1.0,
+        "info": {"latency": 0.2},
+        "list": {"latency": 0.05},
+        "create": {"latency": 1.0, "list_lines": 0},
+        "prune": {"latency": 0.3, "list_lines": 40},
+        "compact": {"latency": 0.3},
+        "check": {"latency": 0.5},
+    },
+    "docker-compose": {"latency": 0.5},
+    "ssh": {"handshake": 0.3, "latency": 0.02},
+    "ping": {"latency": 0.01},
+}
+
+SCENARIOS = {
+    "single": {"description": "one stack", "stacks": 1},
+    "many": {"description": "8 stacks, 4 at a time, own repos", "stacks": 8, "jobs": 4},
+    "list-1m": {
+        "description": "one stack, borg create --list prints 1M lines",
+        "stacks": 1,
+        "create_params": "--list",
+        "fakes": {"borg": {"create": {"list_lines": 1000000}}},
+    },
+    "lock-contention": {
+        "description": "4 stacks sharing one repo, borg's lock_wait decides",
+        "stacks": 4,
+        "jobs": 4,
+        "max_per_repo": 4,
+        "shared_repo": True,
+        "fakes": {"borg": {"lock_wait": 5.0}},
+    },
+    "lock-wait": {
+        "description": "4 stacks sharing one repo, borg's default lock_wait of 1s, retry.lock_wait of 10s",
+        "stacks": 4,
+        "jobs": 4,
+        "max_per_repo": 4,
+        "shared_repo": True,
+        "retry": {"lock_wait": "10s"},
+    },
+    "coordinated": {
+        "description": "8 stacks, 8 at a time, upload slots shared through the server, 2 per server",
+        "stacks": 8,
+        "jobs": 8,
+        "max_per_server": 8,
+        "coordination": {"max_per_server": 2, "poll": 0.2},
+    },
+    "maintenance": {
+        "description": "one stack, prune, compact and check on every run",
+        "stacks": 1,
+        "maintenance": {"prune": 0, "compact": 0, "check": 0},
+    },
+    "cache-resync": {
+        "description": "one stack with a managed borg cache, borg create resyncs 50 archive indexes",
+        "stacks": 1,
+        "borg_cache": True,
+        "fakes": {"borg": {"create": {"cache_sync_archives": 50, "cache_sync_seconds": 0.5}}},
+    },
+    "failures": {
+        "description": "4 stacks, every second borg create fails",
+        "stacks": 4,
+        "jobs": 4,
+        "fakes": {"borg": {"create": {"fail_rate": 0.5}}},
+    },
+}
+
+# the simulated latency of every phase, subtracted from the measured duration to get the overhead
+PHASE_LATENCY = {
+    "preflight": lambda f: max(f["borg"]["info"]["latency"], f["ssh"]["latency"]),
+    "compose_down": lambda f: f["docker-compose"]["latency"],
+    "create": lambda f: f["borg"]["create"]["latency"],
+    "compose_up": lambda f: f["docker-compose"]["latency"],
+    "prune": lambda f: f["borg"]["prune"]["latency"],
+    "compact": lambda f: f["borg"]["compact"]["latency"],
+    "check": lambda f: f["borg"]["check"]["latency"],
+}
+
+CMD_RUN_RSS = """
+import json, os, resource, sys
+sys.path.insert(0, {repodir!r})
+import cmdrunner
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+result = cmdrunner.cmd_run("borg create --list --json --log-json x@y:repo::a /src", env=dict(os.environ), debug=False)
+print(json.dumps({{"before_kb": before, "peak_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, "lines": result.lines}}))
+"""
+
+
+def merge(base: dict, override: dict) -> dict:
+    """Deep-merges 'override' into a copy of 'base'."""
+    merged = copy.deepcopy(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+class FakeSSHPort:
+    """A local TCP port that accepts connections, so the reachability check passes without a real ssh server."""
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(64)
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self._accept, daemon=True)
+        self.thread.start()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            conn.close()
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+def make_bin(folder: str) -> str:
+    """Creates a folder with the stand-ins linked under the names of the tools they imitate.
+
+    Args:
+        folder (str): The benchmark's working folder
+
+    Returns:
+        str: The bin folder, to be put in front of PATH.
+    """
+    bindir = os.path.join(folder, "bin")
+    os.makedirs(bindir)
+    fake = os.path.join(BENCHDIR, "fakebin.py")
+    for tool in TOOLS:
+        os.symlink(fake, os.path.join(bindir, tool))
+    return bindir
+
+
+def make_stacks(folder: str, scenario: dict, port: int) -> list:
+    """Creates the project folders and config files of a scenario.
+
+    Returns:
+        list: The config files.
+    """
+    rootfolder = os.path.join(folder, "stacks") + "/"
+    configs = []
+    for i in range(scenario.get("stacks", 1)):
+        name = f"stack{i}"
+        os.makedirs(os.path.join(rootfolder, name, "data"))
+        with open(os.path.join(rootfolder, name, "docker-compose.yaml"), "w") as f:
+            f.write("services:\n  app:\n    image: alpine\n    volumes:\n      - ./data:/data\n")
+        config = {
+            "rootfolder": rootfolder,
+            "foldername": name,
+            "borgserver": "127.0.0.1",
+            "borgrepo": "shared" if scenario.get("shared_repo") else name,
+            "ssh_port": port,
+            "repo_encrypted": False,
+            "expected_user": getpass.getuser(),
+            "docker_compose": True,
+            "borg_parameters": {
+                "create": scenario.get("create_params", ""),
+                "info": "",
+                "prune": "--keep-daily=7",
+            },
+            "metrics": {"json_dir": os.path.join(folder, "metrics")},
+            "cache_dir": os.path.join(folder, "cache"),
+        }
+        for key in ("maintenance", "borg_cache", "retry", "coordination"):
+            if scenario.get(key):
+                config[key] = scenario[key]
+        configfile = os.path.join(folder, f"{name}.yaml")
+        with open(configfile, "w") as f:
+            json.dump(config, f)  # JSON is valid YAML
+        configs.append(configfile)
+    return configs
+
+
+def measure_cmd_run_rss(env: dict, lines: int) -> dict:
+    """Measures the peak RSS of a process running cmd_run on 'lines' lines of output.
+
+    Returns:
+        dict: before_kb (after the imports), peak_kb and lines.
+    """
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump({"borg": {"create": {"list_lines": lines}}}, f)
+    env = {**env, "DCBB_FAKE_SCENARIO": f.name}
+    try:
+        result = subprocess.run(
+            [sys.executable, "-c", CMD_RUN_RSS.format(repodir=REPODIR)],
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+    finally:
+        os.unlink(f.name)
+    return json.loads(result.stdout)
+
+
+def run_scenario(name: str, scenario: dict) -> dict:
+    """Runs dcborgbackup once for a scenario.
+
+    Returns:
+        dict: wall time, exit code and the metrics of every stack.
+    """
+    fakes = merge(DEFAULT_FAKES, scenario.get("fakes", {}))
+    port = FakeSSHPort()
+    with tempfile.TemporaryDirectory(prefix=f"dcbb-bench-{name}-") as folder:
+        bindir = make_bin(folder)
+        scenariofile = os.path.join(folder, "scenario.json")
+        with open(scenariofile, "w") as f:
+            json.dump(fakes, f)
+        secretsfile = os.path.join(folder, "secrets.yaml")
+        with open(secretsfile, "w") as f:
+            f.write("borguser: bench\n")
+        configs = make_stacks(folder, scenario, port.port)
+        env = {
+            **os.environ,
+            "PATH": bindir + os.pathsep + os.environ.get("PATH", ""),
+            "DCBB_FAKE_SCENARIO": scenariofile,
+            "DCBB_FAKE_STATE": os.path.join(folder, "state"),
+        }
+        cmd = [sys.executable, os.path.join(REPODIR, "dcborgbackup.py"), *configs, secretsfile]
+        cmd += ["--jobs", str(scenario.get("jobs", 1))]
+        cmd += ["--max-per-repo", str(scenario.get("max_per_repo", 1))]
+        cmd += ["--max-per-server", str(scenario.get("max_per_server", scenario.get("jobs", 1)))]
+        start = time.monotonic()
+        result = subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        wall = time.monotonic() - start
+        stacks = []
+        metricsdir = os.path.join(folder, "metrics")
+        if os.path.isdir(metricsdir):
+            for report in sorted(os.listdir(metricsdir)):
+                with open(os.path.join(metricsdir, report)) as f:
+                    stacks.append(json.load(f))
+        if not stacks:
+            logger.warning(f"{name}: no stack finished, dcborgbackup said:\n{result.stderr.decode(errors='replace')[-2000:]}")
+        rss = None
+        lines = fakes["borg"]["create"]["list_lines"]
+        if lines:
+            rss = measure_cmd_run_rss(env, lines)
+    port.close()
+    return {"wall": wall, "returncode": result.returncode, "stacks": stacks, "cmd_run_rss": rss, "fakes": fakes}
+
+
+def summarize(runs: list) -> dict:
+    """Reduces the runs of one scenario to medians."""
+    fakes = runs[0]["fakes"]
+    stacks = [s for r in runs for s in r["stacks"]]
+    phases = {}
+    # failed stacks skip phases or end them early, they'd distort the durations
+    for s in (s for s in stacks if s["outcome"] == "success"):
+        for phase, duration in s["phases"].items():
+            phases.setdefault(phase, []).append(duration)
+    overhead = {
+        phase: statistics.median(durations) - PHASE_LATENCY[phase](fakes)
+        for phase, durations in phases.items()
+        if phase in PHASE_LATENCY
+    }
+    summary = {
+        "runs": len(runs),
+        "wall_seconds": statistics.median(r["wall"] for r in runs),
+        "downtime_seconds": statistics.median(s["downtime_seconds"] for s in stacks) if stacks else None,
+        "max_downtime_seconds": max((s["downtime_seconds"] for s in stacks), default=None),
+        "stacks_failed": sum(s["outcome"] != "success" for s in stacks),
+        "stacks_total": len(stacks),
+        "phases_seconds": {p: statistics.median(d) for p, d in phases.items()},
+        "phase_overhead_seconds": overhead,
+    }
+    syncs = [u["sync_seconds"] for s in stacks for u in s.get("borg_cache") or []]
+    if syncs:
+        summary["cache_sync_seconds"] = statistics.median(syncs)
+    rss = [r["cmd_run_rss"] for r in runs if r["cmd_run_rss"]]
+    if rss:
+        summary["cmd_run_peak_rss_kb"] = max(r["peak_kb"] for r in rss)
+        summary["cmd_run_rss_growth_kb"] = max(r["peak_kb"] - r["before_kb"] for r in rss)
+    return summary
+
+
+def git_revision() -> str:
+    try:
+        result = subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=REPODIR,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        return result.stdout.decode().strip() or "unknown"
+    except FileNotFoundError:
+        return "unknown"
+
+
+def run(names: list, repeat: int, label: str, outdir: str) -> str:
+    """Runs the scenarios and stores the results.
+
+    Returns:
+        str: The results file.
+    """
+    results = {
+        "label": label,
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "scenarios": {},
+    }
+    for name in names:
+        scenario = SCENARIOS[name]
+        logger.info(f"{name}: {scenario['description']}, {repeat} runs")
+        runs = [run_scenario(name, scenario) for _ in range(repeat)]
+        results["scenarios"][name] = summarize(runs)
+        logger.info(f"{name}: {json.dumps(results['scenarios'][name])}")
+    os.makedirs(outdir, exist_ok=True)
+    path = os.path.join(outdir, f"{label}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    return path
+
+
+def compare(old_path: str, new_path: str) -> str:
+    """Compares two results files.
+
+    Returns:
+        str: A table of the values that exist in both, with the change in percent.
+    """
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    lines = [f"{'':40} {old['label']:>14} {new['label']:>14} {'change':>8}"]
+    for name, new_summary in new["scenarios"].items():
+        old_summary = old["scenarios"].get(name)
+        if not old_summary:
+            continue
+        lines.append(name)
+        for key, value in new_summary.items():
+            if isinstance(value, dict):
+                pairs = [(f"{key}.{k}", old_summary.get(key, {}).get(k), v) for k, v in value.items()]
+            else:
+                pairs = [(key, old_summary.get(key), value)]
+            for metric, before, after in pairs:
+                if not isinstance(before, (int, float)) or not isinstance(after, (int, float)):
+                    continue
+                change = f"{(after - before) / before * 100:+.1f}%" if before else ""
+                lines.append(f"  {metric:38} {before:14.3f} {after:14.3f} {change:>8}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks of dcborgbackup")
+    parser.add_argument(
+        "-s",
+        "--scenario",
+        action="append",
+        choices=sorted(SCENARIOS),
+        help="Scenario to run, may be given several times (default: all)",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per scenario (default: 3)")
+    parser.add_argument("--label", default=None, help="Name of the results (default: git revision)")
+    parser.add_argument(
+        "--out",
+        default=os.path.join(BENCHDIR, "results"),
+        help="Folder for the results (default: benchmarks/results)",
+    )
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two results files")
+    parser.add_argument("--list", action="store_true", help="List the scenarios")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s-%(levelname)s: %(message)s", level=logging.INFO)
+    if args.list:
+        for name, scenario in SCENARIOS.items():
+            print(f"{name:16} {scenario['description']}")
+        return
+    if args.compare:
+        print(compare(*args.compare))
+        return
+    path = run(args.scenario or list(SCENARIOS), args.repeat, args.label or git_revision(), args.out)
+    print(path)
+
+
+if __name__ == "__main__":
+    main()
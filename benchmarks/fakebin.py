@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""Stand-in for borg, docker-compose, ssh and ping used by the benchmarks.
+
+The tool to imitate is taken from the name the script is called by (bench.py links it as 'borg', 'docker-compose', ...).
+Its behaviour is read from the scenario file in DCBB_FAKE_SCENARIO, locks and call counters live in DCBB_FAKE_STATE.
+"""
+import fcntl
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+CHUNK = 10000
+
+
+def load_scenario(tool: str) -> dict:
+    path = os.environ.get("DCBB_FAKE_SCENARIO")
+    if not path:
+        return {}
+    with open(path, "r") as f:
+        return json.load(f).get(tool, {})
+
+
+def state_file(name: str) -> str:
+    state = os.environ.get("DCBB_FAKE_STATE", "/tmp/dcbb-fake-state")
+    os.makedirs(state, exist_ok=True)
+    return os.path.join(state, name)
+
+
+def call_number(key: str) -> int:
+    """Counts the calls of 'key' across processes, so failures are deterministic."""
+    with open(state_file(f"count-{key}"), "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        count = int(f.read() or 0) + 1
+        f.seek(0)
+        f.truncate()
+        f.write(str(count))
+    return count
+
+
+def should_fail(key: str, settings: dict) -> bool:
+    rate = settings.get("fail_rate", 0)
+    if not rate:
+        return False
+    seed = os.environ.get("DCBB_FAKE_SEED", "0")
+    return random.Random(f"{seed}-{key}-{call_number(key)}").random() < rate
+
+
+def record(tool: str, args: list) -> None:
+    with open(state_file("calls.log"), "a") as f:
+        f.write(json.dumps({"time": time.time(), "tool": tool, "args": args}) + "\n")
+
+
+def log_json(levelname: str, message: str, msgid: str = None, name: str = "borg.archiver") -> str:
+    entry = {
+        "type": "log_message",
+        "time": time.time(),
+        "levelname": levelname,
+        "name": name,
+        "message": message,
+    }
+    if msgid:
+        entry["msgid"] = msgid
+    return json.dumps(entry)
+
+
+def write_lines(stream, count: int, line) -> None:
+    """Writes 'count' lines made by line(i) in chunks, millions of lines shouldn't be slowed down by the stand-in itself."""
+    for start in range(0, count, CHUNK):
+        stream.write("".join(line(i) + "\n" for i in range(start, min(count, start + CHUNK))))
+    stream.flush()
+
+
+def fail(message: str, msgid: str = None) -> int:
+    sys.stderr.write(log_json("ERROR", message, msgid) + "\n")
+    return 2
+
+
+class RepoLock:
+    """Exclusive lock on a repo, borg gives up after 'lock_wait' seconds like 'borg --lock-wait'."""
+
+    def __init__(self, repo: str, wait: float):
+        self.path = state_file("lock-" + repo.replace("/", "_").replace(":", "_"))
+        self.wait = wait
+        self.f = None
+
+    def acquire(self) -> bool:
+        self.f = open(self.path, "a")
+        deadline = time.monotonic() + self.wait
+        while True:
+            try:
+                fcntl.flock(self.f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    return False
+                time.sleep(0.05)
+
+    def release(self) -> None:
+        self.f.close()
+
+
+def sync_cache(archives: int, seconds: float) -> None:
+    """Logs a resync of the chunks cache like borg does with --info, fetching the index of every archive."""
+    sys.stderr.write(log_json("INFO", "Synchronizing chunks cache...", name="borg.cache") + "\n")
+    for i in range(archives):
+        time.sleep(seconds / archives)
+        sys.stderr.write(log_json("INFO", f"Fetching and building archive index for stack-{i} ...", name="borg.cache") + "\n")
+    sys.stderr.write(log_json("INFO", "Done.", name="borg.cache") + "\n")
+    sys.stderr.flush()
+
+
+def stream(command: list) -> tuple:
+    """Reads the stdout of a command like 'borg create --content-from-command', without keeping it.
+
+    Returns:
+        tuple: (bytes read, exit code of the command)
+    """
+    size = 0
+    with subprocess.Popen(command, stdout=subprocess.PIPE) as p:
+        for block in iter(lambda: p.stdout.read(CHUNK), b""):
+            size += len(block)
+    return size, p.returncode
+
+
+def borg(args: list, scenario: dict) -> int:
+    command = args[0] if args else ""
+    if command in ("--version", "-V"):
+        print("borg 1.2.0")
+        return 0
+    settings = scenario.get(command, {})
+    # after -- comes the command of --content-from-command
+    options = args[: args.index("--")] if "--" in args else args
+    repo = next((a.split("::")[0] for a in options[1:] if "@" in a and ":" in a), "repo")
+    if should_fail(f"borg-{command}", settings):
+        return fail(f"simulated failure of borg {command}")
+    lock = None
+    if command in ("create", "prune", "compact", "check", "delete"):
+        wait = float(options[options.index("--lock-wait") + 1]) if "--lock-wait" in options else scenario.get("lock_wait", 1.0)
+        lock = RepoLock(repo, wait)
+        if not lock.acquire():
+            return fail(f"Failed to create/acquire the lock {repo}/lock.exclusive (timeout).", "LockTimeout")
+    try:
+        if settings.get("cache_sync_archives") and "--info" in args:
+            sync_cache(settings["cache_sync_archives"], settings.get("cache_sync_seconds", 0.1))
+        time.sleep(settings.get("latency", 0))
+        if command == "info":
+            print(
+                json.dumps(
+                    {
+                        "repository": {"id": "f" * 64, "location": repo},
+                        "encryption": {"mode": "repokey"},
+                        "cache": {
+                            "stats": {
+                                "total_size": 10 * 2**30,
+                                "total_csize": 8 * 2**30,
+                                "unique_csize": 2 * 2**30,
+                                "total_unique_chunks": 10000,
+                                "total_chunks": 50000,
+                            }
+                        },
+                    }
+                )
+            )
+        elif command == "list":
+            # like borg 1.2, the checkpoints left by interrupted creates are only listed with --consider-checkpoints
+            names = settings.get("checkpoints", []) if "--consider-checkpoints" in options else ["stack-1"]
+            print(
+                json.dumps(
+                    {
+                        "repository": {"id": "f" * 64, "location": repo},
+                        "encryption": {"mode": "repokey"},
+                        "archives": [{"name": name, "id": "a" * 64} for name in names],
+                    }
+                )
+            )
+        elif command == "create":
+            if "--list" in args:
+                write_lines(
+                    sys.stderr,
+                    settings.get("list_lines", 0),
+                    lambda i: json.dumps({"type": "file_status", "status": "U", "path": f"data/file{i}"}),
+                )
+            original = settings.get("original_size", 2**30)
+            nfiles = settings.get("nfiles", 1000)
+            if "--content-from-command" in options:
+                original, returncode = stream(args[args.index("--") + 1 :])
+                if returncode != 0:
+                    return fail(f"Command {args[args.index('--') + 1]!r} exited with status {returncode}")
+                nfiles = 1
+            print(
+                json.dumps(
+                    {
+                        "repository": {"id": "f" * 64, "location": repo},
+                        "archive": {
+                            "name": next(a for a in options if "::" in a).split("::")[-1],
+                            "id": "a" * 64,
+                            "duration": settings.get("latency", 0),
+                            "stats": {
+                                "original_size": original,
+                                "compressed_size": original // 2,
+                                "deduplicated_size": int(original * settings.get("new_data", 0.01)),
+                                "nfiles": nfiles,
+                            },
+                        },
+                    }
+                )
+            )
+        elif command == "prune":
+            write_lines(
+                sys.stderr,
+                settings.get("list_lines", 20),
+                lambda i: log_json(
+                    "INFO",
+                    f"{'Keeping' if i < 20 else 'Pruning'} archive (rule: daily #{i + 1}):  stack-{i}  Mon, 2021-01-04 01:00:00 [{'b' * 64}]",
+                    name="borg.output.list",
+                ),
+            )
+        elif command == "compact":
+            freed = settings.get("freed", 10**9)
+            sys.stderr.write(
+                log_json("INFO", f"compaction freed about {freed / 10**9:.2f} GB repository space.", name="borg.repository")
+                + "\n"
+            )
+    finally:
+        if lock:
+            lock.release()
+    return 0
+
+
+def docker_compose(args: list, scenario: dict) -> int:
+    settings = scenario.get(args[0] if args else "", {})
+    if should_fail(f"docker-compose-{args[0] if args else ''}", settings):
+        print("simulated docker-compose failure")
+        return 1
+    time.sleep(settings.get("latency", scenario.get("latency", 0)))
+    return 0
+
+
+def ssh(args: list, scenario: dict) -> int:
+    if "-O" in args:  # control commands of the master
+        return 0
+    if "-M" in args:
+        time.sleep(scenario.get("handshake", 0))
+        return 0
+    if should_fail("ssh", scenario):
+        sys.stderr.write("ssh: connect to host: Connection refused\n")
+        return 255
+    multiplexed = any(a.startswith("ControlPath=") for a in args) and "ControlMaster=no" in args
+    time.sleep(scenario.get("latency", 0) if multiplexed else scenario.get("handshake", 0))
+    if args and args[-1].startswith("sh -c "):
+        # the lock directory of 'coordination', the state folder stands in for the home of the borguser on the server
+        return subprocess.run(args[-1], shell=True, cwd=os.path.dirname(state_file("slots"))).returncode
+    return 0
+
+
+def ping(args: list, scenario: dict) -> int:
+    time.sleep(scenario.get("latency", 0))
+    return 1 if should_fail("ping", scenario) else 0
+
+
+TOOLS = {"borg": borg, "docker-compose": docker_compose, "ssh": ssh, "ping": ping}
+
+
+def main() -> int:
+    tool = os.path.basename(sys.argv[0])
+    args = sys.argv[1:]
+    record(tool, args)
+    return TOOLS[tool](args, load_scenario(tool))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""Startup-time benchmark of dcborgbackup.
+
+Measures the import cost of every module with 'python -X importtime' and the wall time of 'dcborgbackup.py --help'.
+
+    python benchmarks/importtime.py                    # top 20 modules, results in benchmarks/results/
+    python benchmarks/importtime.py --max-ms 150       # exit 1 if importing dcborgbackup takes longer
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import time
+from bench import BENCHDIR, REPODIR, git_revision
+
+logger = logging.getLogger(__name__)
+
+# imported only when a config needs them, importing dcborgbackup must not pull them in
+LAZY_MODULES = ["telegram", "yaml", "borgcache", "changes", "composefile", "dbdumps", "patterns", "profiler", "readiness", "scheduler", "slots", "snapshot", "staging", "throttle"]
+
+
+def import_times(module: str = "dcborgbackup", runs: int = 5) -> dict:
+    """Imports 'module' in fresh interpreters and returns the median self and cumulative import time per module.
+
+    Args:
+        module (str, optional): The module to import. Defaults to "dcborgbackup".
+        runs (int, optional): Number of interpreters. Defaults to 5.
+
+    Returns:
+        dict: {module: {"self_us": .., "cumulative_us": ..}}
+    """
+    samples = {}
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=REPODIR,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            check=True,
+        )
+        for line in result.stderr.decode().splitlines():
+            if not line.startswith("import time:") or "self [us]" in line:
+                continue
+            self_us, cumulative_us, name = line[len("import time:") :].split("|")
+            samples.setdefault(name.strip(), []).append((int(self_us), int(cumulative_us)))
+    return {
+        name: {
+            "self_us": statistics.median(s for s, _ in values),
+            "cumulative_us": statistics.median(c for _, c in values),
+        }
+        for name, values in samples.items()
+    }
+
+
+def help_time(runs: int = 5) -> float:
+    """Returns the median wall time of 'dcborgbackup.py --help' in seconds."""
+    durations = []
+    for _ in range(runs):
+        start = time.monotonic()
+        subprocess.run(
+            [sys.executable, os.path.join(REPODIR, "dcborgbackup.py"), "--help"],
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+        durations.append(time.monotonic() - start)
+    return statistics.median(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup-time benchmark of dcborgbackup")
+    parser.add_argument("--runs", type=int, default=5, help="Interpreters started per measurement (default: 5)")
+    parser.add_argument("--top", type=int, default=20, help="Number of modules listed (default: 20)")
+    parser.add_argument("--max-ms", type=float, help="Exit 1 if importing dcborgbackup takes longer")
+    parser.add_argument("--label", default=None, help="Name of the results (default: git revision)")
+    parser.add_argument(
+        "--out",
+        default=os.path.join(BENCHDIR, "results"),
+        help="Folder for the results (default: benchmarks/results)",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s-%(levelname)s: %(message)s", level=logging.INFO)
+
+    times = import_times(runs=args.runs)
+    total_ms = times["dcborgbackup"]["cumulative_us"] / 1000
+    print(f"{'module':40} {'self [ms]':>10} {'cumulative [ms]':>16}")
+    ranked = sorted(times.items(), key=lambda item: item[1]["self_us"], reverse=True)
+    for name, t in ranked[: args.top]:
+        print(f"{name:40} {t['self_us'] / 1000:10.1f} {t['cumulative_us'] / 1000:16.1f}")
+    help_s = help_time(args.runs)
+    print(f"import dcborgbackup: {total_ms:.1f}ms, dcborgbackup.py --help: {help_s * 1000:.0f}ms")
+
+    failed = False
+    eager = [m for m in LAZY_MODULES if m in times]
+    if eager:
+        logger.error(f"Imported although they should be lazy: {', '.join(eager)}")
+        failed = True
+    if args.max_ms is not None and total_ms > args.max_ms:
+        logger.error(f"Importing dcborgbackup took {total_ms:.1f}ms, more than {args.max_ms}ms")
+        failed = True
+
+    label = args.label or git_revision()
+    os.makedirs(args.out, exist_ok=True)
+    path = os.path.join(args.out, f"importtime-{label}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "label": label,
+                "revision": git_revision(),
+                "scenarios": {
+                    "startup": {
+                        "import_ms": total_ms,
+                        "help_ms": help_s * 1000,
+                        "modules_cumulative_ms": {n: t["cumulative_us"] / 1000 for n, t in ranked[: args.top]},
+                    }
+                },
+            },
+            f,
+            indent=2,
+        )
+    print(path)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
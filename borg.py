@@ -1,8 +1,14 @@
 import os
-from cmdrunner import cmd_run
+import re
+from cmdrunner import LineMatcher, cmd_run
+import repocache
+import sshmux
+import json
 import logging
+from dataclasses import dataclass, field
 from shutil import which
-import re
+from typing import List
+from units import format_size, parse_size
 
 logger = logging.getLogger(__name__)
 
@@ -26,6 +32,10 @@ class BorgError(Exception):
     pass
 
 
+class BorgConnectionClosed(Exception):
+    pass
+
+
 class NotRepokeyEncrypted(Exception):
     pass
 
@@ -48,7 +58,7 @@ def _get_parameters(option: str, **kwargs) -> str:
     """Searches the borg_parameters part of the configuration for 'option'.
 
     Args:
-        option (str): Has to be one of 'prune', 'create' or 'info.
+        option (str): Has to be one of 'prune', 'create', 'info', 'list', 'compact' or 'check'.
 
     Raises:
         ValueError: raises this when 'option' isn't one of the allowed.
@@ -57,134 +67,561 @@ def _get_parameters(option: str, **kwargs) -> str:
         str: A string containing parameters for "borg 'option' params ..."
     """
     params = ""
-    if option not in ["create", "info", "prune"]:
+    if option not in ["create", "info", "list", "prune", "compact", "check"]:
         raise ValueError(f"Option {option} is unknown.")
-    params = kwargs["borg_parameters"][option]
+    params = kwargs["borg_parameters"].get(option, "")
     return params
 
 
-def create(**kwargs) -> None:
-    """Creates a borg archive.
+def _get_env(**kwargs) -> dict:
+    """Returns the environment borg runs with: the passphrase and, if an ssh master connection is open or the borgserver listens on
+    another port than 22, the ssh command borg connects with.
 
-    Raises:
-        BorgError: Raises this exception when the command didn't run successfully.
+    Returns:
+        dict: The environment
     """
     my_env = {**os.environ, "BORG_PASSPHRASE": f"{kwargs['password']}"}
     if "borg_relocated_repo_access_is_ok" in kwargs:
         my_env["BORG_RELOCATED_REPO_ACCESS_IS_OK"] = kwargs["borg_relocated_repo_access_is_ok"]
+    if kwargs.get("ssh_master") and kwargs["ssh_master"].is_open:
+        my_env["BORG_RSH"] = kwargs["ssh_master"].rsh()
+    elif sshmux.port_option(kwargs.get("ssh_port", 22)):
+        my_env["BORG_RSH"] = f"ssh {sshmux.port_option(kwargs['ssh_port'])}"
+    if kwargs.get("borg_cache_dir"):
+        my_env["BORG_CACHE_DIR"] = kwargs["borg_cache_dir"]
+    return my_env
+
+
+def _handlers(log, **kwargs) -> list:
+    """Returns the line handlers of a borg call that may touch the chunks cache: 'log' and, for a managed cache, its SyncLog."""
+    if kwargs.get("cache_sync"):
+        return [log, kwargs["cache_sync"]]
+    return [log]
+
+
+def _verbosity(**kwargs) -> str:
+    """borg only logs the resyncs of its chunks cache with --info, it's added if they are timed."""
+    return "--info" if kwargs.get("cache_sync") else ""
+
+
+def _lock_wait(**kwargs) -> str:
+    """Returns --lock-wait if 'retry' sets how long borg waits for the lock of a repo another client holds."""
+    lock_wait = (kwargs.get("retry") or {}).get("lock_wait")
+    return f"--lock-wait {lock_wait:.0f}" if lock_wait else ""
+
+
+def _isolated(cmd: str, **kwargs) -> str:
+    """Prefixes a command with the nice/ionice/cgroup settings of 'isolation', see throttle.isolation()."""
+    return f"{kwargs['isolation_prefix']} {cmd}" if kwargs.get("isolation_prefix") else cmd
+
+
+def _get_source(**kwargs) -> str:
+    """Returns the folder 'borg create' reads from. That is 'rootfolder/foldername' unless a snapshot of it is used.
+
+    Returns:
+        str: The folder to back up.
+    """
+    if kwargs.get("backup_source"):
+        return kwargs["backup_source"]
+    return f"{kwargs['rootfolder']}{kwargs['foldername']}"
+
+
+@dataclass
+class RepoInfo:
+    """What 'borg info --json' says about a repository."""
+
+    repository_id: str = ""
+    location: str = ""
+    encryption_mode: str = ""
+    original_size: int = 0
+    compressed_size: int = 0
+    deduplicated_size: int = 0
+    unique_chunks: int = 0
+    total_chunks: int = 0
+
+    @property
+    def encrypted_with_repokey(self) -> bool:
+        """True if the repo is encrypted using repokey (standard or blake2)."""
+        return self.encryption_mode.startswith("repokey")
+
+
+@dataclass
+class ArchiveResult:
+    """What 'borg create --json' says about the archive it created."""
+
+    name: str = ""
+    archive_id: str = ""
+    repository_id: str = ""
+    duration: float = 0.0
+    original_size: int = 0
+    compressed_size: int = 0
+    deduplicated_size: int = 0
+    nfiles: int = 0
+
+    def summary(self) -> str:
+        return (
+            f"Archive {self.name}: {self.nfiles} files, {format_size(self.original_size)} read, "
+            f"{format_size(self.compressed_size)} compressed, {format_size(self.deduplicated_size)} new after deduplication, "
+            f"created in {self.duration:.0f}s."
+        )
+
+
+@dataclass
+class PruneResult:
+    """The archives 'borg prune --list' kept and pruned."""
+
+    kept: List[str] = field(default_factory=list)
+    pruned: List[str] = field(default_factory=list)
+
+    def summary(self) -> str:
+        return f"Prune: kept {len(self.kept)} archives, pruned {len(self.pruned)}."
+
+
+# what follows the archive name in a checkpoint, the timestamp of create() and borg's .checkpoint or .checkpoint.N
+CHECKPOINT = re.compile(r"-\d{4}-\d{2}-\d{2}-\d{6}\.checkpoint(?:\.\d+)?")
+
+# borg's message IDs (--log-json) of the errors that get their own exception
+MSGID_EXCEPTIONS = {
+    "LockTimeout": BorgErrorGettingLock,
+    "LockFailed": BorgErrorGettingLock,
+    "LockError": BorgErrorGettingLock,
+    "LockErrorT": BorgErrorGettingLock,
+    "ConnectionClosed": BorgConnectionClosed,
+    "ConnectionClosedWithHint": BorgConnectionClosed,
+    "Repository.DoesNotExist": RepoDoesNotExist,
+    "PassphraseWrong": WrongRepokey,
+}
+
+
+class LogJson:
+    """Line handler for 'borg --log-json' output. Keeps the message IDs and the last error message."""
+
+    def __init__(self):
+        self.msgids = []
+        self.messages = []
+        self.error = ""
+
+    def __call__(self, line: str) -> None:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            return
+        if not isinstance(entry, dict) or entry.get("type") != "log_message":
+            return
+        if entry.get("msgid"):
+            self.msgids.append(entry["msgid"])
+        if entry.get("levelname") in ("ERROR", "CRITICAL"):
+            self.error = entry.get("message", "")
+        if entry.get("name") == "borg.output.list":
+            self.messages.append(entry.get("message", ""))
+
+    def raise_for_error(self, default: str) -> None:
+        """Raises the exception matching the first known message ID, BorgError otherwise.
+
+        Args:
+            default (str): Message of the BorgError if no error message was logged.
+        """
+        for msgid in self.msgids:
+            if msgid in MSGID_EXCEPTIONS:
+                raise MSGID_EXCEPTIONS[msgid](f"{msgid}: {self.error}")
+        raise BorgError(f"{default}: {self.error}" if self.error else default)
+
+
+def _is_progress(line: str) -> bool:
+    """Tells borg's JSON progress lines apart from log messages, so cmd_run() rate-limits them."""
+    return line.startswith('{"type": "') and (
+        '"type": "archive_progress"' in line
+        or '"type": "progress_percent"' in line
+        or '"type": "progress_message"' in line
+        or '"type": "file_status"' in line
+    )
+
+
+def _parse_json(stdout: str) -> dict:
+    """Parses the JSON borg prints to stdout. In debug mode there is none, an empty dict is returned then.
+
+    Args:
+        stdout (str): stdout of borg
+
+    Returns:
+        dict: The parsed JSON
+    """
+    try:
+        parsed = json.loads(stdout)
+    except ValueError:
+        logger.debug("borg didn't print JSON")
+        return {}
+    return parsed if isinstance(parsed, dict) else {}
+
+
+def _parse_info(stdout: str) -> RepoInfo:
+    """Turns the output of 'borg info --json' into a RepoInfo.
+
+    Args:
+        stdout (str): stdout of 'borg info --json'
+
+    Returns:
+        RepoInfo: The repository info
+    """
+    parsed = _parse_json(stdout)
+    stats = parsed.get("cache", {}).get("stats", {})
+    return RepoInfo(
+        repository_id=parsed.get("repository", {}).get("id", ""),
+        location=parsed.get("repository", {}).get("location", ""),
+        encryption_mode=parsed.get("encryption", {}).get("mode", ""),
+        original_size=stats.get("total_size", 0),
+        compressed_size=stats.get("total_csize", 0),
+        deduplicated_size=stats.get("unique_csize", 0),
+        unique_chunks=stats.get("total_unique_chunks", 0),
+        total_chunks=stats.get("total_chunks", 0),
+    )
+
+
+def _parse_create(stdout: str) -> ArchiveResult:
+    """Turns the output of 'borg create --json' into an ArchiveResult.
+
+    Args:
+        stdout (str): stdout of 'borg create --json'
+
+    Returns:
+        ArchiveResult: The archive
+    """
+    parsed = _parse_json(stdout)
+    archive = parsed.get("archive", {})
+    stats = archive.get("stats", {})
+    return ArchiveResult(
+        name=archive.get("name", ""),
+        archive_id=archive.get("id", ""),
+        repository_id=parsed.get("repository", {}).get("id", ""),
+        duration=archive.get("duration", 0.0),
+        original_size=stats.get("original_size", 0),
+        compressed_size=stats.get("compressed_size", 0),
+        deduplicated_size=stats.get("deduplicated_size", 0),
+        nfiles=stats.get("nfiles", 0),
+    )
+
+
+def _parse_prune(messages: List[str]) -> PruneResult:
+    """Turns the --list messages of 'borg prune' into a PruneResult.
+
+    Args:
+        messages (List[str]): The messages of logger 'borg.output.list'
+
+    Returns:
+        PruneResult: The kept and pruned archives
+    """
+    result = PruneResult()
+    for message in messages:
+        # borg >= 1.2 writes f.ex. 'Keeping archive (rule: daily #1):  name  date [id]', older versions 'Keeping archive: name ...'
+        rest = message.split("):", 1)[1] if "):" in message else message.split(":", 1)[-1]
+        name = rest.split()[0] if rest.split() else ""
+        if message.startswith("Keeping archive"):
+            result.kept.append(name)
+        elif message.startswith(("Pruning archive", "Would prune")):
+            result.pruned.append(name)
+    return result
+
+
+def _parse_list(stdout: str) -> RepoInfo:
+    """Turns the output of 'borg list --json' into a RepoInfo without sizes.
+
+    Args:
+        stdout (str): stdout of 'borg list --json'
+
+    Returns:
+        RepoInfo: Repository ID, location and encryption mode.
+    """
+    parsed = _parse_json(stdout)
+    return RepoInfo(
+        repository_id=parsed.get("repository", {}).get("id", ""),
+        location=parsed.get("repository", {}).get("location", ""),
+        encryption_mode=parsed.get("encryption", {}).get("mode", ""),
+    )
+
+
+def _create_options(**kwargs) -> str:
+    """Returns the parameters of 'borg create': borg_parameters['create'], the patterns file, the upload rate limit and the checkpoint
+    interval."""
     params = _get_parameters("create", **kwargs)
-    cmd = f"borg create {params} {kwargs['borguser']}@{kwargs['borgserver']}:{kwargs['borgrepo']}::{kwargs['borgarchive']}-{{now:%Y-%m-%d-%H%M%S}} {kwargs['rootfolder']}{kwargs['foldername']}"  # double {{ to escape for f-string
+    checkpoint_interval = (kwargs.get("retry") or {}).get("checkpoint_interval")
+    if checkpoint_interval:
+        params = f"--checkpoint-interval {checkpoint_interval:.0f} {params}"
+    if kwargs.get("patterns_file"):
+        params = f"--patterns-from {kwargs['patterns_file']} {params}"
+    if kwargs.get("upload_ratelimit"):
+        # borg wants KiB/s
+        params = f"--upload-ratelimit {max(1, kwargs['upload_ratelimit'] // 1024)} {params}"
+    return params
+
 
-    result = cmd_run(cmd, env=my_env, **kwargs)
+def _run_create(cmd: str, **kwargs) -> ArchiveResult:
+    log = LogJson()
+    result = cmd_run(
+        _isolated(cmd, **kwargs),
+        env=_get_env(**kwargs),
+        handlers=_handlers(log, **kwargs),
+        is_progress=_is_progress,
+        capture_stdout=True,
+        **kwargs,
+    )
     if result.returncode != 0:
-        raise BorgError(f"Error running borg: {result.stdout}")
+        log.raise_for_error("Error running borg create")
+    archive = _parse_create(result.stdout)
+    logger.info(archive.summary())
+    return archive
 
 
-def prune(**kwargs) -> None:
+def create(**kwargs) -> ArchiveResult:
+    """Creates a borg archive.
+
+    Raises:
+        BorgError: Raises this exception when the command didn't run successfully.
+
+    Returns:
+        ArchiveResult: Name, sizes, file count and duration of the new archive.
+    """
+    params = _create_options(**kwargs)
+    cmd = f"borg create --json --log-json {_verbosity(**kwargs)} {_lock_wait(**kwargs)} {params} {kwargs['borguser']}@{kwargs['borgserver']}:{kwargs['borgrepo']}::{kwargs['borgarchive']}-{{now:%Y-%m-%d-%H%M%S}} {_get_source(**kwargs)}"  # double {{ to escape for f-string
+    return _run_create(cmd, **kwargs)
+
+
+def dump_archive(dump: str, **kwargs) -> str:
+    """Returns the name of the archives holding a database dump, without the timestamp."""
+    return f"{kwargs['borgarchive']}-dump-{dump}"
+
+
+def create_from_command(dump: str, command: str, **kwargs) -> ArchiveResult:
+    """Creates an archive holding the stdout of 'command' as the single item 'dump' (borg >= 1.2). Nothing is written to local disk,
+    borg fails if the command does.
+
+    Args:
+        dump (str): The name of the dump, f.ex. nextcloud-db
+        command (str): The command writing the dump to stdout.
+
+    Raises:
+        BorgError: Raised if the command or borg failed.
+
+    Returns:
+        ArchiveResult: Name, sizes and duration of the new archive.
+    """
+    kwargs = {k: v for k, v in kwargs.items() if k != "patterns_file"}
+    params = _create_options(**kwargs)
+    cmd = f"borg create --json --log-json {_verbosity(**kwargs)} {_lock_wait(**kwargs)} --content-from-command --stdin-name {dump} {params} {kwargs['borguser']}@{kwargs['borgserver']}:{kwargs['borgrepo']}::{dump_archive(dump, **kwargs)}-{{now:%Y-%m-%d-%H%M%S}} -- {command}"
+    return _run_create(cmd, **kwargs)
+
+
+def prune(**kwargs) -> PruneResult:
     """Prunes borg archives.
 
+    With database dumps the archives of the files and of every dump are pruned separately, each series keeps its own daily,
+    weekly... archives.
+
     Raises:
         BorgError: Raises this exception whent he command didn't run successfully
+
+    Returns:
+        PruneResult: The kept and pruned archives.
     """
-    my_env = {**os.environ, "BORG_PASSPHRASE": f"{kwargs['password']}"}
-    if "borg_relocated_repo_access_is_ok" in kwargs:
-        my_env["BORG_RELOCATED_REPO_ACCESS_IS_OK"] = kwargs["borg_relocated_repo_access_is_ok"]
+    my_env = _get_env(**kwargs)
     params = _get_parameters("prune", **kwargs)
-    cmd = f"borg prune {params} {kwargs['borguser']}@{kwargs['borgserver']}:{kwargs['borgrepo']}"
+    series = [""]
+    if kwargs.get("dumps"):
+        # the timestamp of the file archives starts with a digit, the dump archives continue with -dump-
+        series = [f"--glob-archives '{kwargs['borgarchive']}-[0-9]*'"]
+        series += [f"--glob-archives '{dump_archive(d['name'], **kwargs)}-*'" for d in kwargs["dumps"]]
+    pruned = PruneResult()
+    for glob in series:
+        cmd = f"borg prune --log-json --list {_verbosity(**kwargs)} {_lock_wait(**kwargs)} {glob} {params} {kwargs['borguser']}@{kwargs['borgserver']}:{kwargs['borgrepo']}"
+        cmd = _isolated(cmd, **kwargs)
+
+        log = LogJson()
+        result = cmd_run(cmd, env=my_env, handlers=_handlers(log, **kwargs), is_progress=_is_progress, **kwargs)
+        if result.returncode != 0:
+            log.raise_for_error("Error running borg prune")
+        part = _parse_prune(log.messages)
+        pruned.kept += part.kept
+        pruned.pruned += part.pruned
+    logger.info(pruned.summary())
+    return pruned
+
+
+def compact(**kwargs) -> int:
+    """Frees the space of deleted archives in a borg repo (borg >= 1.2).
+
+    Raises:
+        BorgErrorGettingLock: Raised if borg couldn't get the lock of the repo.
+        BorgError: Raised on every other error running 'borg compact ...'.
 
-    result = cmd_run(cmd, env=my_env, **kwargs)
+    Returns:
+        int: Bytes freed according to borg, 0 if it didn't say.
+    """
+    my_env = _get_env(**kwargs)
+    params = _get_parameters("compact", **kwargs)
+    cmd = f"borg compact --info --log-json {_lock_wait(**kwargs)} {params} {kwargs['borguser']}@{kwargs['borgserver']}:{kwargs['borgrepo']}"
+    cmd = _isolated(cmd, **kwargs)
+
+    log = LogJson()
+    freed = LineMatcher(r"(?i)compaction freed about ([\d.]+ ?\w*B) repository space")
+    result = cmd_run(cmd, env=my_env, handlers=[log, freed], **kwargs)
     if result.returncode != 0:
-        raise BorgError("Error running borg prune")
+        log.raise_for_error("Error running borg compact")
+    size = parse_size(freed.match.group(1)) if freed.matched else 0
+    logger.info(f"Compact: freed {format_size(size)}.")
+    return size
 
 
-def info(**kwargs) -> str:
-    """Gets info on a borg repo and returns the stdout of 'borg info'.
+def check(**kwargs) -> None:
+    """Verifies the consistency of a borg repo. borg_parameters['check'] selects what is checked, f.ex. --repository-only.
 
     Raises:
-        BorgError: Raised if there was an error running 'borg info ... ' that isn't a 'Repo does not exist'-error.
+        BorgErrorGettingLock: Raised if borg couldn't get the lock of the repo.
+        BorgError: Raised if borg found problems or on every other error running 'borg check ...'.
+    """
+    my_env = _get_env(**kwargs)
+    params = _get_parameters("check", **kwargs)
+    cmd = f"borg check --log-json {_lock_wait(**kwargs)} {params} {kwargs['borguser']}@{kwargs['borgserver']}:{kwargs['borgrepo']}"
+    cmd = _isolated(cmd, **kwargs)
+
+    log = LogJson()
+    result = cmd_run(cmd, env=my_env, handlers=[log], **kwargs)
+    if result.returncode != 0:
+        log.raise_for_error("borg check failed")
+
+
+def info(**kwargs) -> RepoInfo:
+    """Gets info on a borg repo.
+
+    Raises:
+        BorgErrorGettingLock: Raised if borg couldn't get the lock of the repo.
+        RepoDoesNotExist: Raised if the repo doesn't exist.
+        WrongRepokey: Raised if the repo can't be decrypted with the supplied BORG_PASSPHRASE.
+        BorgError: Raised on every other error running 'borg info ...'.
 
     Returns:
-        str: stdout of 'borg 'init'
+        RepoInfo: Repository ID, encryption mode and sizes of the repo.
     """
-    my_env = {**os.environ, "BORG_PASSPHRASE": f"{kwargs['password']}"}
-    if "borg_relocated_repo_access_is_ok" in kwargs:
-        my_env["BORG_RELOCATED_REPO_ACCESS_IS_OK"] = kwargs["borg_relocated_repo_access_is_ok"]
+    my_env = _get_env(**kwargs)
     params = _get_parameters("info", **kwargs)
-    cmd = f"borg info {params} {kwargs['borguser']}@{kwargs['borgserver']}:{kwargs['borgrepo']}"
+    cmd = f"borg info --json --log-json {_verbosity(**kwargs)} {_lock_wait(**kwargs)} {params} {kwargs['borguser']}@{kwargs['borgserver']}:{kwargs['borgrepo']}"
 
-    result = cmd_run(cmd, env=my_env, **kwargs)
-    contains = re.search("Failed to create/acquire the lock", result.stdout)
-    if contains:
-        raise BorgErrorGettingLock("Couldn't create/aquire the lock. Check if you can delete the lock.")
+    log = LogJson()
+    result = cmd_run(cmd, env=my_env, handlers=_handlers(log, **kwargs), capture_stdout=True, **kwargs)
     if result.returncode != 0:
-        _check_repo_exists(result.stdout)
-        raise BorgError("Error running borg info")
-    return result.stdout
+        log.raise_for_error("Error running borg info")
+    return _parse_info(result.stdout)
 
 
-def repo_checks(**kwargs) -> None:
-    """Convenience function that calls all the necessary checks before creating an archive.
+def list_last(**kwargs) -> RepoInfo:
+    """Lists the last archive of a borg repo. That's cheap, but still needs the repo to exist and the passphrase to be right.
 
     Raises:
-        NotRepokeyEncrypted: Raised if configuration says repo is encrypted but 'borg info' says it isn't.
+        BorgErrorGettingLock: Raised if borg couldn't get the lock of the repo.
+        RepoDoesNotExist: Raised if the repo doesn't exist.
+        WrongRepokey: Raised if the repo can't be decrypted with the supplied BORG_PASSPHRASE.
+        BorgError: Raised on every other error running 'borg list ...'.
+
+    Returns:
+        RepoInfo: Repository ID, location and encryption mode of the repo, without sizes.
     """
-    if kwargs["debug"] is True:
-        return
-    check_ssh_login(**kwargs)
-    stdout = info(**kwargs)
-    _check_repo_exists(stdout)
+    my_env = _get_env(**kwargs)
+    params = _get_parameters("list", **kwargs)
+    cmd = f"borg list --last 1 --json --log-json {_lock_wait(**kwargs)} {params} {kwargs['borguser']}@{kwargs['borgserver']}:{kwargs['borgrepo']}"
 
-    if kwargs["repo_encrypted"]:
-        if _repo_encrypted_with_repokey(stdout):
-            _check_password_correct(stdout)
-        else:
-            raise NotRepokeyEncrypted(
-                "Config says repo is encrypted (repo_encrypted), but borg says repo isn't repokey encrypted."
-            )
+    log = LogJson()
+    result = cmd_run(cmd, env=my_env, handlers=[log], capture_stdout=True, **kwargs)
+    if result.returncode != 0:
+        log.raise_for_error("Error running borg list")
+    return _parse_list(result.stdout)
 
 
-def _check_repo_exists(stdout: str) -> None:
-    """Checks the output of info() to see whether the requested repo exists.
+def _is_checkpoint(archive: str, **kwargs) -> bool:
+    """Tells the checkpoints of the stack's file and dump archives apart from the ones of other stacks sharing the repo."""
+    series = [kwargs["borgarchive"]] + [dump_archive(d["name"], **kwargs) for d in kwargs.get("dumps") or []]
+    return any(archive.startswith(s) and CHECKPOINT.fullmatch(archive[len(s) :]) for s in series)
 
-    Args:
-        stdout (str): The output of info()
+
+def checkpoints(**kwargs) -> List[str]:
+    """Lists the checkpoint archives that interrupted creates of the stack left in the repo. The next create finds their chunks in the
+    repo and only uploads the rest, until the checkpoints are deleted. borg 1.2 hides checkpoints without --consider-checkpoints.
 
     Raises:
-        RepoDoesNotExist: Raised if the repo doesn't exist.
+        BorgErrorGettingLock: Raised if borg couldn't get the lock of the repo.
+        BorgError: Raised on every other error running 'borg list ...'.
+
+    Returns:
+        List[str]: The names of the checkpoints, oldest first.
     """
-    contains = re.search("Repository .* does not exist", stdout)
-    if contains:
-        raise RepoDoesNotExist("Repo doesn't exist, do you need to 'init' it?")
+    my_env = _get_env(**kwargs)
+    cmd = f"borg list --json --log-json {_lock_wait(**kwargs)} --consider-checkpoints --glob-archives '{kwargs['borgarchive']}-*.checkpoint*' {kwargs['borguser']}@{kwargs['borgserver']}:{kwargs['borgrepo']}"
+
+    log = LogJson()
+    result = cmd_run(cmd, env=my_env, handlers=[log], capture_stdout=True, **kwargs)
+    if result.returncode != 0:
+        log.raise_for_error("Error running borg list")
+    names = [a.get("name", "") for a in _parse_json(result.stdout).get("archives", [])]
+    return [n for n in names if _is_checkpoint(n, **kwargs)]
 
 
-def _repo_encrypted_with_repokey(stdout: str) -> bool:
-    """Checks the output of borg() to see whether the repo is encrypted using repokey(standard or blake2)
+def delete(names: List[str], **kwargs) -> None:
+    """Deletes archives from a borg repo, the space is freed by the next compact.
 
     Args:
-        stdout (str): The output of info()
+        names (List[str]): The names of the archives
 
-    Returns:
-        bool: True if the repo is encrypted using repokey, False otherwise.
+    Raises:
+        BorgErrorGettingLock: Raised if borg couldn't get the lock of the repo.
+        BorgError: Raised on every other error running 'borg delete ...'.
     """
-    contains = re.search("Encrypted: Yes [(]repokey", stdout)
-    if contains:
-        return True
-    else:
-        return False
+    my_env = _get_env(**kwargs)
+    cmd = f"borg delete --log-json {_lock_wait(**kwargs)} --consider-checkpoints {kwargs['borguser']}@{kwargs['borgserver']}:{kwargs['borgrepo']} {' '.join(names)}"
+    cmd = _isolated(cmd, **kwargs)
 
+    log = LogJson()
+    result = cmd_run(cmd, env=my_env, handlers=[log], **kwargs)
+    if result.returncode != 0:
+        log.raise_for_error("Error running borg delete")
 
-def _check_password_correct(stdout: str) -> None:
-    """Checks the output of borg() to see whether the password is correct.
 
-    Args:
-        stdout (str): The output of borg()
+def _check_encryption(repo: RepoInfo, **kwargs) -> None:
+    if kwargs["repo_encrypted"] and not repo.encrypted_with_repokey:
+        raise NotRepokeyEncrypted(
+            "Config says repo is encrypted (repo_encrypted), but borg says repo isn't repokey encrypted."
+        )
+
+
+def repo_checks(**kwargs) -> RepoInfo:
+    """Convenience function that calls all the necessary checks on the repo before creating an archive.
+
+    A full 'borg info' is only run if the repo wasn't verified within 'repo_check_ttl' seconds. Otherwise the last archive is listed
+    and the repository ID compared with the verified one, a changed ID forces the full check.
 
     Raises:
-        WrongRepokey: Raised if the repo can't be decrypted with the supplied BORG_PASSPHRASE
+        NotRepokeyEncrypted: Raised if configuration says repo is encrypted but borg says it isn't.
+
+    Returns:
+        RepoInfo: The info of the repo (without sizes if the cheap check was used), None in debug mode.
     """
-    contains = re.search("passphrase supplied in .* is incorrect.", stdout)
-    if contains:
-        raise WrongRepokey("The supplied password is wrong.")
+    if kwargs["debug"] is True:
+        return
+    cache_dir = kwargs.get("cache_dir")
+    ttl = kwargs.get("repo_check_ttl", 0)
+    key = f"{kwargs['borgserver']}:{kwargs['borgrepo']}"
+    verified = repocache.lookup(cache_dir, key, ttl) if cache_dir and ttl else None
+    if verified:
+        repo = list_last(**kwargs)
+        if repo.repository_id == verified.repository_id:
+            _check_encryption(repo, **kwargs)
+            logger.info(f"Repository {key} verified by listing its last archive")
+            return repo
+        logger.warning(
+            f"Repository ID of {key} changed from {verified.repository_id} to {repo.repository_id}, running full check"
+        )
+        repocache.forget(cache_dir, key)
+    repo = info(**kwargs)
+    _check_encryption(repo, **kwargs)
+    if cache_dir and ttl:
+        repocache.store(cache_dir, key, repo.repository_id, repo.encryption_mode)
+    return repo
 
 
 def check_ssh_login(**kwargs) -> None:
@@ -193,11 +630,12 @@ def check_ssh_login(**kwargs) -> None:
     Raises:
         ConnectionError: Raised if the ssh-connection fails.
     """
-    cmd = f"ssh -o BatchMode=yes -o ConnectTimeout=5 {kwargs['borguser']}@{kwargs['borgserver']} echo"
-    result = cmd_run(cmd, debug=kwargs["debug"])
+    options = sshmux.client_options(kwargs.get("ssh_port", 22), kwargs.get("ssh_master"))
+    cmd = f"ssh -o BatchMode=yes -o ConnectTimeout=5 {options} {kwargs['borguser']}@{kwargs['borgserver']} echo"
+    result = cmd_run(cmd, debug=kwargs["debug"], timeout=kwargs.get("timeout"))
     logger.info(result.returncode)
     if result.returncode != 0:
-        raise ConnectionError("Error ssh'ing to server: {result.stdout}")
+        raise ConnectionError(f"Error ssh'ing to server: {result.stdout}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,225 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import List
+from units import format_size, parse_duration, parse_size
+
+logger = logging.getLogger(__name__)
+
+META_FILE = ".dcborgbackup.json"
+LOCK_FILE = ".dcborgbackup.lock"
+REMOVE_AFTER = 30 * 86400
+# borg keeps the cache of a repository in a folder named after the repository ID
+REPOSITORY_ID = re.compile(r"^[0-9a-f]{64}$")
+
+
+@dataclass
+class CacheSync:
+    """One resync of borg's chunks cache, f.ex. because another host wrote to the repo."""
+
+    seconds: float
+    archives_fetched: int
+
+
+class SyncLog:
+    """Line handler for 'borg --log-json --info' output. Times the resyncs of the chunks cache.
+
+    borg logs 'Synchronizing chunks cache...' when it starts, 'Fetching and building archive index for ...' for every archive it has
+    to download and 'Done.' when it's finished.
+    """
+
+    def __init__(self):
+        self.syncs = []
+        self._started = None
+        self._fetched = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, line: str) -> None:
+        if '"log_message"' not in line:
+            return
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            return
+        if not isinstance(entry, dict):
+            return
+        message = entry.get("message", "")
+        now = entry.get("time", time.time())
+        with self._lock:
+            if message.startswith("Synchronizing chunks cache"):
+                self._started = now
+                self._fetched = 0
+            elif self._started is None:
+                return
+            elif message.startswith("Fetching and building archive index"):
+                self._fetched += 1
+            elif message == "Done.":
+                self.syncs.append(CacheSync(now - self._started, self._fetched))
+                logger.info(
+                    f"borg resynced its chunks cache in {now - self._started:.1f}s, fetched {self._fetched} archive indexes"
+                )
+                self._started = None
+
+    @property
+    def seconds(self) -> float:
+        return sum(s.seconds for s in self.syncs)
+
+
+@dataclass
+class CacheUse:
+    """The cache a target used during a run."""
+
+    target: str
+    path: str
+    size: int = 0
+    syncs: List[CacheSync] = field(default_factory=list)
+
+    @property
+    def sync_seconds(self) -> float:
+        return sum(s.seconds for s in self.syncs)
+
+    def summary(self) -> str:
+        line = f"Borg cache: {format_size(self.size)}"
+        if self.syncs:
+            fetched = sum(s.archives_fetched for s in self.syncs)
+            line += f", resynced {len(self.syncs)}x in {self.sync_seconds:.0f}s ({fetched} archive indexes fetched)"
+        return line + "."
+
+
+def settings(value) -> dict:
+    """Turns the 'borg_cache' part of the configuration into path, max_size (bytes) and remove_after (seconds).
+
+    Args:
+        value (dict): f.ex. {"path": "/ssd/borg", "max_size": "50GB", "remove_after": "30d"}
+
+    Raises:
+        ValueError: Raised if max_size or remove_after can't be parsed.
+
+    Returns:
+        dict: The settings, path is None if it isn't set.
+    """
+    value = value or {}
+    return {
+        "path": value.get("path"),
+        "max_size": parse_size(str(value["max_size"])) if value.get("max_size") else None,
+        "remove_after": parse_duration(value.get("remove_after", REMOVE_AFTER)),
+    }
+
+
+def cache_path(root: str, server: str, repo: str) -> str:
+    """Returns the BORG_CACHE_DIR of a repo: a folder in 'root' named after server and repo.
+
+    Returns:
+        str: f.ex. <root>/nas.local_stack-1a2b3c4d
+    """
+    name = re.sub(r"[^A-Za-z0-9._-]", "_", f"{server}_{repo}")
+    digest = hashlib.blake2b(f"{server}:{repo}".encode(), digest_size=4).hexdigest()
+    return os.path.join(root, f"{name}-{digest}")
+
+
+def folder_size(path: str) -> int:
+    """Returns the size of all files below 'path' in bytes."""
+    total = 0
+    for folder, _, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(folder, f)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class Lease:
+    """A cache in use. Holds a shared lock on it, so cleanup() of other runs leaves it alone."""
+
+    def __init__(self, path: str, server: str, repo: str):
+        self.path = path
+        lock_path = os.path.join(path, LOCK_FILE)
+        while True:
+            os.makedirs(path, mode=0o700, exist_ok=True)
+            self._lock = open(lock_path, "a")
+            fcntl.flock(self._lock, fcntl.LOCK_SH)
+            # cleanup() of another run may have removed the cache while we waited for the lock
+            if os.path.exists(lock_path) and os.path.samestat(os.fstat(self._lock.fileno()), os.stat(lock_path)):
+                break
+            self._lock.close()
+        with open(os.path.join(path, META_FILE), "w") as f:
+            json.dump({"server": server, "repo": repo, "last_used": time.time()}, f)
+
+    def drop_stale(self, repository_id: str) -> int:
+        """Removes the caches of other repository IDs, left behind if the repo was recreated.
+
+        Returns:
+            int: Bytes freed.
+        """
+        freed = 0
+        for entry in os.listdir(self.path):
+            full = os.path.join(self.path, entry)
+            if REPOSITORY_ID.match(entry) and entry != repository_id and os.path.isdir(full):
+                freed += folder_size(full)
+                logger.info(f"Removing the cache of repository {entry}, {self.path} belongs to {repository_id} now")
+                shutil.rmtree(full, ignore_errors=True)
+        return freed
+
+    def release(self) -> None:
+        self._lock.close()
+
+
+def _last_used(path: str) -> float:
+    try:
+        with open(os.path.join(path, META_FILE), "r") as f:
+            return json.load(f)["last_used"]
+    except (OSError, ValueError, KeyError):
+        return os.path.getmtime(path)
+
+
+def cleanup(root: str, max_size: int = None, remove_after: float = REMOVE_AFTER) -> List[str]:
+    """Removes the caches in 'root' that weren't used for 'remove_after' seconds, f.ex. of repos that don't exist anymore, and
+    the least recently used ones while all together are bigger than 'max_size'. Caches in use are never removed.
+
+    Args:
+        root (str): The folder holding the caches.
+        max_size (int, optional): Bytes all caches may take. Defaults to no limit.
+        remove_after (float, optional): Seconds after which an unused cache is removed. Defaults to 30 days.
+
+    Returns:
+        List[str]: The removed caches.
+    """
+    if not os.path.isdir(root):
+        return []
+    caches = []
+    for entry in os.listdir(root):
+        path = os.path.join(root, entry)
+        if os.path.isdir(path) and os.path.exists(os.path.join(path, META_FILE)):
+            caches.append((_last_used(path), folder_size(path), path))
+    caches.sort()
+    total = sum(size for _, size, _ in caches)
+    removed = []
+    now = time.time()
+    for last_used, size, path in caches:
+        too_old = now - last_used > remove_after
+        too_big = max_size is not None and total > max_size
+        if not too_old and not too_big:
+            continue
+        with open(os.path.join(path, LOCK_FILE), "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            reason = "unused since " + time.strftime("%Y-%m-%d", time.localtime(last_used)) if too_old else "over max_size"
+            logger.info(f"Removing borg cache {path} ({format_size(size)}, {reason})")
+            shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        removed.append(path)
+    return removed
+
+
+if __name__ == "__main__":
+    pass
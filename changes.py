@@ -0,0 +1,219 @@
+import hashlib
+import logging
+import os
+import queue
+import stat
+import struct
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+# the manifest holds one record per directory: a hash of its path and a digest of its entries (name, type, size, mtime, inode)
+MAGIC = b"DCBBMAN1"
+KEY_SIZE = 8
+DIGEST_SIZE = 16
+RECORD = struct.Struct(f"{KEY_SIZE}s{DIGEST_SIZE}s")
+EXAMPLES = 5
+
+
+class ScanError(Exception):
+    pass
+
+
+@dataclass
+class ScanResult:
+    """The state of a folder and how it differs from the last manifest."""
+
+    manifest: Dict[bytes, bytes]
+    paths: Dict[bytes, str] = field(default_factory=dict)
+    files: int = 0
+    dirs: int = 0
+    duration: float = 0.0
+    first_scan: bool = True
+    changed_dirs: int = 0
+    removed_dirs: int = 0
+    examples: List[str] = field(default_factory=list)
+
+    @property
+    def changed(self) -> bool:
+        return self.first_scan or self.changed_dirs > 0 or self.removed_dirs > 0
+
+    def summary(self) -> str:
+        scanned = f"Scanned {self.files} files in {self.dirs} folders in {self.duration:.1f}s"
+        if self.first_scan:
+            return f"{scanned}, no manifest of the last backup."
+        if not self.changed:
+            return f"{scanned}, nothing changed since the last backup."
+        examples = f" f.ex. {', '.join(self.examples)}" if self.examples else ""
+        return f"{scanned}, {self.changed_dirs} folders changed{examples}, {self.removed_dirs} removed."
+
+
+def _key(relpath: str) -> bytes:
+    return hashlib.blake2b(relpath.encode(errors="surrogateescape"), digest_size=KEY_SIZE).digest()
+
+
+def _scan_dir(path: str, relpath: str):
+    """Digests the entries of one folder.
+
+    Returns:
+        tuple: (digest, number of entries, subfolders as (path, relpath))
+    """
+    digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    entries = []
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            st = entry.stat(follow_symlinks=False)
+            entries.append(
+                f"{entry.name}\0{stat.S_IFMT(st.st_mode)}\0{st.st_size}\0{st.st_mtime_ns}\0{st.st_ino}\n"
+            )
+            if stat.S_ISDIR(st.st_mode):
+                subdirs.append((entry.path, f"{relpath}/{entry.name}" if relpath else entry.name))
+    for line in sorted(entries):
+        digest.update(line.encode(errors="surrogateescape"))
+    return digest.digest(), len(entries), subdirs
+
+
+def scan(root: str, workers: int = 1) -> ScanResult:
+    """Walks 'root' and digests every folder.
+
+    Args:
+        root (str): The folder to scan.
+        workers (int, optional): Number of threads walking the tree, worth it on storage with high latency. Defaults to 1.
+
+    Raises:
+        ScanError: Raised if a folder can't be read.
+
+    Returns:
+        ScanResult: The manifest of 'root'.
+    """
+    start = time.monotonic()
+    result = ScanResult({})
+    lock = threading.Lock()
+
+    def visit(path: str, relpath: str) -> list:
+        try:
+            digest, count, subdirs = _scan_dir(path, relpath)
+        except OSError as e:
+            raise ScanError(f"Couldn't scan {path}: {e}")
+        key = _key(relpath)
+        with lock:
+            result.manifest[key] = digest
+            result.paths[key] = relpath or "."
+            result.files += count - len(subdirs)
+            result.dirs += 1
+        return subdirs
+
+    if workers <= 1:
+        pending = [(root, "")]
+        while pending:
+            pending.extend(visit(*pending.pop()))
+    else:
+        todo = queue.Queue()
+        errors = []
+        todo.put((root, ""))
+
+        def work():
+            while True:
+                item = todo.get()
+                if item is None:
+                    return
+                try:
+                    if not errors:
+                        for subdir in visit(*item):
+                            todo.put(subdir)
+                except ScanError as e:
+                    errors.append(e)
+                finally:
+                    todo.task_done()
+
+        threads = [threading.Thread(target=work, daemon=True) for _ in range(workers)]
+        for t in threads:
+            t.start()
+        todo.join()
+        for _ in threads:
+            todo.put(None)
+        if errors:
+            raise errors[0]
+    result.duration = time.monotonic() - start
+    return result
+
+
+def compare(result: ScanResult, old: Dict[bytes, bytes]) -> ScanResult:
+    """Fills in how 'result' differs from the manifest of the last backup.
+
+    Args:
+        result (ScanResult): The current scan.
+        old (Dict[bytes, bytes]): The manifest of the last backup, None if there is none.
+
+    Returns:
+        ScanResult: 'result'
+    """
+    if old is None:
+        return result
+    result.first_scan = False
+    for key, digest in result.manifest.items():
+        if old.get(key) != digest:
+            result.changed_dirs += 1
+            if len(result.examples) < EXAMPLES:
+                result.examples.append(result.paths[key])
+    result.removed_dirs = sum(1 for key in old if key not in result.manifest)
+    return result
+
+
+def manifest_path(**kwargs) -> str:
+    """Returns where the manifest of a stack is kept: <cache_dir>/manifests/<foldername>-<hash of borgserver:borgrepo>."""
+    repo = hashlib.blake2b(
+        f"{kwargs['borgserver']}:{kwargs['borgrepo']}".encode(), digest_size=4
+    ).hexdigest()
+    return os.path.join(kwargs["cache_dir"], "manifests", f"{kwargs['foldername']}-{repo}.manifest")
+
+
+def load(path: str) -> Dict[bytes, bytes]:
+    """Reads a manifest.
+
+    Returns:
+        Dict[bytes, bytes]: The manifest, None if it doesn't exist or is broken.
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    if not data.startswith(MAGIC) or (len(data) - len(MAGIC)) % RECORD.size:
+        logger.warning(f"Manifest {path} is broken, ignoring it")
+        return None
+    return dict(RECORD.iter_unpack(memoryview(data)[len(MAGIC) :]))
+
+
+def save(path: str, manifest: Dict[bytes, bytes]) -> None:
+    """Writes a manifest atomically, 24 bytes per folder."""
+    folder = os.path.dirname(path)
+    os.makedirs(folder, mode=0o700, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=folder, prefix=".tmp-")
+    with os.fdopen(fd, "wb") as f:
+        f.write(MAGIC)
+        f.write(b"".join(RECORD.pack(k, v) for k, v in sorted(manifest.items())))
+    os.replace(tmp, path)
+
+
+def detect(**kwargs) -> ScanResult:
+    """Scans 'rootfolder/foldername' and compares it with the manifest saved after the last successful backup.
+
+    Returns:
+        ScanResult: The scan, 'changed' tells whether a backup is needed.
+    """
+    root = f"{kwargs['rootfolder']}{kwargs['foldername']}"
+    settings = kwargs["change_detection"]
+    result = scan(root, settings.get("workers", 1))
+    compare(result, load(manifest_path(**kwargs)))
+    logger.info(result.summary())
+    return result
+
+
+if __name__ == "__main__":
+    pass
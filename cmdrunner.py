@@ -1,21 +1,75 @@
+import io
 import logging
+import re
+from collections import deque
 from subprocess import PIPE, STDOUT, Popen
+from typing import Callable, Iterable
 import shlex
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
+TAIL_LINES = 100
+PROGRESS_INTERVAL = 10
 
-def cmd_run(cmd: str, env: dict = None, **kwargs: dict):
+
+class LineMatcher:
+    """Line handler that remembers the first output line matching a regex.
+
+    Example:
+        lock = LineMatcher("Failed to create/acquire the lock")
+        cmd_run(cmd, handlers=[lock], debug=False)
+        if lock.matched: ...
+    """
+
+    def __init__(self, pattern: str):
+        self.regex = re.compile(pattern)
+        self.match = None
+
+    def __call__(self, line: str) -> None:
+        if self.match is None:
+            self.match = self.regex.search(line)
+
+    @property
+    def matched(self) -> bool:
+        return self.match is not None
+
+
+def cmd_run(
+    cmd: str,
+    env: dict = None,
+    cwd: str = None,
+    timeout: float = None,
+    handlers: Iterable[Callable[[str], None]] = (),
+    tail_lines: int = TAIL_LINES,
+    progress_interval: float = PROGRESS_INTERVAL,
+    is_progress: Callable[[str], bool] = None,
+    capture_stdout: bool = False,
+    **kwargs: dict,
+):
     """Runs a command using subprocess.Popen while writing stdout and stderr to the logger. Returns the result
 
+    The output is streamed: every line is passed to the handlers and only the last 'tail_lines' lines are kept, so memory
+    stays flat no matter how much the command prints. Progress updates (lines ending in a carriage return, f.ex. 'borg create --progress')
+    are logged at most once every 'progress_interval' seconds and aren't kept.
+
     Args:
         cmd (str): Command to run
         env (dict, optional): environment variables to add to Popen. Defaults to None.
+        cwd (str, optional): directory to run the command in. Defaults to None, the current directory.
+        timeout (float, optional): seconds after which the command is killed, 'timed_out' of the result is set then. Defaults to None, no timeout.
+        handlers (Iterable[Callable[[str], None]], optional): called with every output line, without line ending. Defaults to none.
+        tail_lines (int, optional): number of output lines kept in 'stdout' of the result. Defaults to 100.
+        progress_interval (float, optional): seconds between two logged progress updates. Defaults to 10.
+        is_progress (Callable[[str], bool], optional): returns True for lines that are progress updates although they end in a newline, f.ex. borg's JSON progress. Defaults to None.
+        capture_stdout (bool, optional): collect stdout completely instead of streaming it, f.ex. for JSON output. Only stderr is streamed then. Defaults to False.
 
     Returns:
-        _type_: _description_
+        Popen: The finished process, 'stdout' holds the last 'tail_lines' lines of output as a string, 'lines' the number of lines.
+        With capture_stdout 'stdout' holds the complete stdout and 'stderr' the tail of stderr.
     """
-    my_stdout = ""
+    tail = deque(maxlen=tail_lines)
     if kwargs["debug"] is True:
         logger.info(f"env= {env}")
         cmd = "echo " + cmd
@@ -26,19 +80,66 @@ def cmd_run(cmd: str, env: dict = None, **kwargs: dict):
     with Popen(
         shlex.split(cmd),
         stdout=PIPE,
-        stderr=STDOUT,
-        bufsize=1,
-        universal_newlines=True,
+        stderr=PIPE if capture_stdout else STDOUT,
         env=env,
-        text=True,
+        cwd=cwd,
     ) as p:
-        for line in p.stdout:
-            my_stdout = my_stdout + line
-            logger.info("subprocess: %s", line.rstrip("\r\n"))
+        p.timed_out = False
+        p.lines = 0
+        timer = None
+        if timeout:
+
+            def kill():
+                p.timed_out = True
+                logger.warning(f"Killing '{cmd}' after {timeout}s")
+                p.kill()
+
+            timer = threading.Timer(timeout, kill)
+            timer.daemon = True
+            timer.start()
+        captured = []
+        reader = None
+        if capture_stdout:
+            reader = threading.Thread(target=lambda: captured.append(p.stdout.read()))
+            reader.start()
+            stream = p.stderr
+        else:
+            stream = p.stdout
+        # newline="" splits on \r as well as \n but keeps the line ending, so progress updates can be told apart
+        output = io.TextIOWrapper(stream, encoding="utf-8", errors="replace", newline="")
+        last_progress = None
+        last_progress_logged = 0.0
+        try:
+            for line in output:
+                p.lines += 1
+                stripped = line.rstrip("\r\n")
+                for handler in handlers:
+                    handler(stripped)
+                if line.endswith("\r") or (is_progress and is_progress(stripped)):
+                    last_progress = stripped
+                    now = time.monotonic()
+                    if now - last_progress_logged >= progress_interval:
+                        logger.info("subprocess: %s", stripped)
+                        last_progress_logged = now
+                        last_progress = None
+                    continue
+                tail.append(stripped + "\n")
+                logger.info("subprocess: %s", stripped)
+            if last_progress:  # the final state of the progress display
+                logger.info("subprocess: %s", last_progress)
+        finally:
+            if reader:
+                reader.join()
+            if timer:
+                timer.cancel()
     logger.info(
         "----------------------------------------------------------------------------"
     )
-    p.stdout = my_stdout
+    if capture_stdout:
+        p.stdout = b"".join(captured).decode("utf-8", errors="replace")
+        p.stderr = "".join(tail)
+    else:
+        p.stdout = "".join(tail)
     return p
 
 
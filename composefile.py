@@ -0,0 +1,243 @@
+import logging
+import os
+import re
+from typing import Dict, List, Set, Tuple
+import yaml
+
+logger = logging.getLogger(__name__)
+
+# $$, ${VAR}, ${VAR:-default}, ${VAR-default}, ${VAR:?error}, ${VAR:+replacement}, ... and $VAR like docker compose interpolates them
+VARIABLE = re.compile(r"\$(?:(\$)|\{([A-Za-z_][A-Za-z0-9_]*)(?:(:?[-?+])([^}]*))?\}|([A-Za-z_][A-Za-z0-9_]*))")
+# a source that isn't a volume name is a host path, whatever it starts with
+VOLUME_NAME = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.-]*")
+
+
+class ComposeFileError(Exception):
+    pass
+
+
+def load(compose_file: str) -> dict:
+    """Reads a docker-compose file.
+
+    Args:
+        compose_file (str): The docker-compose.yaml
+
+    Raises:
+        ComposeFileError: Raised if the file has no services.
+
+    Returns:
+        dict: The parsed compose file.
+    """
+    with open(compose_file, "r") as f:
+        compose = yaml.safe_load(f)
+    if not isinstance(compose, dict) or not isinstance(compose.get("services"), dict):
+        raise ComposeFileError(f"No services found in {compose_file}")
+    return compose
+
+
+def project_env(compose_folder: str) -> Dict[str, str]:
+    """Returns the variables docker compose interpolates the compose file with: the project's .env, overridden by the environment.
+
+    Args:
+        compose_folder (str): The folder containing the compose file and the .env file.
+
+    Returns:
+        Dict[str, str]: The variables
+    """
+    env = {}
+    try:
+        with open(os.path.join(compose_folder, ".env"), "r") as f:
+            lines = f.readlines()
+    except OSError:
+        lines = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#") or "=" not in line:
+            continue
+        key, value = line.split("=", 1)
+        key = key.strip()
+        if key.startswith("export "):
+            key = key[len("export ") :].strip()
+        value = value.strip()
+        if len(value) >= 2 and value[0] == value[-1] and value[0] in "'\"":
+            value = value[1:-1]
+        env[key] = value
+    return {**env, **os.environ}
+
+
+def interpolate(value: str, env: Dict[str, str]) -> str:
+    """Replaces the variables in 'value' like docker compose does, unset variables become empty.
+
+    Args:
+        value (str): f.ex. "${DATA_DIR:-./data}/db:/var/lib/postgresql/data"
+        env (Dict[str, str]): The result of project_env()
+
+    Returns:
+        str: The interpolated value
+    """
+
+    def replace(match: re.Match) -> str:
+        if match.group(1):
+            return "$"
+        name = match.group(2) or match.group(5)
+        operator, word = match.group(3), match.group(4) or ""
+        is_set = name in env and (env[name] != "" or not (operator or "").startswith(":"))
+        if operator and operator.endswith("-"):
+            return env[name] if is_set else word
+        if operator and operator.endswith("+"):
+            return word if is_set else ""
+        return env.get(name, "")
+
+    return VARIABLE.sub(replace, value)
+
+
+def bind_mounts(service: dict, compose_folder: str, env: Dict[str, str] = None) -> List[Tuple[str, str, bool]]:
+    """Returns the bind mounts of a service, named volumes are skipped.
+
+    Args:
+        service (dict): The service definition
+        compose_folder (str): The folder containing the compose file, relative paths are relative to it.
+        env (Dict[str, str], optional): The variables to interpolate the sources with. Defaults to project_env(compose_folder).
+
+    Returns:
+        List[Tuple[str, str, bool]]: (absolute host path, path in the container, read-only)
+    """
+    env = project_env(compose_folder) if env is None else env
+    mounts = []
+    for volume in service.get("volumes", []) or []:
+        if isinstance(volume, str):
+            # interpolated first, a default like ${DATA:-./data} contains a colon
+            parts = interpolate(volume, env).split(":")
+            if len(parts) < 2:
+                continue  # anonymous volume
+            source, target = parts[0], parts[1]
+            read_only = len(parts) > 2 and "ro" in parts[2].split(",")
+        elif isinstance(volume, dict):
+            if volume.get("type", "volume") != "bind":
+                continue
+            source = interpolate(str(volume.get("source", "")), env)
+            target = volume.get("target", "")
+            read_only = bool(volume.get("read_only", False))
+        else:
+            continue
+        if not source or VOLUME_NAME.fullmatch(source):
+            continue  # named volume
+        source = os.path.expanduser(source)
+        mounts.append((os.path.normpath(os.path.join(compose_folder, source)), target, read_only))
+    return mounts
+
+
+def _bind_mounts(service: dict, compose_folder: str, env: Dict[str, str] = None) -> List[str]:
+    """Returns the host paths a service bind-mounts writable, read-only mounts and named volumes are skipped.
+
+    Args:
+        service (dict): The service definition
+        compose_folder (str): The folder containing the compose file, relative paths are relative to it.
+        env (Dict[str, str], optional): The variables to interpolate the sources with. Defaults to project_env(compose_folder).
+
+    Returns:
+        List[str]: Absolute host paths.
+    """
+    return [source for source, _, read_only in bind_mounts(service, compose_folder, env) if not read_only]
+
+
+def dependencies(compose: dict) -> Dict[str, Set[str]]:
+    """Returns the services every service depends on (depends_on, links, volumes_from and network_mode: service:...).
+
+    Args:
+        compose (dict): The parsed compose file.
+
+    Returns:
+        Dict[str, Set[str]]: service -> services it needs.
+    """
+    services = compose["services"]
+    deps = {}
+    for name, service in services.items():
+        service = service or {}
+        needs = set()
+        depends_on = service.get("depends_on", []) or []
+        needs.update(depends_on if isinstance(depends_on, (list, dict)) else [])
+        for link in service.get("links", []) or []:
+            needs.add(link.split(":")[0])
+        for source in service.get("volumes_from", []) or []:
+            source = source.split(":")[0]
+            if source.startswith("service:"):
+                source = source[len("service:") :]
+            if not source.startswith("container:"):
+                needs.add(source)
+        network_mode = service.get("network_mode", "")
+        if network_mode.startswith("service:"):
+            needs.add(network_mode[len("service:") :])
+        deps[name] = {n for n in needs if n in services}
+    return deps
+
+
+def start_order(deps: Dict[str, Set[str]], services: Set[str]) -> List[str]:
+    """Sorts services so every service comes after the services it depends on.
+
+    Args:
+        deps (Dict[str, Set[str]]): The result of dependencies()
+        services (Set[str]): The services to sort.
+
+    Raises:
+        ComposeFileError: Raised if the dependencies contain a cycle.
+
+    Returns:
+        List[str]: The services in start order, reverse it to get the stop order.
+    """
+    order = []
+    visiting = set()
+
+    def visit(name: str) -> None:
+        if name in order:
+            return
+        if name in visiting:
+            raise ComposeFileError(f"Dependency cycle at service {name}")
+        visiting.add(name)
+        for dep in sorted(deps.get(name, set()) & services):
+            visit(dep)
+        visiting.discard(name)
+        order.append(name)
+
+    for name in sorted(services):
+        visit(name)
+    return order
+
+
+def services_to_stop(compose_file: str, folder: str) -> List[str]:
+    """Finds the services that have to be stopped to back up 'folder' consistently.
+
+    These are the services that bind-mount 'folder', a path below it or a folder containing it writable, plus every service depending
+    on them.
+
+    Args:
+        compose_file (str): The docker-compose.yaml
+        folder (str): The folder that is backed up.
+
+    Returns:
+        List[str]: The services in start order, empty if no service writes to 'folder'.
+    """
+    compose = load(compose_file)
+    compose_folder = os.path.dirname(os.path.abspath(compose_file))
+    folder = os.path.normpath(folder)
+    env = project_env(compose_folder)
+    data = set()
+    for name, service in compose["services"].items():
+        for path in _bind_mounts(service or {}, compose_folder, env):
+            # a mount of an ancestor (f.ex. rootfolder or '..') writes into 'folder' as well
+            inside = path == folder or path.startswith(folder + os.sep)
+            if inside or folder.startswith(path.rstrip(os.sep) + os.sep):
+                logger.debug(f"service {name} keeps data in {path}")
+                data.add(name)
+    deps = dependencies(compose)
+    affected = set(data)
+    changed = True
+    while changed:
+        dependents = {n for n, needs in deps.items() if needs & affected}
+        changed = not dependents <= affected
+        affected |= dependents
+    return start_order(deps, affected)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,121 @@
+import logging
+import os
+import re
+import shlex
+from typing import List
+
+logger = logging.getLogger(__name__)
+
+TYPES = ["postgres", "mysql", "sqlite", "command"]
+# the variable each client reads the password from
+PASSWORD_VARIABLES = {"postgres": "PGPASSWORD", "mysql": "MYSQL_PWD"}
+NAME = re.compile(r"^[A-Za-z0-9._-]+$")
+ENV = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def from_config(value) -> List[dict]:
+    """Checks the 'dumps' part of the configuration.
+
+    Args:
+        value (list): f.ex. [{"name": "db", "type": "postgres", "service": "db", "user": "nextcloud", "database": "nextcloud"}]
+
+    Raises:
+        ValueError: Raised if a dump has no or a duplicate name, an unknown type, misses what its type needs, has a password_env its
+            type doesn't use or data outside the project folder.
+
+    Returns:
+        List[dict]: The dumps with defaults applied.
+    """
+    if not isinstance(value, list):
+        raise ValueError("dumps needs to be a list")
+    result = []
+    for dump in value:
+        dump = dict(dump)
+        name = str(dump.get("name", ""))
+        if not NAME.match(name):
+            raise ValueError(f"every dump needs a name of letters, digits, '.', '_' and '-', not '{name}'")
+        if dump.get("type") not in TYPES:
+            raise ValueError(f"type of dump {name} needs to be one of {', '.join(TYPES)}")
+        if dump["type"] == "sqlite" and "path" not in dump:
+            raise ValueError(f"dump {name} needs the path of the sqlite database")
+        if dump.get("password_env") and not ENV.match(str(dump["password_env"])):
+            raise ValueError(f"password_env of dump {name} needs to be the name of an environment variable")
+        if dump.get("password_env") and dump["type"] not in PASSWORD_VARIABLES:
+            raise ValueError(f"dump {name} of type {dump['type']} doesn't use password_env")
+        if dump.get("data"):
+            data = os.path.normpath(str(dump["data"]))
+            if os.path.isabs(data) or data == "." or data.startswith(".."):
+                raise ValueError(f"data of dump {name} needs to be a folder inside the project folder, relative to it")
+            dump["data"] = data
+        if dump["type"] == "command" and "command" not in dump:
+            raise ValueError(f"dump {name} needs a command")
+        if dump.get("service") and dump.get("container"):
+            raise ValueError(f"dump {name} can run in a service or in a container, not both")
+        if dump["type"] in ("postgres", "mysql") and not (dump.get("service") or dump.get("container")):
+            raise ValueError(f"dump {name} needs the service or container the database runs in")
+        dump.setdefault("user", "postgres" if dump["type"] == "postgres" else "root")
+        result.append(dump)
+    names = [d["name"] for d in result]
+    duplicates = sorted({n for n in names if names.count(n) > 1})
+    if duplicates:
+        raise ValueError(f"dump names need to be unique: {', '.join(duplicates)}")
+    return result
+
+
+def _dump_command(dump: dict) -> str:
+    """The command writing the dump to stdout, inside the container if there is one."""
+    user = shlex.quote(dump["user"])
+    database = shlex.quote(dump["database"]) if dump.get("database") else None
+    if dump["type"] == "postgres":
+        if database:
+            cmd = f"pg_dump --username={user} --clean --if-exists --create {database}"
+        else:
+            cmd = f"pg_dumpall --username={user} --clean --if-exists"
+    elif dump["type"] == "mysql":
+        cmd = f"mysqldump --user={user} --single-transaction --routines --events --triggers " + (
+            f"--databases {database}" if database else "--all-databases"
+        )
+    if dump["type"] in PASSWORD_VARIABLES:
+        if dump.get("password_env"):
+            # read in the container, the password never shows up in a command line
+            env = dump["password_env"]
+            return "sh -c " + shlex.quote(f'{PASSWORD_VARIABLES[dump["type"]]}="${env}" exec {cmd}')
+        return cmd
+    if dump["type"] == "sqlite":
+        # .dump is SQL text read in one transaction, .backup needs a file it can seek in
+        return f"sqlite3 -readonly {shlex.quote(dump['path'])} .dump"
+    return dump["command"]
+
+
+def command(dump: dict, **kwargs) -> str:
+    """Returns the command borg runs to read a dump (borg create --content-from-command).
+
+    postgres and mysql run in their compose service (docker-compose exec) or container (docker exec). A sqlite database without service
+    or container is read on this host, its path is relative to the project folder.
+
+    Args:
+        dump (dict): One entry of the result of from_config()
+
+    Returns:
+        str: The command
+    """
+    cmd = _dump_command(dump)
+    if dump.get("service"):
+        compose_file = kwargs.get("compose_file") or f"{kwargs['rootfolder']}{kwargs['foldername']}/docker-compose.yaml"
+        return f"docker-compose -f {shlex.quote(compose_file)} exec -T {shlex.quote(dump['service'])} {cmd}"
+    if dump.get("container"):
+        return f"docker exec -i {shlex.quote(dump['container'])} {cmd}"
+    if dump["type"] == "sqlite":
+        path = os.path.join(f"{kwargs['rootfolder']}{kwargs['foldername']}", dump["path"])
+        return f"sqlite3 -readonly {shlex.quote(path)} .dump"
+    return cmd
+
+
+def excluded(dumps: List[dict]) -> List[str]:
+    """Returns the folders holding the live database files, relative to the project folder. They are inconsistent while the database
+    runs, the dump replaces them in the backup."""
+    return [d["data"].strip("/") for d in dumps if d.get("data")]
+
+
+if __name__ == "__main__":
+    pass
@@ -1,26 +1,39 @@
-from modulefinder import Module
-from typing import Union
+from types import ModuleType
+from typing import List, Union
 import getpass
-import telegram
+import json
 import logging
 import traceback
 import os
+import sys
 import argparse
+import copy
+from functools import partial
+import signal
+import tempfile
 from importlib import import_module
-import yaml
 from cmdrunner import cmd_run
 import borg
-import pathlib
+import maintenance
+import metrics
+import notifications
+import orchestrator
+import preflight
+import sshmux
+import targets
+import time
+import units
+from runcontext import RunContext
+
+# telegram, yaml, prepost modules and the modules of optional features (borgcache, changes, composefile, dbdumps, patterns, profiler,
+# readiness, scheduler, slots, snapshot, staging, throttle)
+# are imported where they're needed, so '--help' and runs that don't use them start fast.
 
-
-telegram_bot = None
-configuration = None
-secrets = None
-dc_down = False
 logger = logging.getLogger(__name__)
 
-scriptfolder = pathlib.Path(__file__).parent.resolve()
-print(scriptfolder)
+scriptfolder = os.path.dirname(os.path.realpath(__file__))
+# the daemon answers on it with its status, see daemon() and show_status()
+STATUS_SOCKET = os.path.join(tempfile.gettempdir(), "dcborgbackup.sock")
 
 
 class PasswordNotSetCorrectlyError(Exception):
@@ -35,6 +48,10 @@ class HostNotPingable(Exception):
     pass
 
 
+class HostNotReachable(HostNotPingable):
+    pass
+
+
 class ConfigError(Exception):
     pass
 
@@ -47,88 +64,135 @@ class ComposeFileNotFoundError(FileNotFoundError):
     pass
 
 
-def docker_compose(up: bool = True) -> None:
+def docker_compose(ctx: RunContext, up: bool = True) -> None:
     """Calls docker-compose. Takes the stack down if up==False, otherwise it starts the stack.
 
+    If only some services keep data in the project folder (docker_compose_mode: selective) just these are stopped and started.
+
     Args:
+        ctx (RunContext): The current run.
         up (bool, optional): Controls whether 'docker-compose up -d' or 'docker-compose down' is called. Defaults to True.
 
     Raises:
         DockerComposeError: Raised if there was an error while running docker-compose
     """
-    if up:
-        cmd = "docker-compose up -d"
+    services = ctx.compose_services
+    if services is not None and not services:
+        logger.info("No service keeps data in the project folder, nothing to stop.")
+        return
+    if services is None:
+        cmd = "docker-compose up -d" if up else "docker-compose down"
+    elif up:
+        cmd = "docker-compose start " + " ".join(services)
     else:
-        cmd = "docker-compose down"
+        cmd = "docker-compose stop " + " ".join(reversed(services))
 
-    result = cmd_run(cmd, debug=configuration["debug"])
+    with ctx.metrics.phase("compose_up" if up else "compose_down"):
+        result = cmd_run(
+            cmd,
+            cwd=ctx.configuration["compose_folder"],
+            debug=ctx.configuration["debug"],
+        )
     if result.returncode != 0:
         raise DockerComposeError("Error running docker-compose")
-    dc_down = True
-
-
-def set_password() -> None:
-    """If the repo is encrypted according to the configuration it reads the password from the secrets-dict and saves it in the global configuration-dict.
-
-    Raises:
-        KeyError: Raised if the password for the repo isn't found in the secrets-dict.
-    """
-    global configuration
-    password = None
-    if configuration["repo_encrypted"] is True:
-        try:
-            password = secrets["repo_passwords"][configuration["foldername"]]
-        except KeyError:
-            raise PasswordNotSetCorrectlyError(
-                f"Password for repo not found. The key of the repo-password must be the same as foldername {configuration['foldername']}"
+    if up:
+        ctx.stack_started()
+        if ctx.configuration["readiness"] and not ctx.configuration["debug"]:
+            import readiness
+
+            # polls in the background, f.ex. while the archive is created from a snapshot, see _await_readiness(). A stack that
+            # doesn't come back is alerted about at the deadline, not when the upload finished.
+            ctx.readiness_watcher = readiness.Watcher(
+                ctx.configuration["readiness"],
+                ctx.configuration["compose_folder"],
+                services,
+                on_timeout=partial(_alert_down, ctx),
             )
-    configuration["password"] = password
+    else:
+        ctx.stack_stopped()
 
 
-def notify(msg: str) -> None:
-    """Wrapper function to call all notifcation providers.
+def _alert_down(ctx: RunContext, result) -> None:
+    """Alerts that the restarted stack didn't become healthy in time, called by the readiness watcher at its deadline.
 
     Args:
-        msg (str): The message to send.
+        ctx (RunContext): The current run.
+        result (readiness.Readiness): The outcome of the watcher.
     """
-    if "telegram" in secrets:
-        send_telegram(msg)
+    logger.error(result.summary())
+    notify(ctx, f"ALERT: {ctx.name} is down. {result.summary()}")
 
 
-def send_telegram(msg: str) -> None:
-    """Sends a telegram message
+def _await_readiness(ctx: RunContext) -> None:
+    """Waits until the restarted stack is healthy and records the true downtime. The alert for a stack that didn't come back in time
+    was already sent by the watcher, see _alert_down().
 
     Args:
-        msg (str): The message to send.
+        ctx (RunContext): The current run.
     """
-    for chatid in secrets["telegram"]["chatids"]:
-        telegram_bot.sendMessage(chat_id=chatid, text=msg)
+    watcher = ctx.readiness_watcher
+    if watcher is None:
+        return
+    ctx.readiness_watcher = None
+    with ctx.metrics.phase("readiness"):
+        result = watcher.wait()
+    ctx.readiness = result
+    ctx.stack_healthy(result.started + result.ready_after if result.ready else result.finished)
+    ctx.add_report(result.summary())
+    if result.ready:
+        logger.info(result.summary())
 
 
-def host_pingable(host: str) -> bool:
-    """Tests whether a host is pingable.
+def set_password(ctx: RunContext) -> None:
+    """If the repo is encrypted according to the configuration it reads the password from the secrets-dict and saves it in the configuration-dict of the run.
+
+    With several targets every target gets its password, the key '<foldername>/<target name>' in repo_passwords is preferred over foldername.
 
     Args:
-        host (str): the host to test
+        ctx (RunContext): The current run.
 
-    Returns:
-        bool: True if host is pingable, False otherwise.
+    Raises:
+        KeyError: Raised if the password for the repo isn't found in the secrets-dict.
     """
-    logger.info(f"pinging {host}")
-    cmd = f"ping -c 1 {host}"
-    result = cmd_run(cmd, debug=configuration["debug"])
-    if result.returncode == 0:
-        return True
-    else:
-        return False
+    configuration = ctx.configuration
+    for target in configuration["targets"] or [configuration]:
+        password = None
+        if target["repo_encrypted"] is True:
+            passwords = ctx.secrets.get("repo_passwords") or {}
+            key = f"{target['foldername']}/{target.get('name')}"
+            if key not in passwords:
+                key = target["foldername"]
+            try:
+                password = passwords[key]
+            except KeyError:
+                raise PasswordNotSetCorrectlyError(
+                    f"Password for repo not found. The key of the repo-password must be the same as foldername {target['foldername']}"
+                )
+        target["password"] = password
+
+
+def notify(ctx: RunContext, msg: str, attachments: list = ()) -> None:
+    """Queues a message for all notification providers, it's sent in the background.
+
+    Args:
+        ctx (RunContext): The current run.
+        msg (str): The message to send.
+        attachments (list, optional): (filename, content) pairs sent along, f.ex. a traceback. Defaults to none.
+    """
+    if ctx.notifier:
+        ctx.notifier.submit(notifications.Message(msg, list(attachments)))
 
 
-def load_prepost_module() -> Union[None, Module]:
+def load_prepost_module(ctx: RunContext) -> Union[None, ModuleType]:
     """Loads prepost-modules if exist. If a prepost-module is supplied in the configuration the imported module is returned.
 
+    Args:
+        ctx (RunContext): The current run.
+
     Returns:
         Union[str, bool]: None if no prepost-module defined, the module otherwise.
     """
+    configuration = ctx.configuration
     if not configuration["prepost"]:
         return
     else:
@@ -138,11 +202,12 @@ def load_prepost_module() -> Union[None, Module]:
         return imported
 
 
-def execute_pre_script(imported: Module) -> None:
+def execute_pre_script(ctx: RunContext, imported: ModuleType) -> None:
     """Executes the pre()-function of a prepost-module.
 
     Args:
-        imported (Module): The module containing the pre()-function.
+        ctx (RunContext): The current run.
+        imported (ModuleType): The module containing the pre()-function.
     """
     try:
         pre = getattr(imported, "pre")
@@ -150,14 +215,15 @@ def execute_pre_script(imported: Module) -> None:
         logger.info(f"No pre()-function found in {imported.__name__}")
     else:
         logger.info("Executing pre-script")
-        pre(**configuration)
+        pre(**ctx.configuration)
 
 
-def execute_post_script(imported: Module) -> None:
+def execute_post_script(ctx: RunContext, imported: ModuleType) -> None:
     """Executes the post()-function of a prepost-module.
 
     Args:
-        imported (Module): The module containing the pre()-function.
+        ctx (RunContext): The current run.
+        imported (ModuleType): The module containing the pre()-function.
     """
     try:
         post = getattr(imported, "post")
@@ -165,20 +231,21 @@ def execute_post_script(imported: Module) -> None:
         logger.info(f"No post()-function found in {imported.__name__}")
     else:
         logger.info("Executing post-script")
-        post(**configuration)
+        post(**ctx.configuration)
 
 
-def running_as_expected_user(expected_user: str) -> bool:
+def running_as_expected_user(expected_user: str, debug: bool = False) -> bool:
     """Tests whether this script is run as the expected user.
 
     Args:
         expected_user (str): The user this script should be run as, example: root
+        debug (bool, optional): In debug mode every user is accepted. Defaults to False.
 
     Returns:
         bool: True if the current user equals 'expected_user', False otherwise.
     """
     # expected user check
-    if configuration["debug"]:
+    if debug:
         return True
     user = getpass.getuser()
     if user != expected_user:
@@ -187,93 +254,645 @@ def running_as_expected_user(expected_user: str) -> bool:
         return True
 
 
-def pre_start_checks() -> None:
+PREFLIGHT_TIMEOUTS = {"local": 5, "reachability": 5, "ssh_login": 20, "repository": 300}
+
+
+def pre_start_checks(ctx: RunContext) -> None:
     """Runs all the checks necessary that have to pass before creating an archive.
 
+    The checks run at the same time, each with its own timeout, all failures are collected into one error. With several targets a
+    target whose checks fail is left out of the run, the others go ahead.
+
+    Args:
+        ctx (RunContext): The current run.
+
     Raises:
-        UnexpectedUser: Raised if this script is run as another user than expected.
-        HostNotPingable: Raised if borg-host isn't pingable.
-        borg.BorgNotInstalled: Raised if borg isn't installed locally.
+        preflight.PreflightError: Raised if at least one local check or every target failed, f.ex. UnexpectedUser, HostNotReachable or borg.BorgNotInstalled.
     """
-    if not running_as_expected_user(configuration["expected_user"]):
-        raise UnexpectedUser(
-            f"This script expects to be run as {configuration['expected_user']} to back up {configuration['foldername']}."
+    configuration = ctx.configuration
+    timeouts = {**PREFLIGHT_TIMEOUTS, **configuration["preflight_timeouts"]}
+    if configuration["retry"]["lock_wait"]:
+        # borg waits for the lock of the repo on top of the time the check takes
+        timeouts["repository"] += configuration["retry"]["lock_wait"]
+
+    def expected_user():
+        if not running_as_expected_user(
+            configuration["expected_user"], configuration["debug"]
+        ):
+            raise UnexpectedUser(
+                f"This script expects to be run as {configuration['expected_user']} to back up {configuration['foldername']}."
+            )
+
+    def reachable(target: targets.Target):
+        if configuration["debug"]:
+            return
+        if not preflight.tcp_reachable(
+            target.configuration["borgserver"],
+            target.configuration["ssh_port"],
+            timeouts["reachability"],
+        ):
+            raise HostNotReachable(
+                f"Host {target.configuration['borgserver']} not reachable on port {target.configuration['ssh_port']}!"
+            )
+
+    def repository(target: targets.Target):
+        target.result.repo_info = borg.repo_checks(
+            **target.configuration, timeout=timeouts["repository"]
+        )
+        if configuration["retry"]["checkpoints"] and not configuration["debug"]:
+            target.result.checkpoints = borg.checkpoints(**target.configuration, timeout=timeouts["repository"])
+
+    def borg_installed():
+        if not borg.borg_installed_locally():
+            raise borg.BorgNotInstalled("borg not installed locally")
+
+    checks = [
+        preflight.Check("expected user", expected_user, timeouts["local"]),
+        preflight.Check("borg installed", borg_installed, timeouts["local"]),
+    ]
+    if configuration["docker_compose"]:
+        checks.append(
+            preflight.Check(
+                "compose file", lambda: docker_compose_setup(ctx), timeouts["local"]
+            )
         )
+    owners = {}
+    for target in ctx.targets:
+        suffix = f" {target.name}" if len(ctx.targets) > 1 else ""
+        target_checks = [
+            preflight.Check("reachability" + suffix, partial(reachable, target), timeouts["reachability"]),
+            preflight.Check(
+                "ssh login" + suffix,
+                partial(borg.check_ssh_login, **target.configuration, timeout=timeouts["ssh_login"]),
+                timeouts["ssh_login"],
+            ),
+            preflight.Check("repository" + suffix, partial(repository, target), timeouts["repository"]),
+        ]
+        owners.update({c.name: target for c in target_checks})
+        checks.extend(target_checks)
+    try:
+        preflight.check(ctx.name, checks)
+    except preflight.PreflightError as e:
+        failed = {owners.get(r.name) for r in e.failures}
+        if None in failed or len(failed) == len(ctx.targets):
+            raise
+        for target in failed:
+            lines = [f"{r.name}: {r.error}" for r in e.failures if owners[r.name] is target]
+            target.fail("preflight", preflight.PreflightError("\n".join(lines), e.results))
+            logger.warning(f"Leaving out target {target.name}, its preflight checks failed")
+    ctx.repo_info = ctx.targets[0].result.repo_info
 
-    if not host_pingable(configuration["borgserver"]):
-        raise HostNotPingable(f"Host {configuration['borgserver']} not pingable!")
 
-    if not borg.borg_installed_locally():
-        raise borg.BorgNotInstalled("borg not installed locally")
-    borg.repo_checks(**configuration)
+def docker_compose_setup(ctx: RunContext) -> None:
+    """Checks whether the compose file exists. docker-compose is run inside the folder containing that file.
 
+    With docker_compose_mode: selective the compose file is parsed for the services to stop.
 
-def docker_compose_setup() -> None:
-    """Checks whether the compose file exists and chdir's to the folder containing that file.
+    Args:
+        ctx (RunContext): The current run.
 
     Raises:
-        ComposeFileNotFoundError: _description_
+        ComposeFileNotFoundError: Raised if the compose file doesn't exist.
     """
+    configuration = ctx.configuration
     if not os.path.isfile(configuration["compose_file"]):
         raise ComposeFileNotFoundError(
             f"compose file {configuration['compose_file']} does not exist!"
         )
-    os.chdir(f"{configuration['compose_folder']}")
-    logger.debug(f"Changed dir to {configuration['compose_folder']}")
+    if configuration["docker_compose_mode"] == "selective":
+        import composefile
 
+        ctx.compose_services = composefile.services_to_stop(
+            configuration["compose_file"], configuration["compose_folder"]
+        )
+        logger.info(
+            f"Services to stop and start: {', '.join(ctx.compose_services) or 'none'}"
+        )
 
-def _start() -> None:
-    """Orchestrates the necessary steps to create an archive."""
-    pre_start_checks()
-    if configuration["prepost"]:
-        imported = load_prepost_module()
-        execute_pre_script(imported)
-    if configuration["docker_compose"]:
-        docker_compose_setup()
-        docker_compose(up=False)
-    borg.create(**configuration)
-    if configuration["docker_compose"]:
-        docker_compose()
-    borg.prune(**configuration)
+
+def _start(ctx: RunContext) -> None:
+    """Orchestrates the necessary steps to create an archive.
+
+    With several targets the archives are created at the same time from one downtime window. A failed target doesn't stop the
+    others, the run fails at the end. Pruning and the other maintenance follow in run(), see _maintain().
+
+    Args:
+        ctx (RunContext): The current run.
+    """
+    configuration = ctx.configuration
+    ctx.started = time.monotonic()
+    scan = None
+    if configuration["change_detection"]:
+        import changes
+
+        with ctx.metrics.phase("scan"):
+            scan = changes.detect(**configuration)
+        if not scan.changed:
+            _skip(ctx, scan.summary())
+            return
+        ctx.add_report(scan.summary())
+    _setup_targets(ctx)
+    _setup_isolation(ctx)
+    _lease_borg_caches(ctx)
+    _open_ssh_master(ctx)
+    with ctx.metrics.phase("preflight"):
+        pre_start_checks(ctx)
+    _drop_stale_borg_caches(ctx)
+    _build_patterns(ctx)
     if configuration["prepost"]:
-        execute_post_script(imported)
-    notify(f"borg-backup of {configuration['foldername']} finished successfully.")
+        imported = load_prepost_module(ctx)
+        with ctx.metrics.phase("pre"):
+            execute_pre_script(ctx, imported)
+    # with database dumps the stack keeps running, the dumps are consistent on their own
+    if configuration["docker_compose"] and not configuration["dumps"]:
+        _reserve_slots(ctx)
+        docker_compose(ctx, up=False)
+    if configuration["snapshot"]:
+        import snapshot
+
+        with snapshot.taken(snapshot.from_config(**configuration)) as source:
+            _create_from_copy(ctx, source)
+    elif configuration["staging"]:
+        import staging
+
+        with ctx.metrics.phase("staging"):
+            stats = staging.sync(**configuration)
+        ctx.add_report(stats.summary())
+        _create_from_copy(ctx, staging.staging_folder(**configuration))
+    else:
+        _create(ctx)
+    ctx.release_slots()
+    if configuration["docker_compose"] and ctx.dc_down:
+        docker_compose(ctx)
+    succeeded = [t for t in ctx.targets if not t.failed]
+    if succeeded:
+        ctx.archive = succeeded[0].result.archive
+    if configuration["prepost"] and succeeded:
+        with ctx.metrics.phase("post"):
+            execute_post_script(ctx, imported)
+    # after the post script, it may be what makes the stack healthy again (f.ex. leaving a maintenance mode)
+    _await_readiness(ctx)
+    _clean_checkpoints(ctx)
+    for target, use in _borg_cache_uses(ctx):
+        _report(ctx, target, use.summary())
+    if ctx.owns_ssh_masters:
+        for line in ctx.ssh_masters.summaries():
+            ctx.add_report(line)
+    targets.finish(ctx.targets)
+    message = f"borg-backup of {configuration['foldername']} finished successfully. {_timing_summary(ctx)}"
+    with ctx.metrics.phase("notify"):
+        notify(ctx, "\n".join([message] + ctx.report_lines))
+    # saved only now, a failed run must not hide the changes from the next one
+    if scan and not configuration["debug"]:
+        changes.save(changes.manifest_path(**configuration), scan.manifest)
+    # the run ends after the maintenance, see run()
+    ctx.metrics.set_outcome("success")
+
+
+def _skip(ctx: RunContext, reason: str) -> None:
+    """Ends a run without backing anything up, the stack stays up.
+
+    Args:
+        ctx (RunContext): The current run.
+        reason (str): Why the run was skipped.
+    """
+    message = f"borg-backup of {ctx.name} skipped. {reason}"
+    logger.info(message)
+    with ctx.metrics.phase("notify"):
+        notify(ctx, message)
+    ctx.metrics.set_outcome("skipped")
+
+
+def _setup_targets(ctx: RunContext) -> None:
+    """Creates the targets of the run, the configuration itself is the only target if the config has no 'targets'.
+
+    Args:
+        ctx (RunContext): The current run.
+    """
+    configuration = ctx.configuration
+    if configuration["targets"]:
+        ctx.targets = [targets.Target(c, c["name"]) for c in configuration["targets"]]
+    else:
+        ctx.targets = [targets.Target(configuration, configuration["borgserver"])]
+
+
+def _setup_isolation(ctx: RunContext) -> None:
+    """Runs borg (create, prune, compact, check) and the commands prepost scripts run with prepost.helpers.run() under the nice/ionice
+    classes or in the cgroup set in 'isolation'.
+
+    Args:
+        ctx (RunContext): The current run.
+    """
+    configuration = ctx.configuration
+    if not configuration["isolation"]:
+        return
+    import throttle
+
+    ctx.isolation = throttle.isolation(configuration["isolation"])
+    for c in [configuration] + [t.configuration for t in ctx.targets]:
+        c["isolation_prefix"] = ctx.isolation.prefix
+    if ctx.isolation.applied:
+        ctx.add_report(ctx.isolation.summary())
+
+
+def _lease_borg_caches(ctx: RunContext) -> None:
+    """Gives every target its own borg cache (BORG_CACHE_DIR) if 'borg_cache' is set, and times the resyncs of its chunks cache.
+
+    Args:
+        ctx (RunContext): The current run.
+    """
+    settings = ctx.configuration["borg_cache"]
+    if not settings:
+        return
+    import borgcache
+
+    for target in ctx.targets:
+        server, repo = target.configuration["borgserver"], target.configuration["borgrepo"]
+        path = borgcache.cache_path(settings["path"], server, repo)
+        ctx.borg_cache_leases.append((target, borgcache.Lease(path, server, repo)))
+        target.configuration["borg_cache_dir"] = path
+        target.configuration["cache_sync"] = borgcache.SyncLog()
+
+
+def _drop_stale_borg_caches(ctx: RunContext) -> None:
+    """Removes the caches of repository IDs a target's repo doesn't have anymore, once preflight told the current one."""
+    for target, lease in ctx.borg_cache_leases:
+        if target.result.repo_info and target.result.repo_info.repository_id:
+            lease.drop_stale(target.result.repo_info.repository_id)
+
+
+def _borg_cache_uses(ctx: RunContext) -> list:
+    """Returns (target, CacheUse) with the current size and the resyncs so far of every leased cache."""
+    import borgcache
+
+    return [
+        (
+            target,
+            borgcache.CacheUse(
+                target.name,
+                lease.path,
+                borgcache.folder_size(lease.path),
+                list(target.configuration["cache_sync"].syncs),
+            ),
+        )
+        for target, lease in ctx.borg_cache_leases
+    ]
+
+
+def _release_borg_caches(ctx: RunContext) -> None:
+    """Records the caches' use for the metrics, removes unused and surplus caches and releases the caches of the run."""
+    if not ctx.borg_cache_leases:
+        return
+    import borgcache
+
+    settings = ctx.configuration["borg_cache"]
+    ctx.borg_cache = [use for _, use in _borg_cache_uses(ctx)]
+    try:
+        borgcache.cleanup(settings["path"], settings["max_size"], settings["remove_after"])
+    except OSError as e:
+        logger.error(f"Couldn't clean up the borg caches in {settings['path']}: {e}")
+    for _, lease in ctx.borg_cache_leases:
+        lease.release()
+    ctx.borg_cache_leases = []
+
+
+def _pattern_rules(configuration: dict) -> list:
+    """Returns the include/exclude rules of a stack: the ones of 'patterns' and the live database files of the dumps."""
+    import patterns
+
+    rules = patterns.build(**configuration) if configuration["patterns"] else []
+    if configuration["dumps"]:
+        import dbdumps
+
+        rules += [patterns.Rule(p, "-", "dump") for p in dbdumps.excluded(configuration["dumps"])]
+    return rules
+
+
+def _build_patterns(ctx: RunContext) -> None:
+    """Builds the include/exclude rules of the stack if 'patterns' or dumps are set, before the stack is stopped.
+
+    Args:
+        ctx (RunContext): The current run.
+    """
+    configuration = ctx.configuration
+    if not configuration["patterns"] and not configuration["dumps"]:
+        return
+    ctx.pattern_rules = _pattern_rules(configuration)
+    library = sum(1 for r in ctx.pattern_rules if r.source.startswith("library"))
+    ctx.add_report(f"Patterns: {len(ctx.pattern_rules)} rules, {library} from the cache path library.")
+
+
+def _reserve_slots(ctx: RunContext) -> None:
+    """Takes the upload slots shared with other hosts ('coordination') before the stack is stopped, if the archives are created while
+    it's down, so waiting for the turn doesn't add to the downtime. They're taken in the order of server and repo, two hosts can't each
+    hold a slot the other one waits for. A target that doesn't get its slot in time fails, the run fails before the stack is stopped if
+    none got one.
+
+    Args:
+        ctx (RunContext): The current run.
+    """
+    configuration = ctx.configuration
+    if not configuration["coordination"] or configuration["snapshot"] or configuration["staging"]:
+        return
+    with ctx.metrics.phase("queue"):
+        for target in sorted(ctx.targets, key=lambda t: (t.configuration["borgserver"], t.configuration["borgrepo"])):
+            if target.failed:
+                continue
+            try:
+                ctx.reserve_slot(target.configuration)
+            except Exception as e:
+                logger.error(f"No upload slot for {target.name}: {type(e).__name__}: {e}")
+                target.fail("queue", e)
+    if all(t.failed for t in ctx.targets):
+        targets.finish(ctx.targets)
+
+
+def _report(ctx: RunContext, target: targets.Target, line: str) -> None:
+    """Adds a line about a target to the report, prefixed with the target's name if there are several."""
+    ctx.add_report(f"{target.name}: {line}" if len(ctx.targets) > 1 else line)
+
+
+def _create(ctx: RunContext) -> None:
+    """Creates the archive on every target at the same time.
+
+    A failed target is only tried again while the stack is up, retries must not extend the downtime. With a snapshot or staging copy
+    the stack is up already, see _create_from_copy(). A create interrupted by an error leaves a checkpoint archive, the retry finds its
+    chunks in the repo and only uploads the rest.
+
+    Args:
+        ctx (RunContext): The current run.
+    """
+
+    isolation = ctx.configuration["isolation"]
+
+    def create(target: targets.Target) -> None:
+        limit = None
+        with ctx.borg_slot(target.configuration):
+            if isolation:
+                import throttle
+
+                # picked when borg starts, the time of day or the load may have changed since the last attempt
+                limit = throttle.upload_ratelimit(isolation)
+                target.configuration["upload_ratelimit"] = target.result.upload_ratelimit = limit.rate
+            _dump(ctx, target)
+            if target.result.checkpoints and target.result.attempts["create"] == 1:
+                _report(ctx, target, f"Resuming from checkpoint {target.result.checkpoints[-1]}.")
+            target.result.archive = borg.create(**target.configuration)
+        archive = target.result.archive
+        _report(ctx, target, archive.summary())
+        if limit is not None:
+            _report(
+                ctx,
+                target,
+                f"Throughput: read {throttle.throughput(archive.original_size, archive.duration)}, "
+                f"uploaded {throttle.throughput(archive.deduplicated_size, archive.duration)} with {limit.summary()}.",
+            )
+
+    patterns_file = None
+    if ctx.pattern_rules:
+        import patterns
+
+        # written for the folder borg actually reads, that is the snapshot or staging copy if there is one
+        patterns_file = patterns.write(
+            ctx.pattern_rules, borg._get_source(**ctx.targets[0].configuration), ctx.configuration["cache_dir"]
+        )
+        for target in ctx.targets:
+            target.configuration["patterns_file"] = patterns_file
+    try:
+        with ctx.metrics.phase("create"):
+            targets.fan_out(ctx.targets, "create", create, may_retry=lambda: not ctx.dc_down)
+    finally:
+        if patterns_file:
+            os.remove(patterns_file)
+
+
+def _dump(ctx: RunContext, target: targets.Target) -> None:
+    """Streams the database dumps of the stack into their own archives on a target, before the files are backed up.
+
+    borg reads every dump from the stdout of the dump command, nothing is written to local disk. borg locks the repo while it creates an
+    archive, so the dumps of a target run one after the other, the targets at the same time. Dumps that are done aren't repeated when
+    the target is tried again.
+
+    Args:
+        ctx (RunContext): The current run.
+        target (targets.Target): The target
+    """
+    dumps = ctx.configuration["dumps"]
+    if not dumps:
+        return
+    import dbdumps
+
+    for dump in dumps:
+        if dump["name"] in target.result.dumps:
+            continue
+        archive = borg.create_from_command(
+            dump["name"], dbdumps.command(dump, **target.configuration), **target.configuration
+        )
+        target.result.dumps[dump["name"]] = archive
+        _report(ctx, target, f"Dump {dump['name']}: {archive.summary()}")
+
+
+def _clean_checkpoints(ctx: RunContext) -> None:
+    """Deletes the checkpoint archives the new archives superseded, on every target that succeeded and had checkpoints before the run or
+    needed more than one attempt. Failures are only reported, prune removes superseded checkpoints as well.
+
+    Args:
+        ctx (RunContext): The current run.
+    """
+    if not ctx.configuration["retry"]["checkpoints"] or ctx.configuration["debug"]:
+        return
+    due = [
+        t
+        for t in ctx.targets
+        if not t.failed and (t.result.checkpoints or t.result.attempts.get("create", 1) > 1)
+    ]
+    if not due:
+        return
+
+    def work(target: targets.Target) -> None:
+        try:
+            with ctx.borg_slot(target.configuration):
+                names = borg.checkpoints(**target.configuration)
+                if names:
+                    borg.delete(names, **target.configuration)
+        except Exception as e:
+            logger.warning(f"Couldn't delete the checkpoints on {target.name}: {type(e).__name__}: {e}")
+            _report(ctx, target, f"Checkpoints not deleted: {type(e).__name__}: {e}")
+            return
+        target.result.checkpoints_deleted = names
+        if names:
+            _report(ctx, target, f"Deleted {len(names)} superseded checkpoints.")
+
+    with ctx.metrics.phase("checkpoints"):
+        targets.fan_out(due, "checkpoints", work)
+
+
+def _maintain(ctx: RunContext) -> None:
+    """Runs the maintenance tasks (prune, compact, check) that are due according to the 'maintenance' policy.
+
+    Only targets an archive was created on are maintained, after the stack is up again and after the backup was reported. Every task
+    holds the borg slot of its repo, so it never overlaps a create. Failed tasks are reported but don't fail the backup.
+
+    Args:
+        ctx (RunContext): The current run.
+    """
+    configuration = ctx.configuration
+    policy = configuration["maintenance"]
+    created = [t for t in ctx.targets if t.result.archive is not None]
+    lines = []
+    for task in maintenance.TASKS:
+        due = [
+            t
+            for t in created
+            if maintenance.due(
+                policy,
+                maintenance.last_runs(
+                    configuration["cache_dir"], f"{t.configuration['borgserver']}:{t.configuration['borgrepo']}"
+                ),
+                task,
+            )
+        ]
+        if not due:
+            continue
+
+        def work(target: targets.Target) -> None:
+            with ctx.borg_slot(target.configuration):
+                result = maintenance.run_task(task, target.name, **target.configuration)
+            ctx.maintenance.append(result)
+            if result.prune:
+                target.result.prune = result.prune
+            lines.append(f"{target.name}: {result.summary()}" if len(ctx.targets) > 1 else result.summary())
+
+        with ctx.metrics.phase(task):
+            targets.fan_out(due, task, work)
+    if not lines:
+        return
+    ctx.prune_result = next((t.result.prune for t in created if t.result.prune), None)
+    failed = [r for r in ctx.maintenance if not r.ok]
+    title = f"Maintenance of {configuration['foldername']}"
+    message = f"WARNING: {title} failed." if failed else f"{title} finished."
+    with ctx.metrics.phase("notify"):
+        notify(ctx, "\n".join([message] + lines))
+
+
+def _open_ssh_master(ctx: RunContext) -> None:
+    """Opens the ssh master connections of the run, one per target server, or reuses the ones of the pool the run shares with other runs.
+
+    Args:
+        ctx (RunContext): The current run.
+    """
+    configuration = ctx.configuration
+    if not configuration["ssh_multiplexing"]:
+        return
+    if ctx.ssh_masters is None:
+        ctx.ssh_masters = sshmux.MasterPool()
+        ctx.owns_ssh_masters = True
+    for target in ctx.targets:
+        target.configuration["ssh_master"] = ctx.ssh_masters.get(
+            configuration["borguser"],
+            target.configuration["borgserver"],
+            target.configuration["ssh_port"],
+            configuration["debug"],
+        )
 
 
-def read_secrets(secretsfile: str) -> None:
-    """Reads secrets.yaml
+def _create_from_copy(ctx: RunContext, source: str) -> None:
+    """Restarts the stack and creates the archives from a copy (snapshot or staging copy) of the project folder.
 
     Args:
+        ctx (RunContext): The current run.
+        source (str): The folder holding the copy.
+    """
+    for target in ctx.targets:
+        target.configuration["backup_source"] = source
+    if ctx.configuration["docker_compose"] and ctx.dc_down:
+        docker_compose(ctx)
+    _create(ctx)
+
+
+def _timing_summary(ctx: RunContext) -> str:
+    """Returns the downtime window and the total duration of a run for reports.
+
+    Args:
+        ctx (RunContext): The current run.
+
+    Returns:
+        str: f.ex. 'Downtime: 12s, total: 3605s.'
+    """
+    return f"Downtime: {ctx.downtime():.0f}s, total: {ctx.duration():.0f}s."
+
+
+def _load_yaml(file: str) -> dict:
+    """Reads a yaml file.
+
+    Args:
+        file (str): The file
+
+    Returns:
+        dict: The parsed content
+    """
+    import yaml
+
+    with open(file, "r") as f:
+        return yaml.safe_load(f)
+
+
+def read_secrets(ctx: RunContext, secretsfile: str) -> None:
+    """Reads secrets.yaml and sets up the notification providers (telegram, email, webhook, file) configured in it.
+
+    Args:
+        ctx (RunContext): The current run.
         secretsfile (str): secrets.yaml
 
     Raises:
-        KeyError: Raised if a mandatory key doesn't exist.
+        KeyError: Raised if a mandatory key doesn't exist or a notification provider is requested but not all its parameters exist in the secrets.
+        ValueError: Raised if telegram parameters are of the wrong type.
     """
-    with open(secretsfile, "r") as f:
-        s = yaml.safe_load(f)
+    s = _load_yaml(secretsfile)
     mandatory = ["borguser"]
     for key in mandatory:
         if key not in s:
             raise KeyError(
                 f"Mandatory key {key} not found in secrets file {secretsfile}"
             )
-    global secrets
-    secrets = s
-
-
-def read_config(configfile: str) -> None:
+    if "telegram" in s:
+        if "bot_token" not in s["telegram"] or "chatids" not in s["telegram"]:
+            raise KeyError(
+                "config_parser: bot_token and chatids are mandatory keys in secrets.yaml when using telegram"
+            )
+        elif not isinstance(s["telegram"]["bot_token"], str) or not isinstance(
+            s["telegram"]["chatids"], list
+        ):
+            raise ValueError(
+                "config parser: bot_token needs to be a string and chatids needs to be a list"
+            )
+    provider_keys = {
+        "email": ["host", "sender", "recipients"],
+        "webhook": ["url"],
+        "file": ["path"],
+    }
+    for provider, keys in provider_keys.items():
+        for key in keys:
+            if provider in s and key not in s[provider]:
+                raise KeyError(
+                    f"config_parser: {key} is a mandatory key in secrets.yaml when using {provider}"
+                )
+    ctx.notifier = notifications.from_secrets(s)
+    ctx.secrets = s
+
+
+def read_config(ctx: RunContext, configfile: str) -> None:
     """Parses the config file
 
     Args:
+        ctx (RunContext): The current run, its secrets have to be read already.
         configfile (str): The config file
 
     Raises:
-        KeyError: Raised if a mandatory config item doesn't exist or telegram is requested but not all parameters exist in the config.
+        KeyError: Raised if a mandatory config item doesn't exist.
         ConfigError: Raised if the rootfolder doesn't end in /
-        ValueError: Raised if telegram parameters are of the wrong type.
     """
-    with open(configfile, "r") as f:
-        config = yaml.safe_load(f)
+    config = _load_yaml(configfile)
     mandatory = [
         "foldername",
         "borgserver",
@@ -281,6 +900,8 @@ def read_config(configfile: str) -> None:
         "expected_user",
         "repo_encrypted",
     ]
+    if "targets" in config:
+        mandatory.remove("borgserver")
     for key in mandatory:
         if key not in config:
             raise KeyError(f"Mandatory key {key} not found in config file {configfile}")
@@ -297,16 +918,123 @@ def read_config(configfile: str) -> None:
         config["telegram"] = False
     if "docker_compose" not in config:
         config["docker_compose"] = True
+    if "docker_compose_mode" not in config:
+        config["docker_compose_mode"] = "full"
+    if config["docker_compose_mode"] not in ["full", "selective"]:
+        raise ConfigError("docker_compose_mode needs to be 'full' or 'selective'")
     if "prepost" not in config:
         config["prepost"] = False
+    if "ssh_multiplexing" not in config:
+        config["ssh_multiplexing"] = True
+    if "ssh_port" not in config:
+        config["ssh_port"] = 22
+    if "preflight_timeouts" not in config:
+        config["preflight_timeouts"] = {}
+    if "snapshot" not in config:
+        config["snapshot"] = False
+    if "staging" not in config:
+        config["staging"] = False
+    if "metrics" not in config:
+        config["metrics"] = False
+    if "cache_dir" not in config:
+        config["cache_dir"] = os.path.expanduser("~/.cache/dcborgbackup")
+    if "repo_check_ttl" not in config:
+        config["repo_check_ttl"] = 7 * 24 * 3600
+    if "borg_cache" not in config:
+        config["borg_cache"] = False
+    if config["borg_cache"]:
+        import borgcache
+
+        try:
+            config["borg_cache"] = borgcache.settings(config["borg_cache"] if isinstance(config["borg_cache"], dict) else {})
+        except ValueError as e:
+            raise ConfigError(f"borg_cache: {e}")
+        if not config["borg_cache"]["path"]:
+            config["borg_cache"]["path"] = os.path.join(config["cache_dir"], "borg")
+    if "isolation" not in config:
+        config["isolation"] = False
+    if config["isolation"]:
+        import throttle
+
+        try:
+            config["isolation"] = throttle.settings(config["isolation"])
+        except ValueError as e:
+            raise ConfigError(f"isolation: {e}")
+    if "readiness" not in config:
+        config["readiness"] = False
+    if config["readiness"]:
+        import readiness
+
+        try:
+            config["readiness"] = readiness.settings(config["readiness"])
+        except ValueError as e:
+            raise ConfigError(f"readiness: {e}")
+    if "coordination" not in config:
+        config["coordination"] = False
+    if config["coordination"]:
+        import slots
+
+        try:
+            config["coordination"] = slots.settings(config["coordination"])
+        except ValueError as e:
+            raise ConfigError(f"coordination: {e}")
+    if "dumps" not in config:
+        config["dumps"] = []
+    if config["dumps"]:
+        import dbdumps
+
+        try:
+            config["dumps"] = dbdumps.from_config(config["dumps"])
+        except ValueError as e:
+            raise ConfigError(f"dumps: {e}")
+    if "patterns" not in config:
+        config["patterns"] = False
+    if config["patterns"]:
+        import patterns
+
+        try:
+            config["patterns"] = patterns.settings(config["patterns"])
+        except ValueError as e:
+            raise ConfigError(f"patterns: {e}")
+    if "change_detection" not in config:
+        config["change_detection"] = False
+    if config["change_detection"] is True:
+        config["change_detection"] = {"workers": 1}
+    if "schedule" not in config:
+        config["schedule"] = None
+    if config["schedule"]:
+        import scheduler
+
+        try:
+            scheduler.CronExpression(config["schedule"])
+        except ValueError as e:
+            raise ConfigError(f"schedule needs to be a cron expression: {e}")
+    if config["snapshot"]:
+        import snapshot
+
+        if config["snapshot"].get("type") not in snapshot.BACKENDS:
+            raise ConfigError(
+                f"snapshot type needs to be one of {', '.join(snapshot.BACKENDS)}"
+            )
+    if config["staging"]:
+        import staging
+
+        if config["snapshot"]:
+            raise ConfigError("snapshot and staging can't be used together")
+        if "path" not in config["staging"]:
+            raise KeyError(f"Mandatory key staging.path not found in config file {configfile}")
+        if config["staging"].get("method", "builtin") not in staging.METHODS:
+            raise ConfigError(
+                f"staging method needs to be one of {', '.join(staging.METHODS)}"
+            )
 
     if "borg_parameters" not in config:
         params = {
-            "prune:": "-v --list --keep-within=1d --keep-daily=7 --keep-weekly=4 --keep-monthly=12",
+            "prune": "-v --list --keep-within=1d --keep-daily=7 --keep-weekly=4 --keep-monthly=12",
             "create": "",
             "info": "",
         }
-        config["borg_parameters"]: params
+        config["borg_parameters"] = params
     else:
         if "create" not in config["borg_parameters"]:
             config["borg_parameters"]["create"] = ""
@@ -314,98 +1042,496 @@ def read_config(configfile: str) -> None:
             config["borg_parameters"]["info"] = ""
         if "prune" not in config["borg_parameters"]:
             config["borg_parameters"]["prune"] = ""
+    if "list" not in config["borg_parameters"]:
+        config["borg_parameters"]["list"] = ""
+    if "compact" not in config["borg_parameters"]:
+        config["borg_parameters"]["compact"] = ""
+    if "check" not in config["borg_parameters"]:
+        config["borg_parameters"]["check"] = "--repository-only"
+    try:
+        config["maintenance"] = maintenance.policy(config.get("maintenance"))
+    except ValueError as e:
+        raise ConfigError(e)
 
     if config["docker_compose"]:
         config["compose_folder"] = f"{config['rootfolder']}{config['foldername']}"
         config["compose_file"] = f"{config['compose_folder']}/docker-compose.yaml"
 
-    if "telegram" in secrets:
-        if (
-            "bot_token" not in secrets["telegram"]
-            or "chatids" not in secrets["telegram"]
-        ):
-            raise KeyError(
-                "config_parser: bot_token and chatids are mandatory keys in secrets.yaml when using telegram"
-            )
-        elif not isinstance(secrets["telegram"]["bot_token"], str) or not isinstance(
-            secrets["telegram"]["chatids"], list
-        ):
-            raise ValueError(
-                "config parser: bot_token needs to be a string and chatids needs to be a list"
-            )
-        global telegram_bot
-        telegram_bot = telegram.Bot(token=secrets["telegram"]["bot_token"])
+    config["borguser"] = ctx.secrets["borguser"]
+    if "retries" not in config:
+        config["retries"] = 0
+    try:
+        config["retry"] = targets.retry_settings(config.get("retry"))
+    except ValueError as e:
+        raise ConfigError(f"retry: {e}")
+    if "targets" not in config:
+        config["targets"] = None
+    if config["targets"] is not None:
+        try:
+            config["targets"] = targets.from_config(config)
+        except ValueError as e:
+            raise ConfigError(e)
+        # the first target stands in for the stack where a single repo is needed, f.ex. to name the change detection manifest
+        config.setdefault("borgserver", config["targets"][0]["borgserver"])
+    ctx.configuration = config
 
-    config["borguser"] = secrets["borguser"]
-    global configuration
-    configuration = config
 
+def logger_setup(debug: bool, multiple: bool = False) -> None:
+    """Logging setup.
 
-def logger_setup() -> None:
-    """Logging setup."""
+    Args:
+        debug (bool): Log on level DEBUG instead of INFO.
+        multiple (bool, optional): Several stacks are backed up at once, prefix every line with the stack's name. Defaults to False.
+    """
     format = "%(asctime)s-%(levelname)s: %(message)s"
+    if multiple:
+        format = "%(asctime)s-%(levelname)s-%(threadName)s: %(message)s"
     datefmt = "%d-%b-%y_%H:%M:%S"
-    if configuration["debug"]:
+    if debug:
         level = logging.DEBUG
     else:
         level = logging.INFO
     logging.basicConfig(format=format, datefmt=datefmt, level=level)
 
 
-def start(configfile: str, secretsfile: str) -> None:
-    """Runs initial checks and starts parsing the config and secrets files.
+def load(ctx: RunContext) -> None:
+    """Reads the config and secrets files of a run and checks that everything they reference exists.
 
     Args:
-        configfile (str): The file containing the configuration
-        secretsfile (str): The file containing the secrets
+        ctx (RunContext): The run to load.
 
     Raises:
         FileNotFoundError: Raised if configfile not found.
         FileNotFoundError: Raised if secrets file not found
         FileNotFoundError: Raised if prepost requested but no prepost file found.
+    """
+    if not os.path.isfile(ctx.configfile):
+        raise FileNotFoundError(f"Configuration yaml {ctx.configfile} not found.")
+    if not os.path.isfile(ctx.secretsfile):
+        raise FileNotFoundError(f"Secrets yaml {ctx.secretsfile} not found.")
+    if ctx.secrets is None:
+        read_secrets(ctx, ctx.secretsfile)
+    read_config(ctx, ctx.configfile)
+    configuration = ctx.configuration
+    if configuration["prepost"]:
+        if configuration["prepost"].endswith(".py"):
+            configuration["prepost"] = configuration["prepost"][0:-3]
+        file = os.path.join(scriptfolder, "prepost", f"{configuration['prepost']}.py")
+        if not os.path.isfile(file):
+            raise FileNotFoundError(f"Prepostfile {file} not found.")
+    set_password(ctx)
+
+
+TRACEBACK_LINES = 10
+
+
+def run(ctx: RunContext, multiple: bool = False) -> None:
+    """Loads and runs a single backup, notifies the user and restarts the stack if anything goes wrong.
+
+    Args:
+        ctx (RunContext): The run, it isn't loaded again if its configuration is set already.
+        multiple (bool, optional): Several stacks are backed up at once. Defaults to False.
+
+    Raises:
         e: Catch-all to notify user via requested methods.
     """
+    error = None
     try:
-        if not os.path.isfile(configfile):
-            raise FileNotFoundError(f"Configuration yaml {configfile} not found.")
-        if not os.path.isfile(secretsfile):
-            raise FileNotFoundError(f"Secrets yaml {secretsfile} not found.")
-        read_secrets(secretsfile)
-        read_config(configfile)
-        if configuration["prepost"]:
-            if configuration["prepost"].endswith(".py"):
-                configuration["prepost"] = configuration["prepost"][0:-3]
-            file = os.path.join(
-                scriptfolder, "prepost", f"{configuration['prepost']}.py"
-            )
-            if not os.path.isfile(file):
-                raise FileNotFoundError(f"Prepostfile {file} not found.")
-        set_password()
-        logger_setup()
-        _start()
+        if ctx.configuration is None:
+            load(ctx)
+        logger_setup(ctx.configuration["debug"], multiple)
+        _start(ctx)
     except Exception as e:
+        error = e
         tb = traceback.format_exc()
-        message = (
-            f"ERROR: borg-backup for {configuration['foldername']} failed with reason:"
+        message = f"ERROR: borg-backup for {ctx.name} failed with reason: {type(e).__name__}: {e}"
+        # one message with what was done so far and the end of the traceback, the complete one is attached
+        notify(
+            ctx,
+            "\n".join([message] + ctx.report_lines + [notifications.tail(tb, TRACEBACK_LINES)]),
+            [("traceback.txt", tb)],
         )
-        notify(message)
-        notify(tb)
-        if dc_down:  # check whether this script has taken the stack down
-            if configuration["docker_compose"]:
-                docker_compose()
+        if ctx.dc_down:  # check whether this script has taken the stack down
+            if ctx.configuration["docker_compose"]:
+                docker_compose(ctx)
+        _await_readiness(ctx)
         logger.error(message)
         logger.error(tb)
+        if ctx.started is not None:
+            logger.error(_timing_summary(ctx))
+        ctx.metrics.set_outcome("failure", f"{type(e).__name__}: {e}")
         raise e
+    finally:
+        ctx.release_slots()
+        # after the success or error report was queued, the stack is up again at this point
+        maintenance_error = None
+        if ctx.targets:
+            try:
+                _maintain(ctx)
+            except Exception as e:
+                maintenance_error = e
+                message = f"ERROR: Maintenance of {ctx.name} failed with reason: {type(e).__name__}: {e}"
+                logger.error(message)
+                notify(ctx, message)
+                if error is None:
+                    ctx.metrics.set_outcome("failure", f"{type(e).__name__}: {e}")
+        _release_borg_caches(ctx)
+        if ctx.owns_ssh_masters:
+            ctx.ssh_masters.close()
+        if ctx.notifier:
+            with ctx.metrics.phase("notify"):
+                ctx.notifier.flush()
+        # finished_at and the run's duration include the maintenance
+        ctx.metrics.finish()
+        metrics.export(ctx)
+        if maintenance_error is not None and error is None:
+            raise maintenance_error
+
+
+def start(configfile: str, secretsfile: str) -> RunContext:
+    """Runs initial checks, parses the config and secrets files and creates the archive.
+
+    Args:
+        configfile (str): The file containing the configuration
+        secretsfile (str): The file containing the secrets
+
+    Returns:
+        RunContext: The finished run.
+    """
+    ctx = RunContext(configfile, secretsfile)
+    run(ctx)
+    return ctx
+
+
+def start_many(
+    configfiles: List[str],
+    secretsfile: str,
+    jobs: int = 4,
+    max_per_server: int = 2,
+    max_per_repo: int = 1,
+) -> List[orchestrator.RunResult]:
+    """Backs up several stacks at the same time and sends one combined report.
+
+    Args:
+        configfiles (List[str]): The config files, one per stack.
+        secretsfile (str): The file containing the secrets, shared by all stacks.
+        jobs (int, optional): Number of stacks backed up at the same time. Defaults to 4.
+        max_per_server (int, optional): Number of borg runs allowed per borgserver at the same time. Defaults to 2.
+        max_per_repo (int, optional): Number of borg runs allowed per borgrepo at the same time. Defaults to 1.
+
+    Returns:
+        List[orchestrator.RunResult]: One result per config file.
+    """
+    limiter = orchestrator.ConcurrencyLimiter(max_per_server, max_per_repo)
+    ssh_masters = sshmux.MasterPool()
+    contexts = []
+    for configfile in configfiles:
+        ctx = RunContext(configfile, secretsfile)
+        ctx.limiter = limiter
+        ctx.ssh_masters = ssh_masters
+        contexts.append(ctx)
+    try:
+        results = orchestrator.run_parallel(
+            contexts, lambda ctx: run(ctx, multiple=True), jobs
+        )
+        ssh_summaries = ssh_masters.summaries()
+    finally:
+        ssh_masters.close()
+    report = "\n".join([orchestrator.format_report(results)] + ssh_summaries)
+    logger.info(report)
+    report_ctx = RunContext(secretsfile=secretsfile)
+    try:
+        read_secrets(report_ctx, secretsfile)
+    except Exception:
+        logger.error(f"Couldn't read {secretsfile} to send the combined report")
+    else:
+        notify(report_ctx, report)
+        if report_ctx.notifier:
+            report_ctx.notifier.flush()
+    return results
+
+
+def _run_preflight(ctx: RunContext) -> None:
+    """Loads a run and runs its preflight checks only.
+
+    Args:
+        ctx (RunContext): The run.
+    """
+    try:
+        load(ctx)
+        logger_setup(ctx.configuration["debug"], multiple=True)
+        _setup_targets(ctx)
+        _lease_borg_caches(ctx)
+        _open_ssh_master(ctx)
+        pre_start_checks(ctx)
+        targets.finish(ctx.targets)
+    except Exception as e:
+        logger.error(f"{ctx.name}: {e}")
+        raise
+    finally:
+        for _, lease in ctx.borg_cache_leases:
+            lease.release()
+
+
+def preflight_only(
+    configfiles: List[str], secretsfile: str, jobs: int = 4
+) -> List[orchestrator.RunResult]:
+    """Runs the preflight checks of every stack without backing anything up.
+
+    Args:
+        configfiles (List[str]): The config files, one per stack.
+        secretsfile (str): The file containing the secrets, shared by all stacks.
+        jobs (int, optional): Number of stacks checked at the same time. Defaults to 4.
+
+    Returns:
+        List[orchestrator.RunResult]: One result per config file.
+    """
+    ssh_masters = sshmux.MasterPool()
+    contexts = []
+    for configfile in configfiles:
+        ctx = RunContext(configfile, secretsfile)
+        ctx.ssh_masters = ssh_masters
+        contexts.append(ctx)
+    try:
+        results = orchestrator.run_parallel(contexts, _run_preflight, jobs)
+    finally:
+        ssh_masters.close()
+    logger.info(orchestrator.format_report(results, title="preflight"))
+    return results
+
+
+def patterns_report(configfiles: List[str], secretsfile: str) -> None:
+    """Prints how many files and bytes every pattern rule of every stack excludes, without backing anything up.
+
+    Args:
+        configfiles (List[str]): The config files, one per stack.
+        secretsfile (str): The file containing the secrets, shared by all stacks.
+    """
+    import patterns
+
+    for configfile in configfiles:
+        ctx = RunContext(configfile, secretsfile)
+        load(ctx)
+        configuration = ctx.configuration
+        rules = _pattern_rules({**configuration, "patterns": configuration["patterns"] or patterns.settings(True)})
+        folder = f"{configuration['rootfolder']}{configuration['foldername']}"
+        title = ctx.name if configuration["patterns"] else f"{ctx.name} (patterns not enabled)"
+        print(patterns.report(rules, folder).format(title))
+
+
+def profile(configfiles: List[str], secretsfile: str, sample_size: int) -> None:
+    """Samples the project folder of every stack and prints which compression and chunker params of borg fit its data.
+
+    Args:
+        configfiles (List[str]): The config files, one per stack.
+        secretsfile (str): The file containing the secrets, shared by all stacks.
+        sample_size (int): Bytes sampled per stack.
+    """
+    import profiler
+
+    for configfile in configfiles:
+        ctx = RunContext(configfile, secretsfile)
+        load(ctx)
+        configuration = ctx.configuration
+        # the upload limit is the best guess of the uplink there is
+        isolation = configuration["isolation"]
+        uplink = (isolation["upload_ratelimit"] or {}).get("default") if isolation else None
+        result = profiler.profile(
+            f"{configuration['rootfolder']}{configuration['foldername']}",
+            sample_size,
+            uplink or profiler.DEFAULT_UPLINK,
+        )
+        print(result.format(ctx.name, configuration["borg_parameters"]["create"]))
+
+
+def daemon(
+    paths: List[str],
+    secretsfile: str,
+    jobs: int = 4,
+    max_per_server: int = 2,
+    max_per_repo: int = 1,
+    status_socket: str = None,
+) -> None:
+    """Runs every stack on the cron expression in its 'schedule' until SIGTERM or SIGINT.
+
+    The configs are read once and read again when a config file or the secrets file changes.
+
+    Args:
+        paths (List[str]): Config files or folders containing config files.
+        secretsfile (str): The file containing the secrets, shared by all stacks.
+        jobs (int, optional): Number of stacks backed up at the same time. Defaults to 4.
+        max_per_server (int, optional): Number of borg runs allowed per borgserver at the same time. Defaults to 2.
+        max_per_repo (int, optional): Number of borg runs allowed per borgrepo at the same time. Defaults to 1.
+        status_socket (str, optional): Unix socket answering with the queue and the next runs as JSON. Defaults to None.
+    """
+    import scheduler
+
+    logger_setup(False, multiple=True)
+    limiter = orchestrator.ConcurrencyLimiter(max_per_server, max_per_repo)
+    ssh_masters = sshmux.MasterPool()
+
+    def load_stack(configfile: str):
+        loaded = RunContext(configfile, secretsfile)
+        load(loaded)
+        return loaded.name, loaded.configuration["schedule"], loaded
+
+    def run_stack(loaded: RunContext) -> None:
+        ctx = RunContext(loaded.configfile, loaded.secretsfile)
+        ctx.secrets = loaded.secrets
+        ctx.notifier = loaded.notifier
+        ctx.configuration = copy.deepcopy(loaded.configuration)
+        ctx.limiter = limiter
+        ctx.ssh_masters = ssh_masters
+        run(ctx, multiple=True)
+
+    daemon_scheduler = scheduler.Scheduler(
+        paths,
+        load_stack,
+        run_stack,
+        jobs,
+        watch=[secretsfile],
+        on_idle=ssh_masters.close,
+    )
+
+    def stop(signum, frame):
+        logger.info(f"Received signal {signum}, stopping")
+        daemon_scheduler.stop()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        daemon_scheduler.serve_forever(status_socket)
+    finally:
+        ssh_masters.close()
+
+
+def show_status(status_socket: str) -> bool:
+    """Prints the status of a running daemon as JSON: the queue depth, the running stacks and the next and last run of every stack.
+
+    Args:
+        status_socket (str): The unix socket of the daemon.
+
+    Returns:
+        bool: True if the daemon answered, False otherwise.
+    """
+    import scheduler
+
+    try:
+        status = scheduler.query_status(status_socket)
+    except (OSError, ValueError) as e:
+        logger.error(f"No daemon answered on {status_socket}: {type(e).__name__}: {e}")
+        return False
+    print(json.dumps(status, indent=2))
+    return True
 
 
 def main():
+    # --status only talks to a running daemon, it needs neither configs nor secrets
+    status_parser = argparse.ArgumentParser(add_help=False)
+    status_parser.add_argument("--status", action="store_true")
+    status_parser.add_argument("--status-socket", default=STATUS_SOCKET)
+    status_args, _ = status_parser.parse_known_args()
+    if status_args.status:
+        logger_setup(False)
+        if not show_status(status_args.status_socket):
+            sys.exit(1)
+        return
     parser = argparse.ArgumentParser(
         description="Backup data (from docker-volumes) with borg"
     )
-    parser.add_argument("config", help="The config.yaml file")
+    parser.add_argument(
+        "config",
+        nargs="+",
+        help="The config.yaml file, several config files or folders containing config files",
+    )
     parser.add_argument("secrets", help="The secrets.yaml file")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=4,
+        help="Number of stacks backed up at the same time (default: 4)",
+    )
+    parser.add_argument(
+        "--max-per-server",
+        type=int,
+        default=2,
+        help="Number of borg runs per borgserver at the same time (default: 2)",
+    )
+    parser.add_argument(
+        "--max-per-repo",
+        type=int,
+        default=1,
+        help="Number of borg runs per borgrepo at the same time (default: 1)",
+    )
+    parser.add_argument(
+        "--preflight-only",
+        action="store_true",
+        help="Only run the preflight checks of every stack, don't back anything up",
+    )
+    parser.add_argument(
+        "--patterns-report",
+        action="store_true",
+        help="Show how many files and bytes the exclusion patterns of every stack remove from the backup, don't back anything up",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Sample the data of every stack and recommend compression and chunker params for borg create, don't back anything up",
+    )
+    parser.add_argument(
+        "--profile-sample",
+        default="64MiB",
+        help="Data sampled per stack by --profile (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep running and back up every stack on the cron expression in its 'schedule'",
+    )
+    parser.add_argument(
+        "--status-socket",
+        default=STATUS_SOCKET,
+        help="Unix socket of the daemon answering with its status as JSON (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--status",
+        action="store_true",
+        help="Print the status of the running daemon from --status-socket as JSON and exit, no configs needed",
+    )
     args = parser.parse_args()
-    start(args.config, args.secrets)
+    if args.daemon:
+        daemon(
+            args.config,
+            args.secrets,
+            args.jobs,
+            args.max_per_server,
+            args.max_per_repo,
+            args.status_socket,
+        )
+        return
+    if args.profile:
+        configfiles = orchestrator.collect_configs(args.config, exclude=[args.secrets])
+        profile(configfiles, args.secrets, units.parse_size(args.profile_sample))
+        return
+    if args.patterns_report:
+        patterns_report(orchestrator.collect_configs(args.config, exclude=[args.secrets]), args.secrets)
+        return
+    if args.preflight_only:
+        configfiles = orchestrator.collect_configs(args.config, exclude=[args.secrets])
+        results = preflight_only(configfiles, args.secrets, args.jobs)
+        if not all(r.success for r in results):
+            sys.exit(1)
+        return
+    if len(args.config) == 1 and not os.path.isdir(args.config[0]):
+        start(args.config[0], args.secrets)
+        return
+    configfiles = orchestrator.collect_configs(args.config, exclude=[args.secrets])
+    results = start_many(
+        configfiles, args.secrets, args.jobs, args.max_per_server, args.max_per_repo
+    )
+    if not all(r.success for r in results):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,161 @@
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import time
+from dataclasses import dataclass
+import borg
+from units import format_size, parse_duration
+
+logger = logging.getLogger(__name__)
+
+# run in this order, compact frees what prune deleted
+TASKS = ["prune", "compact", "check"]
+# seconds between two runs of a task, 0 is every run and None never
+DEFAULT_POLICY = {"prune": 0, "compact": None, "check": None}
+# a task is due a little early, so a daily task isn't skipped because yesterday's run ended a few seconds later
+GRACE = 0.05
+STATE_FILE = "maintenance.json"
+
+
+@dataclass
+class TaskResult:
+    """The outcome of one maintenance task on one repo."""
+
+    task: str
+    target: str
+    ok: bool = True
+    duration: float = 0.0
+    freed: int = 0
+    error: str = ""
+    prune: borg.PruneResult = None
+
+    def summary(self) -> str:
+        if not self.ok:
+            return f"{self.task} FAILED: {self.error}"
+        if self.task == "prune":
+            done = self.prune.summary()
+        elif self.task == "compact":
+            done = f"Compact: freed {format_size(self.freed)}."
+        else:
+            done = "Check: no problems found."
+        return f"{done} Took {self.duration:.0f}s."
+
+
+def policy(settings) -> dict:
+    """Turns the 'maintenance' part of the configuration into seconds between two runs of every task.
+
+    Args:
+        settings (dict): f.ex. {"prune": "1d", "compact": "7d", "check": "30d"}, None for the default policy.
+
+    Raises:
+        ValueError: Raised if a task is unknown or its interval isn't a duration.
+
+    Returns:
+        dict: {task: seconds or None}
+    """
+    result = dict(DEFAULT_POLICY)
+    for task, interval in (settings or {}).items():
+        if task not in TASKS:
+            raise ValueError(f"unknown maintenance task {task}, known are {', '.join(TASKS)}")
+        # 0 == False, so compare by identity
+        never = interval is None or interval is False or interval == "never"
+        result[task] = None if never else parse_duration(interval)
+    return result
+
+
+def _path(cache_dir: str) -> str:
+    return os.path.join(cache_dir, STATE_FILE)
+
+
+def _read(path: str) -> dict:
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        logger.warning(f"Maintenance state {path} is broken, starting over")
+        return {}
+
+
+def last_runs(cache_dir: str, key: str) -> dict:
+    """Returns when each task last succeeded on a repo.
+
+    Args:
+        cache_dir (str): The folder holding the state.
+        key (str): borgserver:borgrepo
+
+    Returns:
+        dict: {task: timestamp}
+    """
+    return _read(_path(cache_dir)).get(key, {})
+
+
+def due(policy: dict, last: dict, task: str, now: float = None) -> bool:
+    """Tells whether a task has to run.
+
+    Args:
+        policy (dict): The result of policy()
+        last (dict): The result of last_runs()
+        task (str): The task
+        now (float, optional): The current time. Defaults to time.time().
+
+    Returns:
+        bool: True if the task is due.
+    """
+    interval = policy[task]
+    if interval is None:
+        return False
+    if task not in last:
+        return True
+    now = time.time() if now is None else now
+    return now - last[task] >= interval * (1 - GRACE)
+
+
+def mark_done(cache_dir: str, key: str, task: str) -> None:
+    """Records that a task succeeded on a repo. The file is locked and replaced atomically, like the repository cache."""
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    path = _path(cache_dir)
+    with open(path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = _read(path)
+        state.setdefault(key, {})[task] = time.time()
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix=".tmp-")
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp, path)
+
+
+def run_task(task: str, target: str, **kwargs) -> TaskResult:
+    """Runs a maintenance task. Errors are caught and returned in the result, maintenance never fails a backup.
+
+    Args:
+        task (str): prune, compact or check
+        target (str): The name of the target, used in the result.
+
+    Returns:
+        TaskResult: The outcome
+    """
+    result = TaskResult(task, target)
+    start = time.monotonic()
+    try:
+        if task == "prune":
+            result.prune = borg.prune(**kwargs)
+        elif task == "compact":
+            result.freed = borg.compact(**kwargs)
+        else:
+            borg.check(**kwargs)
+    except Exception as e:
+        result.ok = False
+        result.error = f"{type(e).__name__}: {e}"
+        logger.error(f"{task} on {target} failed: {result.error}")
+    result.duration = time.monotonic() - start
+    if result.ok and not kwargs["debug"]:
+        mark_done(kwargs["cache_dir"], f"{kwargs['borgserver']}:{kwargs['borgrepo']}", task)
+    return result
+
+
+if __name__ == "__main__":
+    pass
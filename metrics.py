@@ -0,0 +1,367 @@
+import contextlib
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+from dataclasses import asdict
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "dcborgbackup"
+
+
+class RunMetrics:
+    """Collects the duration of every phase and the outcome of a run."""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.finished_at = None
+        self.phases = {}
+        self.outcome = "running"
+        self.error = ""
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Times the body as phase 'name'. A phase that runs several times is summed up.
+
+        Args:
+            name (str): f.ex. create
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.monotonic() - start
+
+    def set_outcome(self, outcome: str, error: str = "") -> None:
+        """Sets the outcome of the run, finish() ends it.
+
+        Args:
+            outcome (str): success, failure or skipped
+            error (str, optional): The error if the run failed. Defaults to "".
+        """
+        self.outcome = outcome
+        self.error = error
+
+    def finish(self, outcome: str = None, error: str = "") -> None:
+        """Ends the run, after its maintenance.
+
+        Args:
+            outcome (str, optional): success, failure or skipped. Defaults to the one set with set_outcome().
+            error (str, optional): The error if the run failed. Defaults to "".
+        """
+        if outcome:
+            self.set_outcome(outcome, error)
+        self.finished_at = time.time()
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _sample(name: str, labels: dict, value: float) -> str:
+    label_str = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+    return f"{PREFIX}_{name}{{{label_str}}} {value}"
+
+
+def _write_atomic(path: str, content: str) -> None:
+    """Writes a file via a temporary file in the same folder, so readers (node_exporter) never see half a file."""
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=folder, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
+def _last_success(path: str, stack: str) -> float:
+    """Reads the last success timestamp from an existing .prom file, so it survives failed runs."""
+    try:
+        with open(path, "r") as f:
+            content = f.read()
+    except FileNotFoundError:
+        return 0
+    match = re.search(
+        rf'^{PREFIX}_last_success_timestamp_seconds{{stack="{re.escape(_escape(stack))}"}} (\S+)$',
+        content,
+        re.MULTILINE,
+    )
+    return float(match.group(1)) if match else 0
+
+
+def collect(ctx) -> dict:
+    """Gathers everything worth exporting about a finished run.
+
+    Args:
+        ctx (RunContext): The run.
+
+    Returns:
+        dict: The values, ready to be dumped as JSON.
+    """
+    m = ctx.metrics
+    data = {
+        "stack": ctx.name,
+        "configfile": ctx.configfile,
+        "started_at": m.started_at,
+        "finished_at": m.finished_at,
+        "outcome": m.outcome,
+        "error": m.error,
+        "duration_seconds": ctx.duration(),
+        "downtime_seconds": ctx.downtime(),
+        "phases": m.phases,
+        "archive": asdict(ctx.archive) if ctx.archive else None,
+        "prune": asdict(ctx.prune_result) if ctx.prune_result else None,
+        "repository": asdict(ctx.repo_info) if ctx.repo_info else None,
+        "targets": [asdict(t.result) for t in ctx.targets],
+        "maintenance": [asdict(r) for r in ctx.maintenance],
+        "borg_cache": [
+            {**asdict(u), "sync_seconds": u.sync_seconds} for u in ctx.borg_cache
+        ],
+        "isolation": ctx.isolation.applied if ctx.isolation else [],
+        "queue_waits": [asdict(w) for w in ctx.queue_waits],
+        "readiness": (
+            {**asdict(ctx.readiness), "ready": ctx.readiness.ready, "ready_after": ctx.readiness.ready_after}
+            if ctx.readiness
+            else None
+        ),
+    }
+    return data
+
+
+def to_prometheus(data: dict, last_success: float = 0) -> str:
+    """Renders the values of collect() in the Prometheus text format.
+
+    Args:
+        data (dict): The result of collect()
+        last_success (float, optional): Timestamp of the last successful run before this one. Defaults to 0.
+
+    Returns:
+        str: The content of the .prom file.
+    """
+    stack = {"stack": data["stack"]}
+    lines = []
+
+    def gauge(name: str, help: str, samples: list) -> None:
+        lines.append(f"# HELP {PREFIX}_{name} {help}")
+        lines.append(f"# TYPE {PREFIX}_{name} gauge")
+        for labels, value in samples:
+            lines.append(_sample(name, labels, value))
+
+    gauge(
+        "phase_duration_seconds",
+        "Duration of each phase of the last run.",
+        [({**stack, "phase": p}, round(v, 3)) for p, v in data["phases"].items()],
+    )
+    gauge(
+        "run_duration_seconds",
+        "Duration of the last run.",
+        [(stack, round(data["duration_seconds"], 3))],
+    )
+    gauge(
+        "downtime_seconds",
+        "How long the stack was down during the last run.",
+        [(stack, round(data["downtime_seconds"], 3))],
+    )
+    gauge(
+        "last_run_timestamp_seconds",
+        "When the last run finished.",
+        [(stack, data["finished_at"] or time.time())],
+    )
+    gauge(
+        "last_run_success",
+        "1 if the last run succeeded or was skipped, 0 otherwise.",
+        [(stack, 0 if data["outcome"] == "failure" else 1)],
+    )
+    gauge(
+        "last_run_outcome",
+        "The outcome of the last run as label.",
+        [({**stack, "outcome": data["outcome"]}, 1)],
+    )
+    if data["outcome"] == "success":
+        last_success = data["finished_at"] or time.time()
+    gauge(
+        "last_success_timestamp_seconds",
+        "When the last successful run finished.",
+        [(stack, last_success)],
+    )
+    readiness = data.get("readiness")
+    if readiness:
+        gauge(
+            "stack_healthy",
+            "1 if the stack was healthy again before the readiness timeout of the last run, 0 otherwise.",
+            [(stack, 1 if readiness["ready"] else 0)],
+        )
+        gauge(
+            "ready_seconds",
+            "Seconds from the restart until the container or probe was ready in the last run.",
+            [({**stack, "check": c["name"]}, round(c["seconds"], 3)) for c in readiness["checks"] if c["ready"]],
+        )
+    archive = data["archive"]
+    if archive:
+        original = archive["original_size"]
+        written = archive["deduplicated_size"]
+        gauge(
+            "bytes_read",
+            "Original size of the last archive.",
+            [(stack, original)],
+        )
+        gauge(
+            "bytes_compressed",
+            "Compressed size of the last archive.",
+            [(stack, archive["compressed_size"])],
+        )
+        gauge(
+            "bytes_written",
+            "Data the last archive added to the repo after deduplication.",
+            [(stack, written)],
+        )
+        gauge(
+            "deduplication_ratio",
+            "Share of the data read by the last run that was already in the repo.",
+            [(stack, round(1 - written / original, 6) if original else 0)],
+        )
+        gauge("files", "Number of files in the last archive.", [(stack, archive["nfiles"])])
+    tasks = [({**stack, "target": r["target"], "task": r["task"]}, r) for r in data.get("maintenance") or []]
+    if tasks:
+        gauge(
+            "maintenance_duration_seconds",
+            "Duration of the maintenance tasks (prune, compact, check) of the last run.",
+            [(labels, round(r["duration"], 3)) for labels, r in tasks],
+        )
+        gauge(
+            "maintenance_success",
+            "1 if the maintenance task succeeded, 0 otherwise.",
+            [(labels, 1 if r["ok"] else 0) for labels, r in tasks],
+        )
+        gauge(
+            "maintenance_freed_bytes",
+            "Repository space borg compact freed in the last run.",
+            [(labels, r["freed"]) for labels, r in tasks if r["task"] == "compact"],
+        )
+    caches = [({**stack, "target": u["target"]}, u) for u in data.get("borg_cache") or []]
+    if caches:
+        gauge(
+            "borg_cache_bytes",
+            "Size of the borg cache (BORG_CACHE_DIR) of the target.",
+            [(labels, u["size"]) for labels, u in caches],
+        )
+        gauge(
+            "borg_cache_sync_seconds",
+            "Time borg spent resyncing its chunks cache during the last run.",
+            [(labels, round(u["sync_seconds"], 3)) for labels, u in caches],
+        )
+        gauge(
+            "borg_cache_syncs",
+            "Number of chunks cache resyncs during the last run.",
+            [(labels, len(u["syncs"])) for labels, u in caches],
+        )
+    targets = data.get("targets") or []
+    limited = [({**stack, "target": t["name"]}, t) for t in targets if t.get("upload_ratelimit")]
+    if limited:
+        gauge(
+            "upload_ratelimit_bytes_per_second",
+            "Upload rate limit borg create ran with in the last run.",
+            [(labels, t["upload_ratelimit"]) for labels, t in limited],
+        )
+        gauge(
+            "upload_throughput_bytes_per_second",
+            "Data the last archive added to the repo after deduplication per second of borg create.",
+            [
+                (labels, round(t["archive"]["deduplicated_size"] / t["archive"]["duration"], 3))
+                for labels, t in limited
+                if t["archive"] and t["archive"]["duration"]
+            ],
+        )
+    dumps = [({**stack, "target": t["name"], "dump": name}, a) for t in targets for name, a in (t.get("dumps") or {}).items()]
+    if dumps:
+        gauge(
+            "dump_bytes",
+            "Size of the database dump streamed into borg in the last run.",
+            [(labels, a["original_size"]) for labels, a in dumps],
+        )
+        gauge(
+            "dump_duration_seconds",
+            "Duration of dumping the database into borg in the last run.",
+            [(labels, round(a["duration"], 3)) for labels, a in dumps],
+        )
+    waits = {}
+    for w in data.get("queue_waits") or []:
+        labels = (w["server"], w["repo"])
+        waits[labels] = waits.get(labels, 0) + w["seconds"]
+    if waits:
+        gauge(
+            "queue_wait_seconds",
+            "Time the last run waited for upload slots shared with other hosts on the server and repo.",
+            [({**stack, "server": server, "repo": repo}, round(seconds, 3)) for (server, repo), seconds in waits.items()],
+        )
+    retried = [({**stack, "target": t["name"], "class": k}, n) for t in targets for k, n in (t.get("retries") or {}).items()]
+    if retried:
+        gauge(
+            "retries",
+            "Retries of a failed borg step in the last run, by error class (lock, network, other).",
+            retried,
+        )
+    cleaned = [({**stack, "target": t["name"]}, len(t["checkpoints_deleted"])) for t in targets if t.get("checkpoints_deleted")]
+    if cleaned:
+        gauge(
+            "checkpoints_deleted",
+            "Superseded checkpoint archives deleted after the last run.",
+            cleaned,
+        )
+    if len(targets) > 1:
+        per_target = [({**stack, "target": t["name"]}, t) for t in targets]
+        gauge(
+            "target_success",
+            "1 if the last run succeeded on the target, 0 otherwise.",
+            [(labels, 1 if t["outcome"] == "success" else 0) for labels, t in per_target],
+        )
+        for step in ("create", "prune"):
+            gauge(
+                f"target_{step}_duration_seconds",
+                f"Duration of {step} on the target, retries included.",
+                [(labels, round(t["durations"][step], 3)) for labels, t in per_target if step in t["durations"]],
+            )
+        gauge(
+            "target_bytes_written",
+            "Data the last archive added to the target's repo after deduplication.",
+            [(labels, t["archive"]["deduplicated_size"]) for labels, t in per_target if t["archive"]],
+        )
+    return "\n".join(lines) + "\n"
+
+
+def export(ctx) -> None:
+    """Writes the metrics of a finished run to the folders configured in 'metrics' (textfile_dir and/or json_dir).
+
+    Export errors are logged, they never fail the run.
+
+    Args:
+        ctx (RunContext): The run.
+    """
+    config = (ctx.configuration or {}).get("metrics")
+    if not config:
+        return
+    try:
+        data = collect(ctx)
+        if config.get("textfile_dir"):
+            path = os.path.join(config["textfile_dir"], f"{PREFIX}_{ctx.name}.prom")
+            last_success = _last_success(path, ctx.name)
+            _write_atomic(path, to_prometheus(data, last_success))
+            logger.debug(f"Wrote metrics to {path}")
+        if config.get("json_dir"):
+            stamp = time.strftime("%Y-%m-%d-%H%M%S", time.localtime(data["started_at"]))
+            path = os.path.join(config["json_dir"], f"{ctx.name}-{stamp}.json")
+            _write_atomic(path, json.dumps(data, indent=2, default=str))
+            logger.debug(f"Wrote run report to {path}")
+    except Exception as e:
+        logger.error(f"Couldn't export metrics: {e}")
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,358 @@
+import abc
+import atexit
+import json
+import logging
+import queue
+import threading
+import time
+import weakref
+from dataclasses import dataclass, field
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+
+RETRIES = 3
+BACKOFF = 2.0
+FLUSH_DEADLINE = 30
+# a worker without messages for this long ends, the next message starts a new one
+IDLE_TIMEOUT = 60
+TRUNCATED = "\n... (truncated)"
+
+
+class NotificationError(Exception):
+    pass
+
+
+@dataclass
+class Message:
+    """A notification. Attachments are (filename, content) pairs, f.ex. a complete traceback."""
+
+    text: str
+    attachments: List[Tuple[str, str]] = field(default_factory=list)
+
+
+def truncate(text: str, max_length: int) -> str:
+    """Cuts 'text' to at most 'max_length' characters.
+
+    Args:
+        text (str): The text
+        max_length (int): The limit, None for no limit.
+
+    Returns:
+        str: The text, marked as truncated if it was cut.
+    """
+    if max_length is None or len(text) <= max_length:
+        return text
+    return text[: max_length - len(TRUNCATED)] + TRUNCATED
+
+
+def tail(text: str, lines: int) -> str:
+    """Returns the last 'lines' lines of 'text', f.ex. the relevant end of a traceback."""
+    all_lines = text.rstrip("\n").splitlines()
+    if len(all_lines) <= lines:
+        return "\n".join(all_lines)
+    return "\n".join(["..."] + all_lines[-lines:])
+
+
+class Provider(abc.ABC):
+    """A way to deliver notifications. Each target (f.ex. a chat) gets its own worker, so targets are sent to at the same time.
+
+    Subclasses implement send(), it raises if the message couldn't be delivered.
+    """
+
+    name = "provider"
+    max_length = None
+
+    def targets(self) -> list:
+        return [None]
+
+    @abc.abstractmethod
+    def send(self, target, message: Message) -> None:
+        """Delivers 'message' to 'target', one of targets()."""
+
+
+class TelegramProvider(Provider):
+    name = "telegram"
+    max_length = 4096
+
+    def __init__(self, bot_token: str, chatids: list):
+        import telegram
+
+        self.bot = telegram.Bot(token=bot_token)
+        self.chatids = chatids
+
+    def targets(self) -> list:
+        return self.chatids
+
+    def send(self, chatid, message: Message) -> None:
+        import io
+
+        self.bot.sendMessage(chat_id=chatid, text=truncate(message.text, self.max_length))
+        for filename, content in message.attachments:
+            self.bot.send_document(
+                chat_id=chatid, document=io.BytesIO(content.encode()), filename=filename
+            )
+
+
+class EmailProvider(Provider):
+    name = "email"
+
+    def __init__(
+        self,
+        host: str,
+        sender: str,
+        recipients: list,
+        port: int = 587,
+        starttls: bool = True,
+        user: str = None,
+        password: str = None,
+        subject: str = "dcborgbackup",
+    ):
+        self.host = host
+        self.port = port
+        self.starttls = starttls
+        self.user = user
+        self.password = password
+        self.sender = sender
+        self.recipients = recipients
+        self.subject = subject
+
+    def send(self, target, message: Message) -> None:
+        import smtplib
+        from email.message import EmailMessage
+
+        mail = EmailMessage()
+        mail["From"] = self.sender
+        mail["To"] = ", ".join(self.recipients)
+        mail["Subject"] = f"{self.subject}: {message.text.splitlines()[0] if message.text else ''}"
+        mail.set_content(message.text)
+        for filename, content in message.attachments:
+            mail.add_attachment(content, filename=filename)
+        with smtplib.SMTP(self.host, self.port, timeout=30) as smtp:
+            if self.starttls:
+                smtp.starttls()
+            if self.user:
+                smtp.login(self.user, self.password)
+            smtp.send_message(mail)
+
+
+class WebhookProvider(Provider):
+    """POSTs {"text": ..., "attachments": [{"filename": ..., "content": ...}]} as JSON to 'url'."""
+
+    name = "webhook"
+
+    def __init__(self, url: str, headers: dict = None, timeout: float = 10):
+        self.url = url
+        self.headers = headers or {}
+        self.timeout = timeout
+
+    def send(self, target, message: Message) -> None:
+        import urllib.request
+
+        body = {
+            "text": message.text,
+            "attachments": [{"filename": f, "content": c} for f, c in message.attachments],
+        }
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps(body).encode(),
+            headers={"Content-Type": "application/json", **self.headers},
+            method="POST",
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            if response.status >= 300:
+                raise NotificationError(f"webhook answered {response.status}")
+
+
+class FileProvider(Provider):
+    """Appends every notification to a local file."""
+
+    name = "file"
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def send(self, target, message: Message) -> None:
+        with open(self.path, "a") as f:
+            f.write(f"--- {time.strftime('%Y-%m-%d %H:%M:%S')}\n{message.text}\n")
+            for filename, content in message.attachments:
+                f.write(f"--- {filename}\n{content}\n")
+
+
+class _Lane:
+    """The queue and the worker of one provider target."""
+
+    def __init__(self, provider: Provider, target):
+        self.provider = provider
+        self.target = target
+        self.queue = queue.Queue()
+        self.thread = None
+        # a message that didn't fit into the last combined message anymore
+        self.carry = None
+
+    @property
+    def label(self) -> str:
+        return self.provider.name if self.target is None else f"{self.provider.name}:{self.target}"
+
+
+_dispatchers = weakref.WeakSet()
+
+
+class Dispatcher:
+    """Sends notifications in the background, so a slow or failing provider never blocks a backup.
+
+    Messages that queue up for a target while it's busy are combined into one. Failed sends are retried with exponential backoff.
+
+    Args:
+        providers (List[Provider]): The providers to send to.
+        retries (int, optional): Retries per message and target. Defaults to 3.
+        backoff (float, optional): Seconds before the first retry, doubled on every further one. Defaults to 2.
+        deadline (float, optional): Seconds flush() waits by default. Defaults to 30.
+    """
+
+    def __init__(
+        self,
+        providers: List[Provider],
+        retries: int = RETRIES,
+        backoff: float = BACKOFF,
+        deadline: float = FLUSH_DEADLINE,
+    ):
+        self.providers = providers
+        self.retries = retries
+        self.backoff = backoff
+        self.deadline = deadline
+        self._lanes = [_Lane(p, t) for p in providers for t in p.targets()]
+        self._lock = threading.Lock()
+        self._done = threading.Condition(self._lock)
+        self._pending = 0
+        self.failed = 0
+        _dispatchers.add(self)
+
+    def submit(self, message: Message) -> None:
+        """Queues a message for every target and returns right away."""
+        for lane in self._lanes:
+            lane.queue.put(message)
+            with self._lock:
+                self._pending += 1
+                if lane.thread is None:
+                    lane.thread = threading.Thread(
+                        target=self._work, args=(lane,), name=f"notify-{lane.label}", daemon=True
+                    )
+                    lane.thread.start()
+
+    def _take(self, lane: _Lane) -> List[Message]:
+        """Waits for the next message and takes the ones queued behind it as well, as long as they fit into one message."""
+        if lane.carry:
+            messages, lane.carry = [lane.carry], None
+        else:
+            messages = [lane.queue.get(timeout=IDLE_TIMEOUT)]
+        length = len(messages[0].text)
+        limit = lane.provider.max_length
+        while True:
+            try:
+                message = lane.queue.get_nowait()
+            except queue.Empty:
+                return messages
+            length += len(message.text) + 2
+            if limit is not None and length > limit:
+                lane.carry = message
+                return messages
+            messages.append(message)
+
+    def _work(self, lane: _Lane) -> None:
+        while True:
+            try:
+                messages = self._take(lane)
+            except queue.Empty:
+                with self._lock:
+                    # checked under the lock, submit() starts a new worker if a message arrives after this
+                    if lane.queue.empty() and lane.carry is None:
+                        lane.thread = None
+                        return
+                continue
+            message = Message(
+                "\n\n".join(m.text for m in messages),
+                [a for m in messages for a in m.attachments],
+            )
+            self._deliver(lane, message)
+            with self._lock:
+                self._pending -= len(messages)
+                self._done.notify_all()
+
+    def _deliver(self, lane: _Lane, message: Message) -> None:
+        for attempt in range(self.retries + 1):
+            try:
+                lane.provider.send(lane.target, message)
+                return
+            except Exception as e:
+                if attempt == self.retries:
+                    with self._lock:
+                        self.failed += 1
+                    logger.error(f"Couldn't send notification via {lane.label}: {type(e).__name__}: {e}")
+                    return
+                delay = self.backoff * 2**attempt
+                logger.warning(
+                    f"Sending notification via {lane.label} failed ({type(e).__name__}: {e}), retrying in {delay:.0f}s"
+                )
+                time.sleep(delay)
+
+    def flush(self, deadline: float = None) -> bool:
+        """Waits until every queued message was sent or given up on.
+
+        Args:
+            deadline (float, optional): Seconds to wait at most. Defaults to the deadline of the dispatcher.
+
+        Returns:
+            bool: True if nothing is left in the queues.
+        """
+        if deadline is None:
+            deadline = self.deadline
+        end = time.monotonic() + deadline
+        with self._lock:
+            while self._pending:
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    logger.warning(f"{self._pending} notifications not sent within {deadline}s")
+                    return False
+                self._done.wait(remaining)
+        return True
+
+
+@atexit.register
+def _flush_all() -> None:
+    for dispatcher in list(_dispatchers):
+        dispatcher.flush()
+
+
+PROVIDERS = {
+    "telegram": TelegramProvider,
+    "email": EmailProvider,
+    "webhook": WebhookProvider,
+    "file": FileProvider,
+}
+
+
+def from_secrets(secrets: dict) -> Dispatcher:
+    """Builds a Dispatcher for every provider configured in secrets.yaml.
+
+    Args:
+        secrets (dict): The parsed secrets.yaml, providers are configured under their name (telegram, email, webhook, file),
+            retries, backoff and deadline under 'notifications'.
+
+    Returns:
+        Dispatcher: The dispatcher, None if no provider is configured.
+    """
+    providers = [cls(**secrets[name]) for name, cls in PROVIDERS.items() if secrets.get(name)]
+    if not providers:
+        return None
+    settings = secrets.get("notifications") or {}
+    return Dispatcher(
+        providers,
+        retries=settings.get("retries", RETRIES),
+        backoff=settings.get("backoff", BACKOFF),
+        deadline=settings.get("deadline", FLUSH_DEADLINE),
+    )
+
+
+if __name__ == "__main__":
+    pass
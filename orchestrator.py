@@ -0,0 +1,158 @@
+import contextlib
+import logging
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Iterable, List
+
+logger = logging.getLogger(__name__)
+
+CONFIG_SUFFIXES = (".yaml", ".yml")
+
+
+class NoConfigsFound(FileNotFoundError):
+    pass
+
+
+@dataclass
+class RunResult:
+    """The outcome of one stack's run."""
+
+    name: str
+    configfile: str
+    success: bool
+    duration: float
+    error: str = ""
+
+
+class ConcurrencyLimiter:
+    """Caps how many borg runs hit a borgserver and a borgrepo at the same time."""
+
+    def __init__(self, max_per_server: int = 2, max_per_repo: int = 1):
+        if max_per_server < 1 or max_per_repo < 1:
+            raise ValueError("max_per_server and max_per_repo need to be at least 1")
+        self.max_per_server = max_per_server
+        self.max_per_repo = max_per_repo
+        self._lock = threading.Lock()
+        self._servers = {}
+        self._repos = {}
+
+    def _semaphore(self, registry: dict, key, size: int) -> threading.Semaphore:
+        with self._lock:
+            if key not in registry:
+                registry[key] = threading.Semaphore(size)
+            return registry[key]
+
+    @contextlib.contextmanager
+    def slot(self, server: str, repo: str):
+        """Blocks until a slot for 'server' and for 'repo' on that server is free.
+
+        The repo slot is always taken before the server slot, so two runs can't deadlock each other, and a run waiting for its repo
+        doesn't hold a server slot runs for other repos on that server could use.
+
+        Args:
+            server (str): The borgserver
+            repo (str): The borgrepo
+        """
+        server_sem = self._semaphore(self._servers, server, self.max_per_server)
+        repo_sem = self._semaphore(self._repos, (server, repo), self.max_per_repo)
+        start = time.monotonic()
+        with repo_sem, server_sem:
+            waited = time.monotonic() - start
+            if waited >= 1:
+                logger.info(f"Waited {waited:.1f}s for a slot on {server}:{repo}")
+            yield
+
+
+def collect_configs(paths: Iterable[str], exclude: Iterable[str] = ()) -> List[str]:
+    """Expands a list of config files and folders into a sorted list of config files.
+
+    Args:
+        paths (Iterable[str]): Config files or folders containing *.yaml/*.yml config files.
+        exclude (Iterable[str], optional): Files to skip, f.ex. the secrets file if it lives next to the configs.
+
+    Raises:
+        FileNotFoundError: Raised if a path doesn't exist.
+        NoConfigsFound: Raised if no config file was found.
+
+    Returns:
+        List[str]: The config files.
+    """
+    excluded = {os.path.realpath(e) for e in exclude}
+    configs = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = [
+                os.path.join(path, f)
+                for f in sorted(os.listdir(path))
+                if f.endswith(CONFIG_SUFFIXES)
+            ]
+        elif os.path.isfile(path):
+            found = [path]
+        else:
+            raise FileNotFoundError(f"Configuration {path} not found.")
+        for f in found:
+            if os.path.realpath(f) not in excluded and f not in configs:
+                configs.append(f)
+    if not configs:
+        raise NoConfigsFound(f"No config files found in {', '.join(paths)}")
+    return configs
+
+
+def run_parallel(contexts: list, run: Callable, jobs: int = 4) -> List[RunResult]:
+    """Runs 'run(context)' for every context in a pool of 'jobs' worker threads.
+
+    Args:
+        contexts (list): The RunContexts to run.
+        run (Callable): Called with a single RunContext, raises on failure.
+        jobs (int, optional): Number of stacks backed up at the same time. Defaults to 4.
+
+    Returns:
+        List[RunResult]: One result per context, in the order of 'contexts'.
+    """
+
+    def worker(ctx) -> RunResult:
+        threading.current_thread().name = ctx.name
+        start = time.monotonic()
+        try:
+            run(ctx)
+        except Exception as e:
+            logger.debug(traceback.format_exc())
+            return RunResult(
+                ctx.name,
+                ctx.configfile,
+                False,
+                time.monotonic() - start,
+                f"{type(e).__name__}: {e}",
+            )
+        return RunResult(ctx.name, ctx.configfile, True, time.monotonic() - start)
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        return list(pool.map(worker, contexts))
+
+
+def format_report(results: List[RunResult], title: str = "borg-backup") -> str:
+    """Builds one combined report of all results.
+
+    Args:
+        results (List[RunResult]): The results of run_parallel()
+        title (str, optional): What was run. Defaults to "borg-backup".
+
+    Returns:
+        str: The report.
+    """
+    failed = [r for r in results if not r.success]
+    lines = [
+        f"{title} of {len(results)} stacks finished: {len(results) - len(failed)} succeeded, {len(failed)} failed."
+    ]
+    for r in results:
+        status = "OK" if r.success else f"FAILED: {r.error}"
+        lines.append(f"{r.name}: {status} ({r.duration:.0f}s)")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    pass
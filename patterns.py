@@ -0,0 +1,305 @@
+import fnmatch
+import logging
+import os
+import re
+import tempfile
+from dataclasses import dataclass
+from typing import Dict, List
+from units import format_size
+
+logger = logging.getLogger(__name__)
+
+# paths inside containers that only hold data the container rebuilds. Keyed by image, matched (fnmatch) against the name without
+# registry and tag and against its last part, so "jellyfin" covers jellyfin/jellyfin and linuxserver/jellyfin.
+LIBRARY: Dict[str, List[str]] = {
+    "*": ["/tmp", "/var/tmp", "/var/cache", "/var/log", "/root/.cache", "/root/.npm"],
+    "nextcloud": ["/var/www/html/data/appdata_*/preview", "/var/www/html/data/nextcloud.log"],
+    "jellyfin": ["/cache", "/config/log", "/config/transcodes", "/config/data/transcodes"],
+    "plex": [
+        "/config/Library/Application Support/Plex Media Server/Cache",
+        "/config/Library/Application Support/Plex Media Server/Logs",
+        "/transcode",
+    ],
+    "pms-docker": [
+        "/config/Library/Application Support/Plex Media Server/Cache",
+        "/config/Library/Application Support/Plex Media Server/Logs",
+        "/transcode",
+    ],
+    "immich-server": ["/usr/src/app/upload/thumbs", "/usr/src/app/upload/encoded-video"],
+    "photoprism": ["/photoprism/storage/cache"],
+    "gitlab-*": ["/var/log/gitlab"],
+    "home-assistant": ["/config/tts"],
+}
+COMPOSE_FILE = "docker-compose.yaml"
+
+
+@dataclass
+class Rule:
+    """One line of the patterns file.
+
+    Args:
+        pattern (str): A borg shell pattern relative to the project folder.
+        action (str): "+" includes matching paths, "-" excludes them.
+        source (str): Where the rule comes from, f.ex. config or library nextcloud (app)
+    """
+
+    pattern: str
+    action: str = "-"
+    source: str = "config"
+
+    def line(self, root: str) -> str:
+        """Returns the rule as a line of a patterns file for a backup of 'root'. borg matches without the leading slash."""
+        return f"{self.action} sh:{root.strip('/')}/{self.pattern}"
+
+
+@dataclass
+class RuleStats:
+    """What a rule removes from (or keeps in) the backup."""
+
+    rule: Rule
+    files: int = 0
+    bytes: int = 0
+
+
+@dataclass
+class Report:
+    """The result of report(): per-rule stats and the size of the whole folder."""
+
+    rules: List[RuleStats]
+    files: int = 0
+    bytes: int = 0
+
+    @property
+    def excluded_bytes(self) -> int:
+        return sum(s.bytes for s in self.rules if s.rule.action == "-")
+
+    @property
+    def excluded_files(self) -> int:
+        return sum(s.files for s in self.rules if s.rule.action == "-")
+
+    def format(self, title: str) -> str:
+        lines = [
+            f"{title}: {len(self.rules)} rules exclude {self.excluded_files} of {self.files} files, "
+            f"{format_size(self.excluded_bytes)} of {format_size(self.bytes)}"
+        ]
+        for s in self.rules:
+            lines.append(
+                f"  {s.rule.action} {s.rule.pattern:50} {s.files:>9} files {format_size(s.bytes):>10}  {s.rule.source}"
+            )
+        return "\n".join(lines)
+
+
+def settings(value) -> dict:
+    """Turns the 'patterns' part of the configuration into library, include and exclude.
+
+    Args:
+        value (dict): True or f.ex. {"library": True, "exclude": ["data/*/cache"], "include": ["data/keep"]}
+
+    Raises:
+        ValueError: Raised if a key is unknown, include/exclude aren't lists or a pattern is empty.
+
+    Returns:
+        dict: The settings with defaults applied.
+    """
+    value = value if isinstance(value, dict) else {}
+    unknown = [k for k in value if k not in ("library", "include", "exclude")]
+    if unknown:
+        raise ValueError(f"unknown keys {', '.join(unknown)}")
+    result = {"library": True, "include": [], "exclude": []}
+    result.update(value)
+    for key in ("include", "exclude"):
+        if not isinstance(result[key], list):
+            raise ValueError(f"{key} needs to be a list of patterns")
+        result[key] = [str(p).strip("/") for p in result[key]]
+        if not all(result[key]):
+            raise ValueError(f"{key} contains an empty pattern, that would match the whole project")
+    return result
+
+
+def image_name(image: str) -> str:
+    """Strips registry, tag and digest from an image, f.ex. ghcr.io/immich-app/immich-server:v1 -> immich-app/immich-server"""
+    image = image.split("@", 1)[0]
+    name, _, tag = image.rpartition(":")
+    if name and "/" not in tag:
+        image = name
+    first, _, rest = image.partition("/")
+    if rest and ("." in first or ":" in first or first == "localhost"):
+        image = rest
+    if image.startswith("library/"):
+        image = image[len("library/") :]
+    return image
+
+
+def library_paths(image: str) -> List[str]:
+    """Returns the cache paths in LIBRARY for an image, including the ones every image has."""
+    name = image_name(image)
+    paths = []
+    short = name.rsplit("/", 1)[-1]
+    for pattern, entries in LIBRARY.items():
+        if fnmatch.fnmatchcase(name, pattern) or fnmatch.fnmatchcase(short, pattern):
+            paths.extend(p for p in entries if p not in paths)
+    return paths
+
+
+def _host_pattern(container_path: str, source: str, target: str, folder: str) -> str:
+    """Maps a path in a container to a pattern relative to 'folder' through the bind mount source:target.
+
+    Returns:
+        str: The pattern, None if the path isn't in the mount or the mount isn't in 'folder'.
+    """
+    target = target.rstrip("/")
+    if source != folder and not source.startswith(folder + "/"):
+        return None
+    if container_path == target or container_path.startswith(target + "/"):
+        host = source + container_path[len(target) :]
+    elif target.startswith(container_path + "/"):
+        host = source  # the whole mount is below the cache path, f.ex. /var/log/nginx and /var/log
+    else:
+        return None
+    if host == folder:
+        return None  # never exclude the whole project
+    return os.path.relpath(host, folder)
+
+
+def compose_rules(compose_file: str, folder: str) -> List[Rule]:
+    """Builds the exclude rules of the cache paths of the services in a compose file, mapped to the host through their bind mounts.
+    Paths in named volumes aren't backed up anyway.
+
+    Args:
+        compose_file (str): The compose file
+        folder (str): The project folder, only mounts inside it are backed up.
+
+    Returns:
+        List[Rule]: The rules
+    """
+    import composefile
+
+    services = composefile.load(compose_file).get("services", {}) or {}
+    compose_folder = os.path.dirname(compose_file)
+    env = composefile.project_env(compose_folder)
+    rules = []
+    seen = set()
+    for name, service in services.items():
+        service = service or {}
+        paths = library_paths(service["image"]) if service.get("image") else []
+        origin = f"library {image_name(service['image'])} ({name})" if paths else ""
+        for source, target, _ in composefile.bind_mounts(service, compose_folder, env):
+            for container_path in paths:
+                pattern = _host_pattern(container_path, source, target, folder)
+                if pattern is None or pattern in seen:
+                    continue
+                seen.add(pattern)
+                rules.append(Rule(pattern, "-", origin))
+    return rules
+
+
+def build(**kwargs) -> List[Rule]:
+    """Builds the rules of a stack: the includes and excludes of the config first, borg uses the first matching rule, then the ones from
+    the compose file.
+
+    Returns:
+        List[Rule]: The rules
+    """
+    settings = kwargs["patterns"]
+    folder = os.path.normpath(f"{kwargs['rootfolder']}{kwargs['foldername']}")
+    rules = [Rule(p, "+", "config") for p in settings["include"]]
+    rules += [Rule(p, "-", "config") for p in settings["exclude"]]
+    compose_file = kwargs.get("compose_file") or os.path.join(folder, COMPOSE_FILE)
+    if settings["library"] and os.path.isfile(compose_file):
+        rules += compose_rules(compose_file, folder)
+    return rules
+
+
+def write(rules: List[Rule], root: str, folder: str) -> str:
+    """Writes a patterns file for 'borg create --patterns-from'.
+
+    Args:
+        rules (List[Rule]): The rules
+        root (str): The folder borg reads from, the project folder or a copy of it.
+        folder (str): Where the file is created.
+
+    Returns:
+        str: The path of the file, the caller removes it.
+    """
+    os.makedirs(folder, mode=0o700, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=folder, prefix="patterns-", suffix=".lst")
+    with os.fdopen(fd, "w") as f:
+        f.write("".join(f"{rule.line(root)}\n" for rule in rules))
+    return path
+
+
+def translate(pattern: str) -> str:
+    """Translates a borg shell pattern (sh:) to a regular expression, like borg does.
+
+    '*' matches within a path element, '**/' any number of elements. A pattern matches a path and everything below it.
+
+    Returns:
+        str: The regular expression, matched against a relative path with a trailing slash.
+    """
+    pattern = os.path.normpath(pattern).strip("/") + "/**/"
+    i, n = 0, len(pattern)
+    res = ""
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == "*":
+            if pattern.startswith("*/", i):
+                res += r"(?:[^/]*/)*"
+                i += 2
+            else:
+                res += r"[^/]*"
+        elif c == "?":
+            res += r"[^/]"
+        elif c == "[":
+            j = pattern.find("]", i + 1)
+            if j == -1:
+                res += r"\["
+            else:
+                stuff = pattern[i:j].replace("\\", r"\\")
+                i = j + 1
+                if stuff.startswith("!"):
+                    stuff = "^" + stuff[1:]
+                res += f"[{stuff}]"
+        else:
+            res += re.escape(c)
+    return res + r"\Z"
+
+
+def report(rules: List[Rule], folder: str) -> Report:
+    """Walks 'folder' and counts the files and bytes each rule matches first, the way borg would apply them.
+
+    Args:
+        rules (List[Rule]): The rules
+        folder (str): The project folder
+
+    Returns:
+        Report: Per-rule stats and the totals.
+    """
+    compiled = [re.compile(translate(r.pattern), re.DOTALL) for r in rules]
+    result = Report([RuleStats(r) for r in rules])
+
+    def first_match(relpath: str) -> int:
+        for i, regex in enumerate(compiled):
+            if regex.match(relpath + "/"):
+                return i
+        return None
+
+    for path, dirs, files in os.walk(folder):
+        relfolder = os.path.relpath(path, folder)
+        relfolder = "" if relfolder == "." else relfolder + "/"
+        for name in files:
+            try:
+                size = os.lstat(os.path.join(path, name)).st_size
+            except OSError:
+                continue
+            result.files += 1
+            result.bytes += size
+            matched = first_match(relfolder + name)
+            if matched is not None:
+                result.rules[matched].files += 1
+                result.rules[matched].bytes += size
+    return result
+
+
+if __name__ == "__main__":
+    pass
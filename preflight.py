@@ -0,0 +1,131 @@
+import logging
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from dataclasses import dataclass
+from typing import Callable, List
+
+logger = logging.getLogger(__name__)
+
+
+class PreflightError(Exception):
+    """Raised if at least one preflight check failed, 'results' holds the outcome of every check."""
+
+    def __init__(self, message: str, results: list):
+        super().__init__(message)
+        self.results = results
+
+    @property
+    def failures(self) -> list:
+        return [r for r in self.results if not r.ok]
+
+
+@dataclass
+class Check:
+    """A single preflight check. 'func' raises an exception if the check fails."""
+
+    name: str
+    func: Callable[[], None]
+    timeout: float
+
+
+@dataclass
+class CheckResult:
+    name: str
+    ok: bool
+    duration: float
+    error: str = ""
+
+
+def tcp_reachable(host: str, port: int = 22, timeout: float = 5) -> bool:
+    """Tests whether a TCP connection to host:port can be opened. Works on networks that block ICMP.
+
+    Args:
+        host (str): The host to test
+        port (int, optional): The port to connect to. Defaults to 22.
+        timeout (float, optional): Seconds to wait for the connection. Defaults to 5.
+
+    Returns:
+        bool: True if the connection was opened, False otherwise.
+    """
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError as e:
+        logger.debug(f"Connecting to {host}:{port} failed: {e}")
+        return False
+
+
+def run_checks(checks: List[Check]) -> List[CheckResult]:
+    """Runs all checks at the same time. A check that doesn't finish within its timeout counts as failed.
+
+    Args:
+        checks (List[Check]): The checks to run.
+
+    Returns:
+        List[CheckResult]: One result per check, in the order of 'checks'.
+    """
+
+    def timed(check: Check) -> float:
+        start = time.monotonic()
+        check.func()
+        return time.monotonic() - start
+
+    pool = ThreadPoolExecutor(max_workers=max(1, len(checks)))
+    start = time.monotonic()
+    futures = [(check, pool.submit(timed, check)) for check in checks]
+    results = []
+    for check, future in futures:
+        remaining = check.timeout - (time.monotonic() - start)
+        try:
+            duration = future.result(timeout=max(0, remaining))
+        except FutureTimeoutError:
+            results.append(
+                CheckResult(
+                    check.name,
+                    False,
+                    time.monotonic() - start,
+                    f"timed out after {check.timeout}s",
+                )
+            )
+        except Exception as e:
+            results.append(
+                CheckResult(check.name, False, time.monotonic() - start, repr(e))
+            )
+        else:
+            results.append(CheckResult(check.name, True, duration))
+    # a check that timed out may still be running, don't wait for it
+    pool.shutdown(wait=False)
+    return results
+
+
+def check(name: str, checks: List[Check]) -> List[CheckResult]:
+    """Runs all checks and raises one error listing every failed check.
+
+    Args:
+        name (str): The stack the checks are for, used in the error message.
+        checks (List[Check]): The checks to run.
+
+    Raises:
+        PreflightError: Raised if at least one check failed.
+
+    Returns:
+        List[CheckResult]: The results if all checks passed.
+    """
+    results = run_checks(checks)
+    for r in results:
+        logger.info(
+            f"preflight {r.name}: {'ok' if r.ok else 'FAILED ' + r.error} ({r.duration:.2f}s)"
+        )
+    failed = [r for r in results if not r.ok]
+    if failed:
+        lines = [f"{r.name}: {r.error}" for r in failed]
+        raise PreflightError(
+            f"Preflight checks for {name} failed:\n" + "\n".join(lines), results
+        )
+    return results
+
+
+if __name__ == "__main__":
+    pass
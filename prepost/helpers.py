@@ -1,3 +1,6 @@
+from cmdrunner import cmd_run
+
+
 def is_mountpoint(mp):
     """Checks whether mp is a mountpoint. Can be used to make sure that we are not reading from an unmounted disk where there are no data.
 
@@ -15,3 +18,18 @@ def is_mountpoint(mp):
             if mountpoint == mp:
                 is_mountpoint = True
     return is_mountpoint
+
+
+def run(cmd, **kwargs):
+    """Runs a command like borg is run: under the nice/ionice classes or in the cgroup set in 'isolation'.
+
+    Args:
+        cmd (str): The command, f.ex: docker exec nextcloud-db pg_dumpall -U postgres
+        kwargs: The configuration passed to pre() and post().
+
+    Returns:
+        Popen: The finished process, see cmdrunner.cmd_run()
+    """
+    if kwargs.get("isolation_prefix"):
+        cmd = f"{kwargs['isolation_prefix']} {cmd}"
+    return cmd_run(cmd, **kwargs)
@@ -0,0 +1,297 @@
+import logging
+import lzma
+import math
+import os
+import random
+import re
+import stat
+import time
+import zlib
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List
+from units import format_size
+
+logger = logging.getLogger(__name__)
+
+BLOCK = 2 * 2**20  # borg compresses chunks, about 2 MiB with the default chunker params
+SAMPLE_SIZE = 64 * 2**20
+DEFAULT_UPLINK = 10 * 2**20  # bytes per second, used if no upload_ratelimit is set
+# borg's 'auto' compresses with the chosen algorithm only if lz4 gets the data below this share of its size
+AUTO_THRESHOLD = 0.97
+# borg keeps about 40 bytes per chunk in the chunks cache and as much in the repository index
+INDEX_BYTES_PER_CHUNK = 80
+MAX_INDEX_MEMORY = 512 * 2**20
+CHUNKER_PARAMS = {
+    "buzhash,19,23,21,4095": "borg's default, ~2 MiB chunks",
+    "buzhash,19,23,22,4095": "~4 MiB chunks, half the index for big media files",
+    "buzhash,10,23,16,4095": "~64 KiB chunks, finer deduplication of small changes",
+}
+DEFAULT_CHUNKER = "buzhash,19,23,21,4095"
+
+
+@dataclass
+class Candidate:
+    """One compression setting measured on the sample."""
+
+    name: str
+    compressed: int = 0
+    cpu_seconds: float = 0.0
+
+    def ratio(self, sampled: int) -> float:
+        return self.compressed / sampled if sampled else 1.0
+
+
+@dataclass
+class Projection:
+    """A candidate projected on the whole folder."""
+
+    name: str
+    size: int
+    cpu_seconds: float
+    upload_seconds: float
+
+    @property
+    def total_seconds(self) -> float:
+        return self.cpu_seconds + self.upload_seconds
+
+
+@dataclass
+class ChunkerEstimate:
+    """The number of chunks borg would cut the folder into with some chunker params."""
+
+    params: str
+    note: str
+    chunks: int
+
+    @property
+    def index_memory(self) -> int:
+        return self.chunks * INDEX_BYTES_PER_CHUNK
+
+
+@dataclass
+class Profile:
+    """What profile() found out about a folder."""
+
+    folder: str
+    files: int = 0
+    total: int = 0
+    sampled: int = 0
+    sampled_files: int = 0
+    uplink: int = DEFAULT_UPLINK
+    candidates: Dict[str, Candidate] = field(default_factory=dict)
+    missing: List[str] = field(default_factory=list)
+    paths: Dict[str, Dict[str, Candidate]] = field(default_factory=dict)
+    path_sampled: Dict[str, int] = field(default_factory=dict)
+    chunkers: List[ChunkerEstimate] = field(default_factory=list)
+
+    def projections(self) -> List[Projection]:
+        """Projects every candidate on the whole folder, the fastest first backup (CPU time plus upload time) first."""
+        scale = self.total / self.sampled if self.sampled else 0
+        result = []
+        for c in self.candidates.values():
+            size = int(c.ratio(self.sampled) * self.total)
+            result.append(Projection(c.name, size, c.cpu_seconds * scale, size / self.uplink))
+        return sorted(result, key=lambda p: (p.total_seconds, p.size))
+
+    def recommended_compression(self) -> str:
+        return self.projections()[0].name
+
+    def recommended_chunker(self) -> str:
+        """borg's default unless its index would take more than MAX_INDEX_MEMORY, then the one with the fewest chunks."""
+        default = next(c for c in self.chunkers if c.params == DEFAULT_CHUNKER)
+        if default.index_memory <= MAX_INDEX_MEMORY:
+            return DEFAULT_CHUNKER
+        return min(self.chunkers, key=lambda c: c.chunks).params
+
+    def path_rules(self) -> Dict[str, str]:
+        """Returns the candidate that fits each top-level folder best, by the same measure as recommended_compression()."""
+        rules = {}
+        for path, candidates in self.paths.items():
+            rules[path] = min(
+                candidates.values(),
+                key=lambda c: (c.cpu_seconds + c.compressed / self.uplink, c.compressed),
+            ).name
+        return rules
+
+    def format(self, title: str, create: str = "") -> str:
+        """Renders the profile as a report, 'create' are the current borg_parameters['create']."""
+        lines = [
+            f"{title}: {self.files} files, {format_size(self.total)}, "
+            f"sampled {format_size(self.sampled)} in {self.sampled_files} files, uplink {format_size(self.uplink)}/s"
+        ]
+        lines.append(f"  {'compression':16} {'ratio':>6} {'projected size':>15} {'CPU time':>10} {'upload':>10}")
+        for p in self.projections():
+            ratio = self.candidates[p.name].ratio(self.sampled)
+            lines.append(
+                f"  {p.name:16} {ratio:6.2f} {format_size(p.size):>15} {p.cpu_seconds:9.1f}s {p.upload_seconds:9.1f}s"
+            )
+        if self.missing:
+            lines.append(f"  not measured: {', '.join(self.missing)}")
+        lines.append(f"  {'chunker params':24} {'chunks':>10} {'index memory':>13}")
+        for c in self.chunkers:
+            lines.append(f"  {c.params:24} {c.chunks:10} {format_size(c.index_memory):>13}  {c.note}")
+        rules = self.path_rules()
+        if len(set(rules.values())) > 1:
+            lines.append("  per folder (borg uses one compression per archive, auto,<algorithm> skips incompressible chunks):")
+            for path, name in sorted(rules.items()):
+                lines.append(f"    {path}: {name}")
+        lines.append(f"  recommended create: {recommend(create, self.recommended_compression(), self.recommended_chunker())}")
+        if self.recommended_chunker() != DEFAULT_CHUNKER:
+            lines.append("  other chunker params don't deduplicate against the archives made with the old ones")
+        return "\n".join(lines)
+
+
+def compressors() -> Dict[str, Callable[[bytes], bytes]]:
+    """Returns the compression settings of borg that can be measured here. lz4 and zstd need the lz4 and zstandard packages.
+
+    Returns:
+        Dict[str, Callable[[bytes], bytes]]: {borg's name: compress function}
+    """
+    result = {"none": lambda data: data}
+    try:
+        import lz4.block
+
+        result["lz4"] = lambda data: lz4.block.compress(data, store_size=False)
+    except ImportError:
+        pass
+    try:
+        import zstandard
+
+        for level in (1, 3, 6, 10):
+            result[f"zstd,{level}"] = zstandard.ZstdCompressor(level=level).compress
+    except ImportError:
+        pass
+    for level in (1, 6):
+        result[f"zlib,{level}"] = lambda data, level=level: zlib.compress(data, level)
+    for level in (5, 6):
+        result[f"lzma,{level}"] = lambda data, level=level: lzma.compress(data, preset=level)
+    return result
+
+
+def _measure(compress: Callable[[bytes], bytes], block: bytes) -> tuple:
+    start = time.process_time()
+    size = len(compress(block))
+    return size, time.process_time() - start
+
+
+def _sample(folder: str, sample_size: int, seed: int) -> tuple:
+    """Lists the files in 'folder' and picks blocks to sample, files with a chance proportional to their size.
+
+    Returns:
+        tuple: (number of files, total bytes, [(path, offset, length, top-level folder)], sizes of the files)
+    """
+    files = []
+    for path, _, names in os.walk(folder):
+        for name in names:
+            full = os.path.join(path, name)
+            try:
+                st = os.lstat(full)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                files.append((full, st.st_size))
+    total = sum(size for _, size in files)
+    blocks = []
+    if total:
+        rng = random.Random(seed)
+        # every block of BLOCK bytes has the same chance to be picked, small files count as one block
+        share = min(1.0, sample_size / total)
+        for full, size in files:
+            count = max(1, math.ceil(size / BLOCK))
+            for index in range(count):
+                if rng.random() < share:
+                    top = os.path.relpath(full, folder).split(os.sep)[0]
+                    top = top if os.path.isdir(os.path.join(folder, top)) else "."
+                    blocks.append((full, index * BLOCK, min(BLOCK, size - index * BLOCK), top))
+    return len(files), total, blocks, [size for _, size in files]
+
+
+def estimate_chunks(sizes: List[int], params: str) -> int:
+    """Estimates how many chunks borg's buzhash chunker cuts files of 'sizes' into.
+
+    A file smaller than the minimum chunk is one chunk. Above it, a cut happens with a chance of 1 / 2^mask_bits per byte after the
+    minimum, so a chunk is about 2^min + 2^mask_bits bytes, at most 2^max.
+
+    Args:
+        sizes (List[int]): The file sizes
+        params (str): f.ex. buzhash,19,23,21,4095
+
+    Returns:
+        int: The estimated number of chunks.
+    """
+    _, min_exp, max_exp, mask_bits, _ = params.split(",")
+    minimum, maximum = 2 ** int(min_exp), 2 ** int(max_exp)
+    average = min(minimum + 2 ** int(mask_bits), maximum)
+    return sum(1 if size <= minimum else math.ceil(size / average) for size in sizes if size)
+
+
+def profile(
+    folder: str, sample_size: int = SAMPLE_SIZE, uplink: int = DEFAULT_UPLINK, seed: int = 0
+) -> Profile:
+    """Samples 'folder' and measures how well and how fast the compression settings of borg compress it.
+
+    Args:
+        folder (str): The folder, rootfolder/foldername
+        sample_size (int, optional): Bytes to sample. Defaults to 64 MiB.
+        uplink (int, optional): Upload bytes per second, to weigh CPU time against size. Defaults to 10 MiB/s.
+        seed (int, optional): Seed of the sampling, the same seed samples the same blocks. Defaults to 0.
+
+    Returns:
+        Profile: The measurements and the chunk count estimates.
+    """
+    result = Profile(folder, uplink=uplink)
+    result.files, result.total, blocks, sizes = _sample(folder, sample_size, seed)
+    available = compressors()
+    result.missing = [n for n in ("lz4", "zstd") if not any(k.startswith(n) for k in available)]
+    # borg's auto probes with lz4, zlib,1 stands in for it if lz4 isn't installed
+    probe = "lz4" if "lz4" in available else "zlib,1"
+    auto = [f"auto,{n}" for n in ("zstd,3", "lzma,6", "zlib,6") if n in available]
+    names = list(available) + auto
+    result.candidates = {n: Candidate(n) for n in names}
+    sampled_files = set()
+    for full, offset, length, top in blocks:
+        try:
+            with open(full, "rb") as f:
+                f.seek(offset)
+                block = f.read(length)
+        except OSError:
+            continue
+        if not block:
+            continue
+        sampled_files.add(full)
+        result.sampled += len(block)
+        result.path_sampled[top] = result.path_sampled.get(top, 0) + len(block)
+        per_path = result.paths.setdefault(top, {n: Candidate(n) for n in names})
+        measured = {n: _measure(compress, block) for n, compress in available.items()}
+        for name in names:
+            if name.startswith("auto,"):
+                probe_size, probe_cpu = measured[probe]
+                size, cpu = measured[name[len("auto,") :]]
+                if probe_size >= AUTO_THRESHOLD * len(block):
+                    size, cpu = len(block), 0.0
+                cpu += probe_cpu
+            else:
+                size, cpu = measured[name]
+            for candidate in (result.candidates[name], per_path[name]):
+                candidate.compressed += size
+                candidate.cpu_seconds += cpu
+    result.sampled_files = len(sampled_files)
+    result.chunkers = [ChunkerEstimate(p, note, estimate_chunks(sizes, p)) for p, note in CHUNKER_PARAMS.items()]
+    return result
+
+
+def recommend(create: str, compression: str, chunker: str) -> str:
+    """Replaces --compression/-C and --chunker-params in the 'create' parameters.
+
+    Returns:
+        str: f.ex. --compression auto,zstd,3 --chunker-params buzhash,19,23,21,4095 --exclude-caches
+    """
+    rest = re.sub(r"(--compression|-C|--chunker-params)(=|\s+)\S+", "", create or "")
+    params = f"--compression {compression}"
+    if chunker != DEFAULT_CHUNKER:
+        params += f" --chunker-params {chunker}"
+    return " ".join([params] + rest.split())
+
+
+if __name__ == "__main__":
+    pass
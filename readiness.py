@@ -0,0 +1,286 @@
+import logging
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List
+from preflight import tcp_reachable
+from units import parse_duration
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT = 300
+INTERVAL = 2
+PROBE_TIMEOUT = 5
+# what 'docker inspect' prints per container: name, status and health (empty without a health check)
+INSPECT_FORMAT = "{{.Name}} {{.State.Status}} {{if .State.Health}}{{.State.Health.Status}}{{end}}"
+
+
+@dataclass
+class CheckResult:
+    """One container or probe: whether and when it was ready after the restart."""
+
+    name: str
+    ready: bool = False
+    seconds: float = None
+    detail: str = ""
+
+
+@dataclass
+class Readiness:
+    """The outcome of waiting for a restarted stack."""
+
+    started: float
+    timeout: float
+    checks: List[CheckResult] = field(default_factory=list)
+    finished: float = None
+
+    @property
+    def ready(self) -> bool:
+        return all(c.ready for c in self.checks)
+
+    @property
+    def ready_after(self) -> float:
+        """Seconds from the restart until the last check was ready, None if one never was."""
+        if not self.ready:
+            return None
+        return max((c.seconds for c in self.checks), default=0.0)
+
+    @property
+    def pending(self) -> List[CheckResult]:
+        return [c for c in self.checks if not c.ready]
+
+    def summary(self) -> str:
+        if self.ready:
+            slowest = max(self.checks, key=lambda c: c.seconds, default=None)
+            last = f", {slowest.name} was the last" if slowest and len(self.checks) > 1 else ""
+            return f"Stack healthy {self.ready_after:.0f}s after the restart ({len(self.checks)} checks{last})."
+        pending = ", ".join(f"{c.name} ({c.detail})" if c.detail else c.name for c in self.pending)
+        return f"Stack not healthy {self.timeout:.0f}s after the restart, waiting for: {pending}."
+
+
+def settings(value) -> dict:
+    """Turns the 'readiness' part of the configuration into timeout, interval, health and probes.
+
+    Args:
+        value (dict): True or f.ex. {"timeout": "5m", "probes": [{"http": "http://localhost:8080/status.php"}, {"tcp": "localhost:5432"}]}
+
+    Raises:
+        ValueError: Raised if a key is unknown, a duration can't be parsed or a probe is neither http nor tcp.
+
+    Returns:
+        dict: The settings with defaults applied, durations in seconds.
+    """
+    value = value if isinstance(value, dict) else {}
+    unknown = [k for k in value if k not in ("timeout", "interval", "health", "probes")]
+    if unknown:
+        raise ValueError(f"unknown keys {', '.join(unknown)}")
+    probes = []
+    for probe in value.get("probes") or []:
+        if "http" in probe:
+            probes.append({"http": probe["http"], "status": int(probe.get("status", 0))})
+        elif "tcp" in probe:
+            host, _, port = str(probe["tcp"]).rpartition(":")
+            if not host or not port.isdigit():
+                raise ValueError(f"tcp probe {probe['tcp']} needs to be host:port")
+            probes.append({"tcp": probe["tcp"], "host": host, "port": int(port)})
+        else:
+            raise ValueError("every probe needs http or tcp")
+    return {
+        "timeout": parse_duration(value.get("timeout", TIMEOUT)),
+        "interval": parse_duration(value.get("interval", INTERVAL)),
+        "health": bool(value.get("health", True)),
+        "probes": probes,
+    }
+
+
+def http_probe(url: str, status: int = 0, timeout: float = PROBE_TIMEOUT) -> str:
+    """Requests 'url'.
+
+    Args:
+        url (str): The URL
+        status (int, optional): The expected status, 0 accepts everything below 400. Defaults to 0.
+        timeout (float, optional): Seconds to wait for the answer. Defaults to 5.
+
+    Returns:
+        str: Why the probe failed, "" if it succeeded.
+    """
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            code = response.status
+    except urllib.error.HTTPError as e:
+        code = e.code
+    except (OSError, ValueError) as e:
+        return str(getattr(e, "reason", e))
+    if (status and code != status) or (not status and code >= 400):
+        return f"HTTP {code}"
+    return ""
+
+
+def container_states(compose_folder: str, services: List[str] = None) -> Dict[str, str]:
+    """Asks docker for the state of the containers of a compose project.
+
+    Args:
+        compose_folder (str): The folder holding the compose file.
+        services (List[str], optional): Only the containers of these services. Defaults to all.
+
+    Returns:
+        Dict[str, str]: {container name: "" if it's healthy, or running without a health check, else its state}
+    """
+    ids = subprocess.run(
+        ["docker-compose", "ps", "-q"] + list(services or []),
+        cwd=compose_folder,
+        capture_output=True,
+        text=True,
+        timeout=PROBE_TIMEOUT * 6,
+    ).stdout.split()
+    if not ids:
+        return {}
+    lines = subprocess.run(
+        ["docker", "inspect", "--format", INSPECT_FORMAT] + ids,
+        capture_output=True,
+        text=True,
+        timeout=PROBE_TIMEOUT * 6,
+    ).stdout.splitlines()
+    states = {}
+    for line in lines:
+        name, status, health = (line.split(" ") + ["", ""])[:3]
+        name = name.lstrip("/")
+        if health:
+            states[name] = "" if health == "healthy" else health
+        else:
+            states[name] = "" if status == "running" else status
+    return states
+
+
+class Watcher:
+    """Polls the containers and probes of a restarted stack in the background, each check in its own thread, until every one is
+    ready or the deadline passed.
+
+    Args:
+        settings (dict): The result of settings()
+        compose_folder (str): The folder holding the compose file.
+        services (List[str], optional): Only the containers of these services (docker_compose_mode: selective). Defaults to all.
+        states (Callable, optional): Returns the container states, see container_states(). Defaults to container_states.
+        on_timeout (Callable, optional): Called from the background with the outcome as soon as the deadline passed with a check not
+            ready, f.ex. to alert while the run is still busy. Defaults to none.
+    """
+
+    def __init__(
+        self,
+        settings: dict,
+        compose_folder: str,
+        services: List[str] = None,
+        states: Callable[[str, List[str]], Dict[str, str]] = container_states,
+        on_timeout: Callable[[Readiness], None] = None,
+    ):
+        self.settings = settings
+        self.result = Readiness(time.monotonic(), settings["timeout"])
+        self._deadline = self.result.started + settings["timeout"]
+        self._lock = threading.Lock()
+        self._threads = []
+        if settings["health"]:
+            self._start(self._poll_containers, compose_folder, services, states)
+        for probe in settings["probes"]:
+            if "http" in probe:
+                check = self._add(probe["http"])
+                self._start(self._poll, check, lambda p=probe: http_probe(p["http"], p["status"]))
+            else:
+                check = self._add(probe["tcp"])
+                self._start(
+                    self._poll,
+                    check,
+                    lambda p=probe: "" if tcp_reachable(p["host"], p["port"], PROBE_TIMEOUT) else "connection refused",
+                )
+        self._supervisor = None
+        if on_timeout:
+            self._supervisor = threading.Thread(
+                target=self._supervise, args=(on_timeout,), name=f"{threading.current_thread().name}/readiness", daemon=True
+            )
+            self._supervisor.start()
+
+    def _add(self, name: str) -> CheckResult:
+        check = CheckResult(name)
+        with self._lock:
+            self.result.checks.append(check)
+        return check
+
+    def _start(self, func: Callable, *args) -> None:
+        thread = threading.Thread(target=func, args=args, name=f"{threading.current_thread().name}/readiness", daemon=True)
+        self._threads.append(thread)
+        thread.start()
+
+    def _done(self, check: CheckResult) -> None:
+        check.ready = True
+        check.seconds = time.monotonic() - self.result.started
+        check.detail = ""
+
+    def _poll(self, check: CheckResult, probe: Callable[[], str]) -> None:
+        while True:
+            try:
+                check.detail = probe()
+            except Exception as e:
+                check.detail = f"{type(e).__name__}: {e}"
+            if not check.detail:
+                self._done(check)
+                return
+            if time.monotonic() + self.settings["interval"] > self._deadline:
+                return
+            time.sleep(self.settings["interval"])
+
+    def _poll_containers(self, compose_folder: str, services: List[str], states: Callable) -> None:
+        checks = {}
+        while True:
+            try:
+                current = states(compose_folder, services)
+            except (OSError, subprocess.SubprocessError) as e:
+                logger.warning(f"Couldn't get the state of the containers: {e}")
+                current = {}
+            for name, state in current.items():
+                if name not in checks:
+                    checks[name] = self._add(name)
+                if not checks[name].ready:
+                    if state:
+                        checks[name].detail = state
+                    else:
+                        self._done(checks[name])
+            if current and all(c.ready for c in checks.values()):
+                return
+            if time.monotonic() + self.settings["interval"] > self._deadline:
+                if not checks:
+                    self._add("containers").detail = "none running"
+                return
+            time.sleep(self.settings["interval"])
+
+    def _join(self) -> None:
+        for thread in self._threads:
+            thread.join()
+        with self._lock:
+            if self.result.finished is None:
+                self.result.finished = time.monotonic()
+
+    def _supervise(self, on_timeout: Callable[[Readiness], None]) -> None:
+        self._join()
+        if self.result.ready:
+            return
+        try:
+            on_timeout(self.result)
+        except Exception as e:
+            logger.error(f"Couldn't report the stack as down: {type(e).__name__}: {e}")
+
+    def wait(self) -> Readiness:
+        """Waits until every check is ready or the deadline passed, and until on_timeout returned.
+
+        Returns:
+            Readiness: The outcome
+        """
+        self._join()
+        if self._supervisor:
+            self._supervisor.join()
+        return self.result
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,100 @@
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+
+logger = logging.getLogger(__name__)
+
+CACHE_FILE = "repos.json"
+
+
+@dataclass
+class VerifiedRepo:
+    """What a full 'borg info' confirmed about a repository."""
+
+    repository_id: str
+    encryption_mode: str
+    verified_at: float
+
+
+def _path(cache_dir: str) -> str:
+    return os.path.join(cache_dir, CACHE_FILE)
+
+
+def _read(path: str) -> dict:
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        logger.warning(f"Repository cache {path} is broken, starting over")
+        return {}
+
+
+def _write(path: str, entries: dict) -> None:
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    with os.fdopen(fd, "w") as f:
+        json.dump(entries, f, indent=2)
+    os.replace(tmp, path)
+
+
+def lookup(cache_dir: str, key: str, ttl: float) -> VerifiedRepo:
+    """Returns the cached verification of a repository if it's younger than 'ttl' seconds.
+
+    Args:
+        cache_dir (str): The folder holding the cache.
+        key (str): borgserver:borgrepo
+        ttl (float): Maximum age of the verification in seconds.
+
+    Returns:
+        VerifiedRepo: The verification, None if there is none or it is stale.
+    """
+    entry = _read(_path(cache_dir)).get(key)
+    if not entry:
+        return None
+    repo = VerifiedRepo(**entry)
+    if time.time() - repo.verified_at > ttl:
+        logger.info(f"Verification of {key} is older than {ttl:.0f}s")
+        return None
+    return repo
+
+
+def store(cache_dir: str, key: str, repository_id: str, encryption_mode: str) -> None:
+    """Saves the verification of a repository.
+
+    The file is locked while it's updated and replaced atomically, so runs of other stacks and processes don't lose entries.
+
+    Args:
+        cache_dir (str): The folder holding the cache.
+        key (str): borgserver:borgrepo
+        repository_id (str): The ID borg reported.
+        encryption_mode (str): The encryption mode borg reported.
+    """
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    path = _path(cache_dir)
+    with open(path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        entries = _read(path)
+        entries[key] = asdict(VerifiedRepo(repository_id, encryption_mode, time.time()))
+        _write(path, entries)
+
+
+def forget(cache_dir: str, key: str) -> None:
+    """Drops the verification of a repository, f.ex. after its ID changed."""
+    path = _path(cache_dir)
+    if not os.path.exists(path):
+        return
+    with open(path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        entries = _read(path)
+        if entries.pop(key, None) is None:
+            return
+        _write(path, entries)
+
+
+if __name__ == "__main__":
+    pass
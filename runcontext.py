@@ -0,0 +1,132 @@
+import contextlib
+import os
+import time
+from metrics import RunMetrics
+
+
+class RunContext:
+    """Holds the state of a single backup run (one config/secrets pair).
+
+    Every function in dcborgbackup that needs the configuration, the secrets or the
+    notifier receives the context instead of reading module globals, so several
+    runs can live side by side in one process.
+    """
+
+    def __init__(self, configfile: str = None, secretsfile: str = None):
+        self.configfile = configfile
+        self.secretsfile = secretsfile
+        self.configuration = None
+        self.secrets = None
+        self.notifier = None
+        self.dc_down = False
+        self.compose_services = None
+        self.limiter = None
+        self.ssh_masters = None
+        self.owns_ssh_masters = False
+        self.started = None
+        self.downtime_started = None
+        self.downtime_ended = None
+        self.report_lines = []
+        self.repo_info = None
+        self.archive = None
+        self.prune_result = None
+        self.targets = []
+        self.maintenance = []
+        self.borg_cache_leases = []
+        self.borg_cache = []
+        self.pattern_rules = []
+        self.isolation = None
+        self.readiness_watcher = None
+        self.readiness = None
+        self.queue_waits = []
+        self.reserved_slots = contextlib.ExitStack()
+        self.reserved = set()
+        self.metrics = RunMetrics()
+
+    @property
+    def name(self) -> str:
+        """The name used in log messages and reports: foldername if the config was read, the config file otherwise."""
+        if self.configuration and "foldername" in self.configuration:
+            return self.configuration["foldername"]
+        if self.configfile:
+            return os.path.basename(self.configfile)
+        return "dcborgbackup"
+
+    def add_report(self, line: str) -> None:
+        """Adds a line to the report sent at the end of the run.
+
+        Args:
+            line (str): f.ex. the statistics of a step.
+        """
+        self.report_lines.append(line)
+
+    def stack_stopped(self) -> None:
+        """Marks the start of the downtime window."""
+        self.dc_down = True
+        self.downtime_started = time.monotonic()
+        self.downtime_ended = None
+
+    def stack_started(self) -> None:
+        """Marks the end of the downtime window."""
+        self.dc_down = False
+        if self.downtime_started is not None:
+            self.downtime_ended = time.monotonic()
+
+    def stack_healthy(self, at: float) -> None:
+        """Moves the end of the downtime window to when the restarted stack was healthy (time.monotonic())."""
+        if self.downtime_started is not None:
+            self.downtime_ended = at
+
+    def downtime(self) -> float:
+        """Returns how long the stack was down in seconds, 0 if it wasn't taken down. With 'readiness' until it was healthy again."""
+        if self.downtime_started is None:
+            return 0.0
+        end = self.downtime_ended if self.downtime_ended else time.monotonic()
+        return end - self.downtime_started
+
+    def duration(self) -> float:
+        """Returns how long the run has been running in seconds."""
+        if self.started is None:
+            return 0.0
+        return time.monotonic() - self.started
+
+    @contextlib.contextmanager
+    def borg_slot(self, configuration: dict = None):
+        """Holds a borg slot for this run's borgserver and borgrepo: the upload slot shared with other hosts if 'coordination' is set,
+        unless it's reserved already (see reserve_slot()), then the slot of the orchestrator.
+
+        The slot shared with other hosts is always taken first, so runs in one process can't deadlock each other.
+
+        Args:
+            configuration (dict, optional): The configuration of a target. Defaults to the configuration of the run.
+        """
+        configuration = configuration or self.configuration
+        key = (configuration["borgserver"], configuration["borgrepo"])
+        with contextlib.ExitStack() as stack:
+            if configuration.get("coordination") and not configuration["debug"] and key not in self.reserved:
+                self._take_slot(stack, configuration)
+            if self.limiter is not None:
+                stack.enter_context(self.limiter.slot(*key))
+            yield
+
+    def _take_slot(self, stack: contextlib.ExitStack, configuration: dict) -> None:
+        import slots
+
+        wait = stack.enter_context(slots.held(configuration["coordination"], **configuration))
+        self.queue_waits.append(wait)
+        if wait.seconds >= 1:
+            self.add_report(wait.summary())
+
+    def reserve_slot(self, configuration: dict) -> None:
+        """Takes the upload slot shared with other hosts for a target and holds it until release_slots(), f.ex. from before the stack
+        is stopped until its archive is created, so the stack isn't down while the run waits for its turn."""
+        key = (configuration["borgserver"], configuration["borgrepo"])
+        if not configuration.get("coordination") or configuration["debug"] or key in self.reserved:
+            return
+        self._take_slot(self.reserved_slots, configuration)
+        self.reserved.add(key)
+
+    def release_slots(self) -> None:
+        """Releases the slots taken with reserve_slot()."""
+        self.reserved_slots.close()
+        self.reserved = set()
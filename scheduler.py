@@ -0,0 +1,386 @@
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Callable, Iterable, List, Tuple
+import orchestrator
+
+logger = logging.getLogger(__name__)
+
+RELOAD_INTERVAL = 30
+
+CRON_ALIASES = {
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+    "@monthly": "0 0 1 * *",
+    "@weekly": "0 0 * * 0",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@hourly": "0 * * * *",
+}
+MONTHS = ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"]
+WEEKDAYS = ["sun", "mon", "tue", "wed", "thu", "fri", "sat"]
+
+
+class CronExpression:
+    """A cron expression: minute hour day-of-month month day-of-week, or one of @hourly, @daily, @weekly, @monthly, @yearly.
+
+    Fields accept *, lists (1,15), ranges (1-5), steps (*/15, 0-30/10) and the names of months and weekdays.
+    Like cron, a day matches if day-of-month or day-of-week matches when both are restricted.
+    """
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        fields = CRON_ALIASES.get(expression.strip(), expression).split()
+        if len(fields) != 5:
+            raise ValueError(f"cron expression '{expression}' needs 5 fields")
+        self.minutes = self._parse(fields[0], 0, 59)
+        self.hours = self._parse(fields[1], 0, 23)
+        self.days = self._parse(fields[2], 1, 31)
+        self.months = self._parse(fields[3], 1, 12, MONTHS, 1)
+        # 7 is sunday as well
+        self.weekdays = {d % 7 for d in self._parse(fields[4], 0, 7, WEEKDAYS, 0)}
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    def _parse(self, field: str, low: int, high: int, names: list = None, offset: int = 0) -> set:
+        def value(v: str) -> int:
+            if names and v.lower() in names:
+                return names.index(v.lower()) + offset
+            n = int(v)
+            if not low <= n <= high:
+                raise ValueError(f"{n} is out of range {low}-{high} in '{self.expression}'")
+            return n
+
+        values = set()
+        for part in field.split(","):
+            step = 1
+            if "/" in part:
+                part, step_str = part.split("/", 1)
+                step = int(step_str)
+                if step < 1:
+                    raise ValueError(f"step needs to be at least 1 in '{self.expression}'")
+            if part == "*":
+                start, end = low, high
+            elif "-" in part:
+                start, end = (value(v) for v in part.split("-", 1))
+            else:
+                start = value(part)
+                end = high if step > 1 else start
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, dt: datetime) -> bool:
+        dom = dt.day in self.days
+        dow = (dt.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return dom and dow
+        return dom or dow
+
+    def next_after(self, dt: datetime) -> datetime:
+        """Returns the first matching minute after 'dt'.
+
+        Args:
+            dt (datetime): The time to start from.
+
+        Raises:
+            ValueError: Raised if the expression never matches, f.ex. 0 0 31 2 *.
+
+        Returns:
+            datetime: The next time the expression matches.
+        """
+        t = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = t + timedelta(days=5 * 366)
+        while t < limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+            else:
+                return t
+        raise ValueError(f"cron expression '{self.expression}' never matches")
+
+
+@dataclass
+class Job:
+    """A scheduled stack and what happened to its last run."""
+
+    configfile: str
+    name: str
+    cron: CronExpression
+    payload: Any
+    next_run: datetime
+    running: bool = False
+    queued: bool = False
+    last_started: datetime = None
+    last_finished: datetime = None
+    last_outcome: str = ""
+    last_error: str = ""
+    skipped: int = 0
+
+    def status(self) -> dict:
+        def iso(dt):
+            return dt.isoformat(timespec="seconds") if dt else None
+
+        return {
+            "name": self.name,
+            "configfile": self.configfile,
+            "schedule": self.cron.expression,
+            "next_run": iso(self.next_run),
+            "queued": self.queued,
+            "running": self.running,
+            "last_started": iso(self.last_started),
+            "last_finished": iso(self.last_finished),
+            "last_outcome": self.last_outcome,
+            "last_error": self.last_error,
+            "skipped": self.skipped,
+        }
+
+
+class Scheduler:
+    """Runs every stack on its own cron schedule in a bounded pool of worker threads.
+
+    The configs are loaded once and reloaded when a file changes. A stack that is still queued or running when it's due again is skipped.
+
+    Args:
+        paths (Iterable[str]): Config files or folders containing config files.
+        load (Callable): Called with a config file, returns (name, schedule, payload). The schedule is a cron expression or None for stacks
+            the scheduler should ignore. Raises if the config is broken.
+        run (Callable): Called with the payload of a stack, raises on failure.
+        jobs (int, optional): Number of stacks backed up at the same time. Defaults to 4.
+        exclude (Iterable[str], optional): Files to skip in 'paths'.
+        watch (Iterable[str], optional): Further files that reload every stack when they change, f.ex. the secrets file.
+        on_idle (Callable, optional): Called when the last running stack finished, f.ex. to close ssh connections.
+        reload_interval (float, optional): Seconds between checks for changed config files. Defaults to 30.
+    """
+
+    def __init__(
+        self,
+        paths: Iterable[str],
+        load: Callable[[str], Tuple[str, str, Any]],
+        run: Callable[[Any], None],
+        jobs: int = 4,
+        exclude: Iterable[str] = (),
+        watch: Iterable[str] = (),
+        on_idle: Callable[[], None] = None,
+        reload_interval: float = RELOAD_INTERVAL,
+    ):
+        self.paths = list(paths)
+        self.exclude = list(exclude)
+        self.watch = list(watch)
+        self.load = load
+        self.run = run
+        self.jobs = jobs
+        self.on_idle = on_idle
+        self.reload_interval = reload_interval
+        self.started = datetime.now()
+        self._jobs = {}
+        self._watched = {}
+        self._seen = {}
+        self._active = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._pool = ThreadPoolExecutor(max_workers=max(1, jobs), thread_name_prefix="job")
+
+    def _mtime(self, path: str) -> float:
+        try:
+            return os.stat(path).st_mtime
+        except FileNotFoundError:
+            return 0.0
+
+    def reload(self) -> None:
+        """Loads new and changed config files and drops the stacks whose config file is gone.
+
+        A config that fails to load is logged, the stack keeps its previous version if it had one.
+        """
+        watched = {path: self._mtime(path) for path in self.watch}
+        reload_all = watched != self._watched
+        self._watched = watched
+        try:
+            configfiles = orchestrator.collect_configs(self.paths, exclude=self.exclude + self.watch)
+        except orchestrator.NoConfigsFound as e:
+            logger.warning(e)
+            configfiles = []
+        now = datetime.now()
+        for configfile in list(self._seen):
+            if configfile not in configfiles:
+                del self._seen[configfile]
+        with self._lock:
+            for configfile in list(self._jobs):
+                if configfile not in configfiles:
+                    logger.info(f"{configfile} is gone, {self._jobs[configfile].name} isn't scheduled anymore")
+                    del self._jobs[configfile]
+        for configfile in configfiles:
+            mtime = self._mtime(configfile)
+            if self._seen.get(configfile) == mtime and not reload_all:
+                continue
+            self._seen[configfile] = mtime
+            try:
+                name, schedule, payload = self.load(configfile)
+                if not schedule:
+                    logger.info(f"{name} has no schedule, it isn't run by the scheduler")
+                    with self._lock:
+                        self._jobs.pop(configfile, None)
+                    continue
+                cron = CronExpression(schedule)
+                next_run = cron.next_after(now)
+            except Exception as e:
+                logger.error(f"Couldn't load {configfile}: {type(e).__name__}: {e}")
+                continue
+            with self._lock:
+                job = self._jobs.get(configfile)
+                if job:
+                    if job.cron.expression != schedule:
+                        job.next_run = next_run
+                    job.name, job.cron, job.payload = name, cron, payload
+                else:
+                    job = Job(configfile, name, cron, payload, next_run)
+                    self._jobs[configfile] = job
+            logger.info(f"Loaded {name} ({schedule}), next run at {job.next_run:%Y-%m-%d %H:%M}")
+
+    def _worker(self, job: Job) -> None:
+        with self._lock:
+            job.queued = False
+            job.running = True
+            job.last_started = datetime.now()
+            payload = job.payload
+        threading.current_thread().name = job.name
+        try:
+            self.run(payload)
+        except Exception as e:
+            logger.debug(traceback.format_exc())
+            outcome, error = "failure", f"{type(e).__name__}: {e}"
+        else:
+            outcome, error = "success", ""
+        with self._lock:
+            job.running = False
+            job.last_finished = datetime.now()
+            job.last_outcome, job.last_error = outcome, error
+            self._active -= 1
+            # counted separately from the jobs, a stack whose config was removed may still be running
+            idle = self._active == 0
+        # outside the lock, closing ssh connections must not hold up the ticks and the start of other stacks
+        if self.on_idle and idle:
+            self.on_idle()
+
+    def run_due(self, now: datetime = None) -> List[str]:
+        """Queues every stack that is due.
+
+        Args:
+            now (datetime, optional): The current time. Defaults to now.
+
+        Returns:
+            List[str]: The names of the queued stacks.
+        """
+        now = now or datetime.now()
+        queued = []
+        with self._lock:
+            for job in self._jobs.values():
+                if job.next_run > now:
+                    continue
+                job.next_run = job.cron.next_after(now)
+                if job.running or job.queued:
+                    job.skipped += 1
+                    logger.warning(f"{job.name} is due but its last run hasn't finished, skipping it")
+                    continue
+                job.queued = True
+                self._active += 1
+                self._pool.submit(self._worker, job)
+                queued.append(job.name)
+        return queued
+
+    def status(self) -> dict:
+        """Returns the state of the scheduler: queue depth, running stacks and the next run of every stack."""
+        with self._lock:
+            stacks = sorted((j.status() for j in self._jobs.values()), key=lambda s: s["next_run"])
+        return {
+            "started": self.started.isoformat(timespec="seconds"),
+            "workers": self.jobs,
+            "queue_depth": sum(s["queued"] for s in stacks),
+            "running": [s["name"] for s in stacks if s["running"]],
+            "stacks": stacks,
+        }
+
+    def _sleep_time(self, now: datetime) -> float:
+        with self._lock:
+            next_runs = [j.next_run for j in self._jobs.values()]
+        seconds = self.reload_interval
+        if next_runs:
+            seconds = min(seconds, (min(next_runs) - now).total_seconds())
+        return max(0.0, seconds)
+
+    def serve_forever(self, status_socket: str = None) -> None:
+        """Schedules the stacks until stop() is called. Running stacks are waited for before returning.
+
+        Args:
+            status_socket (str, optional): Path of a unix socket that answers every connection with status() as JSON. Defaults to None.
+        """
+        server = self._start_status_server(status_socket) if status_socket else None
+        last_reload = None
+        try:
+            while not self._stop.is_set():
+                now = datetime.now()
+                if last_reload is None or (now - last_reload).total_seconds() >= self.reload_interval:
+                    self.reload()
+                    last_reload = now
+                self.run_due(now)
+                self._stop.wait(self._sleep_time(datetime.now()))
+        finally:
+            if server:
+                server.shutdown()
+                server.server_close()
+                os.unlink(status_socket)
+            logger.info("Waiting for running stacks to finish")
+            self._pool.shutdown(wait=True)
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _start_status_server(self, path: str) -> socketserver.BaseServer:
+        scheduler = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                self.wfile.write(json.dumps(scheduler.status(), indent=2).encode() + b"\n")
+
+        if os.path.exists(path):
+            os.unlink(path)  # left over from a daemon that didn't shut down cleanly
+        server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        os.chmod(path, 0o660)
+        threading.Thread(target=server.serve_forever, name="status", daemon=True).start()
+        logger.info(f"Status socket listening on {path}")
+        return server
+
+
+def query_status(path: str) -> dict:
+    """Reads the status of a running scheduler from its status socket.
+
+    Args:
+        path (str): The status socket
+
+    Returns:
+        dict: The status
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        chunks = []
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return json.loads(b"".join(chunks))
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,320 @@
+import contextlib
+import hashlib
+import logging
+import os
+import shlex
+import socket
+import subprocess
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Dict, List
+import sshmux
+from units import parse_duration
+
+logger = logging.getLogger(__name__)
+
+PATH = ".dcborgbackup-slots"  # relative to the home of the borguser on the borgserver
+PRIORITY = 50
+TIMEOUT = 2 * 3600
+POLL = 15
+STALE = 600
+SSH_TIMEOUT = 30
+
+# Runs on the borgserver, one ssh call per operation. A queue entry is a file named <99 - priority>.<time queued>.<repo key>.<token>,
+# sorted by name the entries are in the order slots are handed out, it holds the time of its last poll. A slot is a directory, mkdir
+# is atomic, its 'owner' file holds the token of the run and the time of its last heartbeat. Entries and slots whose heartbeat is
+# older than 'stale' seconds belong to crashed runs and are removed by the next poll. Only the server's clock is used, so the clocks
+# of the hosts don't matter.
+SCRIPT = """
+op=$1; dir=$2; stale=$3; shift 3
+mkdir -p "$dir/queue" "$dir/slots" || exit 3
+now=$(date +%s)
+case $op in
+enqueue)
+    entry="$1.$(printf %012d "$now").$2.$3"
+    echo "$now" > "$dir/queue/$entry" || exit 3
+    echo "entry $entry" ;;
+poll)
+    echo "$now" > "$dir/queue/$1" || exit 3
+    for f in "$dir"/queue/*; do
+        [ -f "$f" ] || continue
+        t=$(cat "$f" 2>/dev/null)
+        if [ $((now - ${t:-0})) -gt "$stale" ]; then rm -f "$f"; else echo "queue ${f##*/}"; fi
+    done
+    for s in "$dir"/slots/*; do
+        [ -d "$s" ] || continue
+        owner=-; t=$now
+        [ -f "$s/owner" ] && read -r owner t < "$s/owner"
+        if [ $((now - ${t:-0})) -gt "$stale" ]; then rm -rf "$s"; else echo "slot ${s##*/} $owner"; fi
+    done ;;
+take)
+    entry=$1; token=$2; shift 2; taken=""
+    for s in "$@"; do
+        if mkdir "$dir/slots/$s" 2>/dev/null; then
+            echo "$token $now" > "$dir/slots/$s/owner"; taken="$taken $s"
+        else
+            for t in $taken; do rm -rf "$dir/slots/$t"; done
+            echo busy; exit 0
+        fi
+    done
+    rm -f "$dir/queue/$entry"; echo taken ;;
+beat)
+    token=$1; shift
+    for s in "$@"; do
+        owner=-; [ -f "$dir/slots/$s/owner" ] && read -r owner t < "$dir/slots/$s/owner"
+        if [ "$owner" = "$token" ]; then echo "$token $now" > "$dir/slots/$s/owner"; else echo "lost $s"; fi
+    done ;;
+release)
+    token=$1; entry=$2; shift 2
+    rm -f "$dir/queue/$entry"
+    for s in "$@"; do
+        owner=-; [ -f "$dir/slots/$s/owner" ] && read -r owner t < "$dir/slots/$s/owner"
+        [ "$owner" = "$token" ] && rm -rf "$dir/slots/$s"
+    done ;;
+esac
+exit 0
+"""
+
+
+class SlotTimeout(Exception):
+    pass
+
+
+class CoordinationError(ConnectionError):
+    pass
+
+
+@dataclass
+class Wait:
+    """How long a run queued for an upload slot on a borgserver."""
+
+    server: str
+    repo: str
+    seconds: float = 0.0
+    ahead: int = 0
+    priority: int = PRIORITY
+
+    def summary(self) -> str:
+        return f"Queue: waited {self.seconds:.0f}s for an upload slot on {self.server}:{self.repo} ({self.ahead} runs ahead)."
+
+
+@dataclass
+class QueueState:
+    """What a poll saw in the lock directory: the queue in the order slots are handed out and the taken slots."""
+
+    queue: List[str]
+    taken: Dict[str, str]
+
+
+def settings(value) -> dict:
+    """Turns the 'coordination' part of the configuration into the lock directory, the slots, the priority and the timeouts.
+
+    Args:
+        value (dict): True or f.ex. {"max_per_server": 2, "max_per_repo": 1, "priority": 80, "timeout": "1h"}
+
+    Raises:
+        ValueError: Raised if a key is unknown, a number is out of range or a duration can't be parsed.
+
+    Returns:
+        dict: The settings with defaults applied, durations in seconds.
+    """
+    value = value if isinstance(value, dict) else {}
+    keys = ("path", "max_per_server", "max_per_repo", "priority", "timeout", "poll", "stale")
+    unknown = [k for k in value if k not in keys]
+    if unknown:
+        raise ValueError(f"unknown keys {', '.join(unknown)}")
+    result = {
+        "path": str(value.get("path", PATH)),
+        "max_per_server": int(value.get("max_per_server", 2)),
+        "max_per_repo": int(value.get("max_per_repo", 1)),
+        "priority": int(value.get("priority", PRIORITY)),
+        "timeout": parse_duration(value.get("timeout", TIMEOUT)),
+        "poll": parse_duration(value.get("poll", POLL)),
+        "stale": parse_duration(value.get("stale", STALE)),
+    }
+    if result["max_per_server"] < 1 or result["max_per_repo"] < 1:
+        raise ValueError("max_per_server and max_per_repo need to be at least 1")
+    if not 0 <= result["priority"] <= 99:
+        raise ValueError("priority needs to be between 0 and 99")
+    if result["stale"] < 3 * result["poll"]:
+        raise ValueError("stale needs to be at least three times poll, or waiting runs would be taken for crashed ones")
+    return result
+
+
+def repo_key(repo: str) -> str:
+    """Returns a short name for a repo that can be part of a file name, repos may contain slashes."""
+    return hashlib.blake2b(repo.encode(), digest_size=6).hexdigest()
+
+
+def parse(output: str) -> QueueState:
+    """Parses the output of the 'poll' operation of SCRIPT."""
+    state = QueueState([], {})
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) >= 2 and parts[0] == "queue":
+            state.queue.append(parts[1])
+        elif len(parts) >= 3 and parts[0] == "slot":
+            state.taken[parts[1]] = parts[2]
+    state.queue.sort()
+    return state
+
+
+def free_slots(state: QueueState, settings: dict, key: str) -> tuple:
+    """Returns the names of the free server slots and of the free slots of the repo with repo_key() 'key'."""
+    server = [f"server.{i}" for i in range(settings["max_per_server"]) if f"server.{i}" not in state.taken]
+    repos = [f"repo.{key}.{i}" for i in range(settings["max_per_repo"]) if f"repo.{key}.{i}" not in state.taken]
+    return server, repos
+
+
+def turn(state: QueueState, settings: dict, entry: str, repo: str) -> tuple:
+    """Decides whether the run queued as 'entry' may take a slot now.
+
+    The entries ahead of it come first, except the ones waiting for a repo whose slots are all taken, they don't hold up runs for
+    other repos.
+
+    Returns:
+        tuple: (the server slot and the repo slot to take or None, the number of runs ahead)
+    """
+    key = repo_key(repo)
+    server, repos = free_slots(state, settings, key)
+    ahead = state.queue[: state.queue.index(entry)] if entry in state.queue else state.queue
+    startable = 0
+    same_repo = 0
+    for other in ahead:
+        other_key = other.split(".")[2]
+        if other_key == key:
+            same_repo += 1
+            startable += 1
+        elif free_slots(state, settings, other_key)[1]:
+            startable += 1
+    if len(server) > startable and len(repos) > same_repo:
+        return (server[startable], repos[same_repo]), len(ahead)
+    return None, len(ahead)
+
+
+class Slot:
+    """An upload slot on a borgserver for a repo, handed out through a lock directory on the server that every host backing up to it
+    uses, reached with the ssh login of borg.
+
+    Args:
+        settings (dict): The result of settings()
+        user (str): The borguser
+        server (str): The borgserver
+        repo (str): The borgrepo
+        ssh_options (str, optional): f.ex. the port or the options of the ssh master connection. Defaults to none.
+    """
+
+    def __init__(self, settings: dict, user: str, server: str, repo: str, ssh_options: str = ""):
+        self.settings = settings
+        self.destination = f"{user}@{server}"
+        self.ssh_options = ssh_options
+        self.wait = Wait(server, repo, priority=settings["priority"])
+        host = "".join(c if c.isalnum() or c == "-" else "-" for c in socket.gethostname())
+        self.token = f"{host}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.entry = None
+        self.held = []
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def _call(self, op: str, *args: str) -> str:
+        remote = " ".join(
+            shlex.quote(a) for a in ["sh", "-c", SCRIPT, "slots", op, self.settings["path"], str(int(self.settings["stale"])), *args]
+        )
+        cmd = ["ssh", "-o", "BatchMode=yes", "-o", "ConnectTimeout=5", *shlex.split(self.ssh_options), self.destination, remote]
+        logger.debug(f"Slots on {self.destination}: {op} {' '.join(args)}")
+        try:
+            result = subprocess.run(cmd, stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=SSH_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            raise CoordinationError(f"Couldn't reach the slots on {self.destination}: {e}")
+        if result.returncode != 0:
+            raise CoordinationError(
+                f"Couldn't {op} a slot on {self.destination} in {self.settings['path']}: {result.stderr.strip()}"
+            )
+        return result.stdout
+
+    def acquire(self) -> Wait:
+        """Queues for a slot and waits until it's this run's turn and the slot is taken.
+
+        Raises:
+            SlotTimeout: Raised if no slot was free within 'timeout'.
+            CoordinationError: Raised if the lock directory couldn't be reached over ssh.
+
+        Returns:
+            Wait: How long the run waited and how many runs were ahead of it.
+        """
+        start = time.monotonic()
+        first = True
+        # queued with the time of the server, the clocks of the hosts don't matter
+        output = self._call("enqueue", f"{99 - self.settings['priority']:02d}", repo_key(self.wait.repo), self.token)
+        self.entry = output.split()[-1]
+        while True:
+            state = parse(self._call("poll", self.entry))
+            slots, ahead = turn(state, self.settings, self.entry, self.wait.repo)
+            if first:
+                self.wait.ahead = ahead
+                first = False
+            if slots and self._call("take", self.entry, self.token, *slots).strip() == "taken":
+                self.held = list(slots)
+                break
+            waited = time.monotonic() - start
+            if waited + self.settings["poll"] > self.settings["timeout"]:
+                self._call("release", self.token, self.entry)
+                raise SlotTimeout(
+                    f"No upload slot on {self.destination} for {self.wait.repo} after {waited:.0f}s, {ahead} runs ahead"
+                )
+            time.sleep(self.settings["poll"])
+        self.wait.seconds = time.monotonic() - start
+        self._stop.clear()
+        self._heartbeat = threading.Thread(
+            target=self._beat, name=f"{threading.current_thread().name}/slot", daemon=True
+        )
+        self._heartbeat.start()
+        return self.wait
+
+    def _beat(self) -> None:
+        # well within 'stale', a missed heartbeat or two doesn't lose the slot
+        while not self._stop.wait(self.settings["stale"] / 4):
+            try:
+                lost = [line for line in self._call("beat", self.token, *self.held).splitlines() if line.startswith("lost")]
+            except CoordinationError as e:
+                logger.warning(str(e))
+                continue
+            if lost:
+                logger.warning(f"Upload slot on {self.destination} was taken over: {', '.join(lost)}")
+
+    def release(self) -> None:
+        """Frees the slot, a run that crashed loses it after 'stale' seconds."""
+        self._stop.set()
+        if self._heartbeat:
+            self._heartbeat.join()
+            self._heartbeat = None
+        try:
+            self._call("release", self.token, self.entry, *self.held)
+        except CoordinationError as e:
+            logger.warning(f"{e}, the slot is freed after {self.settings['stale']:.0f}s")
+        self.held = []
+
+
+@contextlib.contextmanager
+def held(settings: dict, **kwargs):
+    """Holds an upload slot for the borgserver and borgrepo of 'kwargs' (a target's configuration).
+
+    Args:
+        settings (dict): The result of settings()
+
+    Yields:
+        Wait: How long the run waited for the slot.
+    """
+    options = sshmux.client_options(kwargs.get("ssh_port", 22), kwargs.get("ssh_master"))
+    slot = Slot(settings, kwargs["borguser"], kwargs["borgserver"], kwargs["borgrepo"], options)
+    wait = slot.acquire()
+    try:
+        yield wait
+    finally:
+        slot.release()
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,224 @@
+import abc
+import contextlib
+import logging
+import os
+from cmdrunner import cmd_run
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class Snapshot(abc.ABC):
+    """Base class of the snapshot backends.
+
+    A backend takes a read-only snapshot of the volume containing 'rootfolder/foldername' and
+    returns the path the folder can be read from inside the snapshot. The snapshot name is the
+    same on every run, so borg's files cache keeps working between runs.
+    """
+
+    def __init__(self, source: str, name: str, debug: bool = False, **options):
+        self.source = source.rstrip("/")
+        self.name = f"dcborgbackup-{name}"
+        self.snapshot = self.name
+        self.debug = debug
+        self.options = options
+
+    def _run(self, cmd: str, check: bool = True):
+        result = cmd_run(cmd, debug=self.debug)
+        if check and result.returncode != 0:
+            raise SnapshotError(f"Error running '{cmd}': {result.stdout}")
+        return result
+
+    def _relpath(self, volume_root: str) -> str:
+        """Returns the path of the source relative to the root of its volume.
+
+        Args:
+            volume_root (str): Where the volume (subvolume, LV, dataset) is mounted.
+
+        Raises:
+            SnapshotError: Raised if the source doesn't live on the volume.
+
+        Returns:
+            str: The relative path, '.' if the source is the volume root.
+        """
+        rel = os.path.relpath(self.source, volume_root.rstrip("/"))
+        if rel.startswith(".."):
+            raise SnapshotError(f"{self.source} is not on the volume at {volume_root}")
+        return rel
+
+    @abc.abstractmethod
+    def exists(self) -> bool:
+        """Tells whether the snapshot exists, f.ex. left over from a run that crashed."""
+
+    @abc.abstractmethod
+    def create(self) -> str:
+        """Takes the snapshot and returns the path the source can be read from inside it."""
+
+    @abc.abstractmethod
+    def remove(self) -> None:
+        """Removes the snapshot."""
+
+
+class BtrfsSnapshot(Snapshot):
+    """Read-only btrfs subvolume snapshot.
+
+    Options:
+        path: Folder on the same filesystem the snapshot is created in.
+        subvolume: The subvolume containing the source. Defaults to the source itself.
+    """
+
+    def __init__(self, source: str, name: str, debug: bool = False, **options):
+        super().__init__(source, name, debug, **options)
+        self.subvolume = options.get("subvolume", self.source).rstrip("/")
+        self.snapshot = os.path.join(options["path"], self.name)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.snapshot)
+
+    def create(self) -> str:
+        rel = self._relpath(self.subvolume)
+        self._run(f"btrfs subvolume snapshot -r {self.subvolume} {self.snapshot}")
+        return os.path.normpath(os.path.join(self.snapshot, rel))
+
+    def remove(self) -> None:
+        self._run(f"btrfs subvolume delete {self.snapshot}")
+
+
+class LvmThinSnapshot(Snapshot):
+    """LVM thin snapshot, mounted read-only.
+
+    Options:
+        volume: The thin logical volume containing the source, f.ex. vg0/docker.
+        mountpoint: Where that logical volume is mounted.
+        snapshot_mountpoint: Where the snapshot gets mounted.
+        mount_options: Defaults to 'ro', use 'ro,nouuid' for xfs.
+    """
+
+    def __init__(self, source: str, name: str, debug: bool = False, **options):
+        super().__init__(source, name, debug, **options)
+        self.vg = options["volume"].split("/")[0]
+        self.volume = options["volume"]
+        self.mountpoint = options["mountpoint"]
+        self.snapshot_mountpoint = options["snapshot_mountpoint"]
+        self.mount_options = options.get("mount_options", "ro")
+        self.snapshot = f"{self.vg}/{self.name}"
+
+    def exists(self) -> bool:
+        if os.path.ismount(self.snapshot_mountpoint):
+            return True
+        return self._run(f"lvs {self.snapshot}", check=False).returncode == 0
+
+    def create(self) -> str:
+        rel = self._relpath(self.mountpoint)
+        self._run(f"lvcreate -s -n {self.name} {self.volume}")
+        self._run(f"lvchange -ay -K {self.snapshot}")
+        os.makedirs(self.snapshot_mountpoint, exist_ok=True)
+        self._run(
+            f"mount -o {self.mount_options} /dev/{self.snapshot} {self.snapshot_mountpoint}"
+        )
+        return os.path.normpath(os.path.join(self.snapshot_mountpoint, rel))
+
+    def remove(self) -> None:
+        if os.path.ismount(self.snapshot_mountpoint):
+            self._run(f"umount {self.snapshot_mountpoint}")
+        if self._run(f"lvs {self.snapshot}", check=False).returncode == 0:
+            self._run(f"lvremove -f {self.snapshot}")
+
+
+class ZfsSnapshot(Snapshot):
+    """ZFS snapshot, read through the dataset's .zfs/snapshot folder.
+
+    Options:
+        dataset: The dataset containing the source, f.ex. tank/docker.
+        mountpoint: Where that dataset is mounted.
+    """
+
+    def __init__(self, source: str, name: str, debug: bool = False, **options):
+        super().__init__(source, name, debug, **options)
+        self.dataset = options["dataset"]
+        self.mountpoint = options["mountpoint"]
+        self.snapshot = f"{self.dataset}@{self.name}"
+
+    def exists(self) -> bool:
+        return (
+            self._run(f"zfs list -H -t snapshot {self.snapshot}", check=False).returncode
+            == 0
+        )
+
+    def create(self) -> str:
+        rel = self._relpath(self.mountpoint)
+        self._run(f"zfs snapshot {self.snapshot}")
+        return os.path.normpath(
+            os.path.join(self.mountpoint, ".zfs", "snapshot", self.name, rel)
+        )
+
+    def remove(self) -> None:
+        self._run(f"zfs destroy {self.snapshot}")
+
+
+BACKENDS = {"btrfs": BtrfsSnapshot, "lvm": LvmThinSnapshot, "zfs": ZfsSnapshot}
+
+
+def from_config(**kwargs) -> Snapshot:
+    """Creates the snapshot backend requested in the 'snapshot' part of the configuration.
+
+    Raises:
+        ValueError: Raised if the snapshot type is unknown.
+        KeyError: Raised if an option the backend needs is missing.
+
+    Returns:
+        Snapshot: The backend for this stack.
+    """
+    options = dict(kwargs["snapshot"])
+    kind = options.pop("type", None)
+    if kind not in BACKENDS:
+        raise ValueError(
+            f"Unknown snapshot type {kind}, has to be one of {', '.join(BACKENDS)}"
+        )
+    source = f"{kwargs['rootfolder']}{kwargs['foldername']}"
+    return BACKENDS[kind](source, kwargs["foldername"], kwargs["debug"], **options)
+
+
+@contextlib.contextmanager
+def taken(snap: Snapshot):
+    """Takes the snapshot and yields the path to read the source from. The snapshot is removed afterwards, even if the body fails.
+
+    A snapshot left over by an earlier run that crashed is removed first.
+
+    Args:
+        snap (Snapshot): The backend.
+
+    Raises:
+        SnapshotError: Raised if the snapshot can't be taken, or can't be removed after a successful body.
+    """
+    if snap.exists():
+        logger.warning(f"Removing stale snapshot {snap.snapshot}")
+        snap.remove()
+    logger.info(f"Taking snapshot {snap.snapshot} of {snap.source}")
+    try:
+        path = snap.create()
+    except Exception:
+        _remove_quietly(snap)
+        raise
+    try:
+        yield path
+    except Exception:
+        _remove_quietly(snap)
+        raise
+    logger.info(f"Removing snapshot {snap.snapshot}")
+    snap.remove()
+
+
+def _remove_quietly(snap: Snapshot) -> None:
+    """Removes a snapshot while another error is being handled, without masking that error."""
+    try:
+        snap.remove()
+    except Exception as e:
+        logger.error(f"Couldn't remove snapshot {snap.snapshot}: {e}")
+
+
+if __name__ == "__main__":
+    pass
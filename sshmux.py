@@ -0,0 +1,201 @@
+import logging
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from cmdrunner import cmd_run
+
+logger = logging.getLogger(__name__)
+
+
+def port_option(port: int) -> str:
+    """Returns the ssh option selecting 'port', none for port 22 so a Port set in ~/.ssh/config still applies."""
+    return "" if int(port) == 22 else f"-p {int(port)}"
+
+
+def client_options(port: int, master: "SSHMaster" = None) -> str:
+    """Returns the ssh options of a connection to the borgserver: the options of its master if it's open, else just the port.
+
+    Args:
+        port (int): The ssh_port of the target
+        master (SSHMaster, optional): The master connection to the borgserver. Defaults to none.
+
+    Returns:
+        str: ssh options
+    """
+    if master and master.is_open:
+        return master.options()
+    return port_option(port)
+
+
+class SSHMaster:
+    """One multiplexed ssh connection (ControlMaster) to borguser@borgserver.
+
+    Every ssh connection made with the options of this master reuses its session instead of doing a full key exchange.
+    """
+
+    def __init__(self, user: str, server: str, port: int = 22, debug: bool = False):
+        self.user = user
+        self.server = server
+        self.port = port
+        self.debug = debug
+        # the socket lives in a directory of its own, created by open(), so masters of other processes are never reused or closed
+        self.control_dir = None
+        self.control_path = None
+        self.is_open = False
+        self.handshake = 0.0
+        self.sessions = 0
+        self._lock = threading.Lock()
+
+    @property
+    def destination(self) -> str:
+        return f"{self.user}@{self.server}"
+
+    def options(self) -> str:
+        """Returns the ssh options to use the master and counts the connection.
+
+        Returns:
+            str: ssh options, empty if the master isn't open.
+        """
+        if not self.is_open:
+            return ""
+        with self._lock:
+            self.sessions += 1
+        # the port is part of %C, every connection has to name it like the master did
+        return f"{port_option(self.port)} -o ControlPath={self.control_path} -o ControlMaster=no".strip()
+
+    def rsh(self) -> str:
+        """Returns the ssh command borg uses to connect (BORG_RSH).
+
+        Returns:
+            str: The command, 'ssh' with the master's options.
+        """
+        return f"ssh {self.options()}".strip()
+
+    def open(self) -> bool:
+        """Opens the master connection in the background and measures the handshake.
+
+        Returns:
+            bool: True if the master is open, False otherwise.
+        """
+        self.control_dir = tempfile.mkdtemp(prefix="dcborgbackup-ssh-")
+        # %C is a hash of local host, remote host, port and user, it keeps the socket path short
+        self.control_path = os.path.join(self.control_dir, "%C")
+        cmd = [
+            "ssh",
+            "-f",
+            "-N",
+            "-M",
+            "-o",
+            f"ControlPath={self.control_path}",
+            "-o",
+            "ControlPersist=yes",
+            "-o",
+            "BatchMode=yes",
+            "-o",
+            "ConnectTimeout=5",
+            *shlex.split(port_option(self.port)),
+            self.destination,
+        ]
+        if self.debug:
+            cmd_run(" ".join(cmd), debug=True)
+            self._remove_control_dir()
+            return False
+        start = time.monotonic()
+        # the master keeps running in the background, its output must not be piped or we'd wait for it
+        with tempfile.TemporaryFile() as err:
+            result = subprocess.run(
+                cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=err
+            )
+            err.seek(0)
+            stderr = err.read().decode(errors="replace").strip()
+        if result.returncode != 0:
+            logger.warning(
+                f"Couldn't open ssh master connection to {self.destination}, continuing without: {stderr}"
+            )
+            self._remove_control_dir()
+            return False
+        self.handshake = time.monotonic() - start
+        self.is_open = True
+        logger.info(
+            f"Opened ssh master connection to {self.destination} in {self.handshake:.2f}s"
+        )
+        return True
+
+    def close(self) -> None:
+        """Closes the master connection."""
+        if not self.is_open:
+            return
+        cmd = f"ssh {port_option(self.port)} -o ControlPath={self.control_path} -O exit {self.destination}"
+        result = cmd_run(cmd, debug=self.debug)
+        if result.returncode != 0:
+            logger.warning(f"Couldn't close ssh master connection to {self.destination}")
+        self.is_open = False
+        self._remove_control_dir()
+
+    def _remove_control_dir(self) -> None:
+        if self.control_dir:
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+            self.control_dir = None
+
+    def summary(self) -> str:
+        return (
+            f"SSH: handshake to {self.server} took {self.handshake:.1f}s, reused for {self.sessions} connections, "
+            f"saved about {self.handshake * self.sessions:.0f}s."
+        )
+
+
+class MasterPool:
+    """Hands out one SSHMaster per borguser@borgserver and port, shared by all runs using the pool."""
+
+    def __init__(self):
+        self._masters = {}
+        self._opening = {}
+        self._lock = threading.Lock()
+
+    def get(self, user: str, server: str, port: int = 22, debug: bool = False) -> SSHMaster:
+        """Returns the master for user@server, it is opened on first use.
+
+        Args:
+            user (str): The borguser
+            server (str): The borgserver
+            port (int, optional): The ssh_port of the borgserver. Defaults to 22.
+            debug (bool, optional): Only echo the ssh commands. Defaults to False.
+
+        Returns:
+            SSHMaster: The master, it isn't open if the connection failed.
+        """
+        key = (str(user), server, int(port), debug)
+        with self._lock:
+            if key in self._masters:
+                return self._masters[key]
+            opening = self._opening.setdefault(key, threading.Lock())
+        # the handshake only holds up runs to the same server, not the whole pool
+        with opening:
+            with self._lock:
+                if key in self._masters:
+                    return self._masters[key]
+            master = SSHMaster(user, server, port, debug)
+            master.open()
+            with self._lock:
+                self._masters[key] = master
+            return master
+
+    def summaries(self) -> list:
+        """Returns the summary of every master that was open."""
+        with self._lock:
+            return [m.summary() for m in self._masters.values() if m.is_open]
+
+    def close(self) -> None:
+        """Closes all masters."""
+        with self._lock:
+            for master in self._masters.values():
+                master.close()
+            self._masters = {}
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,271 @@
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import stat
+import time
+from dataclasses import dataclass
+from shutil import which
+from cmdrunner import cmd_run
+from units import format_size
+
+logger = logging.getLogger(__name__)
+
+# ioctl to share the extents of one file with another (reflink) on btrfs/xfs, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+METHODS = ["builtin", "rsync"]
+
+
+class StagingError(Exception):
+    pass
+
+
+@dataclass
+class SyncStats:
+    """What a sync did and how big the staging copy is afterwards."""
+
+    duration: float = 0.0
+    files_copied: int = 0
+    bytes_copied: int = 0
+    files_linked: int = 0
+    files_deleted: int = 0
+    disk_usage: int = 0
+
+    def summary(self) -> str:
+        return (
+            f"Staging: synced in {self.duration:.0f}s, {self.files_copied} files ({format_size(self.bytes_copied)}) copied, "
+            f"{self.files_deleted} deleted, staging copy uses {format_size(self.disk_usage)}."
+        )
+
+
+def staging_folder(**kwargs) -> str:
+    """Returns the folder holding the staging copy of this stack. It's the same on every run so each sync stays cheap.
+
+    Returns:
+        str: <staging.path>/<foldername>
+    """
+    return os.path.join(kwargs["staging"]["path"], kwargs["foldername"])
+
+
+def _copy_file(src: str, dest: str) -> None:
+    """Copies a file, as a reflink if the filesystem supports it.
+
+    The file is written to a temporary name first, so an interrupted sync never leaves a half-written file behind under the real name.
+
+    Args:
+        src (str): The source file
+        dest (str): The destination file
+    """
+    tmp = f"{dest}.dcborgbackup-tmp"
+    with open(src, "rb") as fsrc, open(tmp, "wb") as fdest:
+        try:
+            fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+        except OSError as e:
+            if e.errno not in (
+                errno.EOPNOTSUPP,
+                errno.ENOTTY,
+                errno.EXDEV,
+                errno.EINVAL,
+                errno.ENOSYS,
+            ):
+                raise
+            shutil.copyfileobj(fsrc, fdest, 1024 * 1024)
+    _copy_metadata(src, tmp, os.lstat(src))
+    os.replace(tmp, dest)
+
+
+def _copy_metadata(src: str, dest: str, st: os.stat_result) -> None:
+    if os.geteuid() == 0:
+        os.lchown(dest, st.st_uid, st.st_gid)
+    if not stat.S_ISLNK(st.st_mode):
+        os.chmod(dest, stat.S_IMODE(st.st_mode))
+        os.utime(dest, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+def _remove(path: str) -> int:
+    """Removes a file or a directory tree and returns the number of entries removed, like rsync counts deletions."""
+    if os.path.isdir(path) and not os.path.islink(path):
+        count = 1 + sum(len(dirnames) + len(filenames) for _, dirnames, filenames in os.walk(path))
+        shutil.rmtree(path)
+        return count
+    os.unlink(path)
+    return 1
+
+
+def _sync_builtin(src: str, dest: str, stats: SyncStats) -> None:
+    """Incrementally mirrors 'src' to 'dest'.
+
+    Files whose size and mtime didn't change are skipped, hardlinks are kept as hardlinks and new or changed files are reflinked where possible.
+    Sockets, fifos and devices are skipped.
+
+    Args:
+        src (str): The source folder
+        dest (str): The staging folder
+        stats (SyncStats): Updated with what was done.
+    """
+    links = {}
+    dirs = []
+
+    def walk(s: str, d: str) -> None:
+        st = os.lstat(s)
+        if not os.path.isdir(d) or os.path.islink(d):
+            if os.path.lexists(d):
+                _remove(d)
+            os.mkdir(d)
+        dirs.append((s, d, st))
+        present = set()
+        with os.scandir(s) as it:
+            for entry in it:
+                target = os.path.join(d, entry.name)
+                est = entry.stat(follow_symlinks=False)
+                # sockets, fifos and devices aren't present in the copy, an entry of the same name left in it is removed
+                if entry.is_dir(follow_symlinks=False) or entry.is_symlink() or entry.is_file(follow_symlinks=False):
+                    present.add(entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    walk(entry.path, target)
+                elif entry.is_symlink():
+                    link = os.readlink(entry.path)
+                    if os.path.islink(target) and os.readlink(target) == link:
+                        continue
+                    if os.path.lexists(target):
+                        _remove(target)
+                    os.symlink(link, target)
+                    _copy_metadata(entry.path, target, est)
+                elif entry.is_file(follow_symlinks=False):
+                    _sync_file(entry.path, target, est)
+        with os.scandir(d) as it:
+            for entry in it:
+                if entry.name not in present:
+                    stats.files_deleted += _remove(entry.path)
+
+    def _sync_file(s: str, d: str, st: os.stat_result) -> None:
+        key = (st.st_dev, st.st_ino)
+        if st.st_nlink > 1 and key in links:
+            first = links[key]
+            try:
+                same = os.path.samefile(first, d)
+            except FileNotFoundError:
+                same = False
+            if not same:
+                if os.path.lexists(d):
+                    _remove(d)
+                os.link(first, d)
+                stats.files_linked += 1
+            return
+        if st.st_nlink > 1:
+            links[key] = d
+        try:
+            dst = os.lstat(d)
+        except FileNotFoundError:
+            dst = None
+        if (
+            dst is not None
+            and stat.S_ISREG(dst.st_mode)
+            and dst.st_size == st.st_size
+            and dst.st_mtime_ns == st.st_mtime_ns
+        ):
+            return
+        if dst is not None and not stat.S_ISREG(dst.st_mode):
+            _remove(d)
+        _copy_file(s, d)
+        stats.files_copied += 1
+        stats.bytes_copied += st.st_size
+
+    walk(src, dest)
+    # directory mtimes change while their content is synced, so they are set last
+    for s, d, st in reversed(dirs):
+        _copy_metadata(s, d, st)
+
+
+def _sync_rsync(src: str, dest: str, stats: SyncStats, debug: bool = False) -> None:
+    """Mirrors 'src' to 'dest' with rsync, keeping hardlinks.
+
+    Args:
+        src (str): The source folder
+        dest (str): The staging folder
+        stats (SyncStats): Updated with what was done.
+        debug (bool, optional): Only echo the rsync command. Defaults to False.
+
+    Raises:
+        StagingError: Raised if rsync isn't installed or fails.
+    """
+    if not debug and not which("rsync"):
+        raise StagingError("staging method rsync requested, but rsync isn't installed")
+    os.makedirs(dest, exist_ok=True)
+    cmd = f"rsync -aH --delete --numeric-ids --stats {src}/ {dest}/"
+    result = cmd_run(cmd, debug=debug)
+    if result.returncode != 0:
+        raise StagingError(f"Error running rsync: {result.stdout}")
+    for line in result.stdout.splitlines():
+        if line.startswith("Number of regular files transferred:"):
+            stats.files_copied = int(line.split(":")[1].strip().replace(",", ""))
+        elif line.startswith("Total transferred file size:"):
+            stats.bytes_copied = int(
+                line.split(":")[1].strip().split()[0].replace(",", "")
+            )
+        elif line.startswith("Number of deleted files:"):
+            stats.files_deleted = int(
+                line.split(":")[1].strip().split()[0].replace(",", "")
+            )
+
+
+def disk_usage(path: str) -> int:
+    """Returns the space used by a folder in bytes, hardlinked files are counted once.
+
+    Args:
+        path (str): The folder
+
+    Returns:
+        int: Bytes allocated on disk.
+    """
+    seen = set()
+    total = 0
+    stack = [path]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                st = entry.stat(follow_symlinks=False)
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+                total += st.st_blocks * 512
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+    return total
+
+
+def sync(**kwargs) -> SyncStats:
+    """Syncs 'rootfolder/foldername' to the staging copy of this stack.
+
+    Raises:
+        StagingError: Raised if the source doesn't exist or the sync fails.
+
+    Returns:
+        SyncStats: What the sync did.
+    """
+    src = f"{kwargs['rootfolder']}{kwargs['foldername']}".rstrip("/")
+    dest = staging_folder(**kwargs)
+    method = kwargs["staging"].get("method", "builtin")
+    stats = SyncStats()
+    logger.info(f"Syncing {src} to staging copy {dest} using {method}")
+    if kwargs["debug"] and method == "builtin":
+        logger.info("debug: not syncing")
+        return stats
+    if not kwargs["debug"] and not os.path.isdir(src):
+        raise StagingError(f"{src} does not exist")
+    start = time.monotonic()
+    if method == "rsync":
+        _sync_rsync(src, dest, stats, kwargs["debug"])
+    else:
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        _sync_builtin(src, dest, stats)
+    stats.duration = time.monotonic() - start
+    if os.path.isdir(dest):
+        stats.disk_usage = disk_usage(dest)
+    logger.info(stats.summary())
+    return stats
+
+
+if __name__ == "__main__":
+    pass
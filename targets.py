@@ -0,0 +1,274 @@
+import logging
+import threading
+import time
+import traceback
+from dataclasses import dataclass, field
+from typing import Callable, List
+from borg import (
+    ArchiveResult,
+    BorgConnectionClosed,
+    BorgErrorGettingLock,
+    BorgNotInstalled,
+    NotRepokeyEncrypted,
+    PruneResult,
+    RepoDoesNotExist,
+    RepoInfo,
+    WrongRepokey,
+)
+from units import parse_duration
+
+logger = logging.getLogger(__name__)
+
+# keys a target may set, everything else is shared by all targets of a stack
+TARGET_KEYS = [
+    "name",
+    "borgserver",
+    "borgrepo",
+    "borgarchive",
+    "borg_parameters",
+    "ssh_port",
+    "repo_encrypted",
+    "retries",
+    "borg_relocated_repo_access_is_ok",
+]
+RETRY_DELAY = 30
+MAX_RETRY_DELAY = 1800
+# errors are retried by class: a repo another client holds locked, a broken connection, or errors retrying can't fix. Everything else
+# is "other".
+ERROR_CLASSES = {
+    "lock": (BorgErrorGettingLock,),
+    "network": (BorgConnectionClosed, ConnectionError, TimeoutError),
+    "permanent": (WrongRepokey, RepoDoesNotExist, NotRepokeyEncrypted, BorgNotInstalled),
+}
+
+
+class TargetsFailed(Exception):
+    pass
+
+
+@dataclass
+class TargetResult:
+    """What happened on one target during a run."""
+
+    name: str
+    borgserver: str
+    borgrepo: str
+    outcome: str = "pending"
+    failed_step: str = ""
+    error: str = ""
+    attempts: dict = field(default_factory=dict)
+    durations: dict = field(default_factory=dict)
+    repo_info: RepoInfo = None
+    archive: ArchiveResult = None
+    prune: PruneResult = None
+    upload_ratelimit: int = None
+    dumps: dict = field(default_factory=dict)
+    retries: dict = field(default_factory=dict)
+    checkpoints: list = field(default_factory=list)
+    checkpoints_deleted: list = field(default_factory=list)
+
+
+class Target:
+    """One borg repository a stack is backed up to, with its own configuration.
+
+    Args:
+        configuration (dict): The configuration of the stack with the keys of the target applied.
+        name (str): The name used in reports.
+    """
+
+    def __init__(self, configuration: dict, name: str):
+        self.configuration = configuration
+        self.name = name
+        self.result = TargetResult(name, configuration["borgserver"], configuration["borgrepo"])
+        self.exception = None
+
+    @property
+    def failed(self) -> bool:
+        return self.exception is not None
+
+    def fail(self, step: str, exception: Exception) -> None:
+        self.exception = exception
+        self.result.outcome = "failure"
+        self.result.failed_step = step
+        self.result.error = f"{type(exception).__name__}: {exception}"
+
+
+def from_config(config: dict) -> List[dict]:
+    """Builds the configuration of every target in 'config["targets"]'.
+
+    A target overrides the keys in TARGET_KEYS of the stack, borg_parameters are merged. borgrepo defaults to foldername and name to
+    borgserver, or borgserver:borgrepo if there is more than one target on a server.
+
+    Args:
+        config (dict): The parsed config file with all defaults set.
+
+    Raises:
+        ValueError: Raised if a target has no borgserver, an unknown key or a name that's used twice.
+
+    Returns:
+        List[dict]: One configuration per target.
+    """
+    if not isinstance(config["targets"], list) or not config["targets"]:
+        raise ValueError("targets needs to be a list of borgserver/borgrepo entries")
+    base = {k: v for k, v in config.items() if k != "targets"}
+    configurations = []
+    for target in config["targets"]:
+        if "borgserver" not in target:
+            raise ValueError("every target needs a borgserver")
+        unknown = [k for k in target if k not in TARGET_KEYS]
+        if unknown:
+            raise ValueError(f"unknown keys in target {target['borgserver']}: {', '.join(unknown)}")
+        configuration = {**base, "borgrepo": config["foldername"], **target}
+        configuration["borg_parameters"] = {
+            **base.get("borg_parameters", {}),
+            **target.get("borg_parameters", {}),
+        }
+        configurations.append(configuration)
+    servers = [c["borgserver"] for c in configurations]
+    for configuration in configurations:
+        if "name" not in configuration:
+            server = configuration["borgserver"]
+            configuration["name"] = server if servers.count(server) == 1 else f"{server}:{configuration['borgrepo']}"
+    names = [c["name"] for c in configurations]
+    duplicates = sorted({n for n in names if names.count(n) > 1})
+    if duplicates:
+        raise ValueError(f"target names need to be unique: {', '.join(duplicates)}")
+    return configurations
+
+
+def retry_settings(value) -> dict:
+    """Turns the 'retry' part of the configuration into the retries per error class, the backoff and borg's lock wait.
+
+    Args:
+        value (dict): True or f.ex. {"lock_wait": "10m", "network": 5, "delay": "1m", "checkpoint_interval": "10m"}, None to keep
+            borg's defaults and retry every class 'retries' times.
+
+    Raises:
+        ValueError: Raised if a key is unknown, a duration can't be parsed or a number of retries is negative.
+
+    Returns:
+        dict: The settings with defaults applied, durations in seconds. lock and network are None if 'retries' applies.
+    """
+    enabled = bool(value)
+    value = value if isinstance(value, dict) else {}
+    keys = ("lock_wait", "lock", "network", "delay", "max_delay", "checkpoint_interval", "checkpoints")
+    unknown = [k for k in value if k not in keys]
+    if unknown:
+        raise ValueError(f"unknown keys {', '.join(unknown)}")
+    result = {
+        "lock_wait": parse_duration(value["lock_wait"]) if value.get("lock_wait") else None,
+        "lock": None,
+        "network": None,
+        "delay": parse_duration(value.get("delay", RETRY_DELAY)),
+        "max_delay": parse_duration(value.get("max_delay", MAX_RETRY_DELAY)),
+        "checkpoint_interval": parse_duration(value["checkpoint_interval"]) if value.get("checkpoint_interval") else None,
+        "checkpoints": enabled and bool(value.get("checkpoints", True)),
+    }
+    for kind in ("lock", "network"):
+        if value.get(kind) is not None:
+            result[kind] = int(value[kind])
+            if result[kind] < 0:
+                raise ValueError(f"{kind} needs to be 0 or more retries")
+    return result
+
+
+def error_class(exception: Exception) -> str:
+    """Returns the class of an error in ERROR_CLASSES, "other" if it's in none of them."""
+    for kind, exceptions in ERROR_CLASSES.items():
+        if isinstance(exception, exceptions):
+            return kind
+    return "other"
+
+
+def allowed_retries(kind: str, policy: dict, retries: int) -> int:
+    """Returns how often an error of class 'kind' is retried: never if it's permanent, 'retries' unless the policy says otherwise."""
+    if kind == "permanent":
+        return 0
+    if policy.get(kind) is not None:
+        return policy[kind]
+    return retries
+
+
+def fan_out(
+    targets: List[Target],
+    step: str,
+    func: Callable[[Target], None],
+    may_retry: Callable[[], bool] = lambda: True,
+    delay: float = None,
+) -> None:
+    """Runs func(target) for every target that hasn't failed yet, each in its own thread, and waits for all of them.
+
+    An exception fails only its target. A target is tried again as often as its 'retry' policy allows for the class of the error (see
+    allowed_retries()), the delay doubling every time up to 'max_delay', as long as may_retry() says so (f.ex. not while the stack is
+    down).
+
+    Args:
+        targets (List[Target]): The targets.
+        step (str): The name of the step, f.ex. create
+        func (Callable[[Target], None]): Does the step for one target, raises on failure.
+        may_retry (Callable[[], bool], optional): Asked before every retry. Defaults to always.
+        delay (float, optional): Seconds before the first retry. Defaults to the policy's delay, 30.
+    """
+    parent = threading.current_thread().name
+
+    def work(target: Target) -> None:
+        retries = target.configuration.get("retries", 0)
+        policy = target.configuration.get("retry") or retry_settings(None)
+        first = policy["delay"] if delay is None else delay
+        start = time.monotonic()
+        attempt = 0
+        used = {}
+        while True:
+            target.result.attempts[step] = attempt + 1
+            try:
+                func(target)
+                break
+            except Exception as e:
+                kind = error_class(e)
+                if used.get(kind, 0) >= allowed_retries(kind, policy, retries) or not may_retry():
+                    logger.error(f"{step} on {target.name} failed: {type(e).__name__}: {e}")
+                    logger.debug(traceback.format_exc())
+                    target.fail(step, e)
+                    break
+                wait = min(first * 2**attempt, policy["max_delay"])
+                logger.warning(
+                    f"{step} on {target.name} failed ({kind} error, {type(e).__name__}: {e}), retrying in {wait:.0f}s"
+                )
+                time.sleep(wait)
+                used[kind] = used.get(kind, 0) + 1
+                target.result.retries[kind] = target.result.retries.get(kind, 0) + 1
+                attempt += 1
+        target.result.durations[step] = time.monotonic() - start
+
+    active = [t for t in targets if not t.failed]
+    if len(active) == 1:
+        work(active[0])
+        return
+    threads = [threading.Thread(target=work, args=(t,), name=f"{parent}/{t.name}") for t in active]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def finish(targets: List[Target]) -> None:
+    """Marks every target that didn't fail as successful.
+
+    Raises:
+        Exception: The exception of the target if there is only one.
+        TargetsFailed: Raised if some of several targets failed, listing each of them.
+    """
+    for target in targets:
+        if not target.failed:
+            target.result.outcome = "success"
+    failed = [t for t in targets if t.failed]
+    if not failed:
+        return
+    if len(targets) == 1:
+        raise failed[0].exception
+    lines = [f"{t.name} ({t.result.failed_step}): {t.result.error}" for t in failed]
+    raise TargetsFailed(f"{len(failed)} of {len(targets)} targets failed:\n" + "\n".join(lines))
+
+
+if __name__ == "__main__":
+    pass
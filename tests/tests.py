@@ -1,7 +1,40 @@
 # pi@raspberrypi:~/backup_scripts/newscripts $ python -m unittest discover
 import borg
+import borgcache
+import changes
+import fcntl
+import json
+import maintenance
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime
 import unittest
+from unittest import mock
 import cmdrunner
+import composefile
+import dbdumps
+import metrics
+import notifications
+import orchestrator
+import patterns
+import preflight
+import profiler
+import readiness
+import scheduler
+import slots
+import socket
+import subprocess
+import sys
+import snapshot
+import sshmux
+import staging
+import targets
+import throttle
+from runcontext import RunContext
 
 
 class TestBorg(unittest.TestCase):
@@ -35,85 +68,216 @@ class TestBorg(unittest.TestCase):
     def test_borg_info(self):
         borg.info(**TestBorg.config)
 
+    def test_get_env_uses_ssh_master(self):
+        master = sshmux.SSHMaster(123, "test.com")
+        env = borg._get_env(**TestBorg.config, ssh_master=master)
+        self.assertNotIn("BORG_RSH", env)
+        master.is_open = True
+        env = borg._get_env(**TestBorg.config, ssh_master=master)
+        self.assertIn("ControlMaster=no", env["BORG_RSH"])
+        self.assertTrue(env["BORG_RSH"].startswith("ssh "))
+        self.assertEqual(master.sessions, 1)
+
+    def test_ssh_port_used_by_every_connection(self):
+        config = {**TestBorg.config, "ssh_port": 2222}
+        env = borg._get_env(**config)
+        self.assertEqual(env["BORG_RSH"], "ssh -p 2222")
+        self.assertNotIn("BORG_RSH", borg._get_env(**{**config, "ssh_port": 22}))
+        with mock.patch("borg.cmd_run") as run:
+            run.return_value.returncode = 0
+            borg.check_ssh_login(**config)
+        self.assertIn(" -p 2222 ", run.call_args[0][0])
+        with mock.patch("slots.Slot") as slot:
+            with slots.held(slots.settings(True), **config):
+                pass
+        self.assertEqual(slot.call_args[0][-1], "-p 2222")
+        master = sshmux.SSHMaster(123, "test.com", 2222)
+        with mock.patch("sshmux.subprocess.run") as run, mock.patch("sshmux.cmd_run") as cmd:
+            run.return_value.returncode = 0
+            cmd.return_value.returncode = 0
+            master.open()
+            self.assertIn("-p", run.call_args[0][0])
+            self.assertEqual(run.call_args[0][0][run.call_args[0][0].index("-p") + 1], "2222")
+            env = borg._get_env(**config, ssh_master=master)
+            self.assertTrue(env["BORG_RSH"].startswith("ssh -p 2222 -o ControlPath="))
+            master.close()
+            self.assertIn("ssh -p 2222 ", cmd.call_args[0][0])
+
+    def test_master_pool_opens_servers_in_parallel(self):
+        opened = []
+
+        def slow_open(master):
+            opened.append(master.server)
+            time.sleep(0.3)
+            return False
+
+        pool = sshmux.MasterPool()
+        with mock.patch("sshmux.SSHMaster.open", slow_open):
+            threads = [threading.Thread(target=pool.get, args=(123, server)) for server in ["a.com", "b.com", "a.com"]]
+            start = time.monotonic()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        # the second server doesn't wait for the handshake of the first, a server's master is opened once
+        self.assertLess(time.monotonic() - start, 0.55)
+        self.assertEqual(sorted(opened), ["a.com", "b.com"])
+        self.assertIs(pool.get(123, "a.com"), pool.get(123, "a.com"))
+
+    def test_ssh_masters_use_private_control_paths(self):
+        masters = [sshmux.SSHMaster(123, "test.com"), sshmux.SSHMaster(123, "test.com")]
+        with mock.patch("sshmux.subprocess.run") as run, mock.patch("sshmux.cmd_run") as cmd:
+            run.return_value.returncode = 0
+            cmd.return_value.returncode = 0
+            for master in masters:
+                self.assertTrue(master.open())
+            self.assertNotEqual(masters[0].control_path, masters[1].control_path)
+            control_dir = masters[0].control_dir
+            self.assertTrue(os.path.isdir(control_dir))
+            masters[0].close()
+            self.assertFalse(os.path.exists(control_dir))
+            self.assertIn(f"ControlPath={os.path.join(control_dir, '%C')} -O exit", cmd.call_args[0][0])
+            run.return_value.returncode = 255
+            master = sshmux.SSHMaster(123, "test.com")
+            self.assertFalse(master.open())
+            self.assertIsNone(master.control_dir)
+            masters[1].close()
+
     fakerepo = "1234abcde"
-    info_repokey = """
-    Remote: Borg 0.29.0: exception in RPC call:
-Remote: Traceback (most recent call last):
-Remote:   File "/usr/home/kibab/borgbackup-0.29.0/borg/remote.py", line 96, in serve
-Remote: TypeError: open() takes from 2 to 5 positional arguments but 7 were given
-Remote: Platform: FreeBSD ch-s011.rsync.net 12.2-RELEASE FreeBSD 12.2-RELEASE rsync_12_2 amd64
-Remote: Python: CPython 3.4.3
-Remote: 
-Please note:
-If you see a TypeError complaining about the number of positional arguments
-given to open(), you can ignore it if it comes from a borg version < 1.0.7.
-This TypeError is a cosmetic side effect of the compatibility code borg
-clients >= 1.0.7 have to support older borg servers.
-This problem will go away as soon as the server has been upgraded to 1.0.7+.
-Repository ID: {fakerepo}
-Location: ssh://123456@ch-s011.rsync.net/./borg_repo
-Encrypted: Yes (repokey)
-Cache: /home/pi/.cache/borg/{fakerepo}
-Security dir: /home/pi/.config/borg/security/{fakerepo}
-------------------------------------------------------------------------------
-                       Original size      Compressed size    Deduplicated size
-All archives:                0 TB              0 TB            0 GB
-
-                       Unique chunks         Total chunks
-Chunk index:                  1              1
-    """
-
-    info_repokey_blake2b = f"""
-Repository ID: {fakerepo}
-Location: ssh://1234@ch-s011.rsync.net/./blaketest
-Encrypted: Yes (repokey BLAKE2b)
-Cache: /home/pi/.cache/borg/{fakerepo}
-Security dir: /home/pi/.config/borg/security/{fakerepo}
-------------------------------------------------------------------------------
-                       Original size      Compressed size    Deduplicated size
-All archives:                    0 B                  0 B                  0 B
-
-                       Unique chunks         Total chunks
-Chunk index:                       0                    0
-"""
-    info_unencrypted = """
-Repository ID: {fakerepo}
-Location: ssh://17963@ch-s011.rsync.net/./unencryptedtest
-Encrypted: No
-Cache: /home/pi/.cache/borg/{fakerepo}
-Security dir: /home/pi/.config/borg/security/{fakerepo}
-------------------------------------------------------------------------------
-                       Original size      Compressed size    Deduplicated size
-All archives:                    0 B                  0 B                  0 B
-
-                       Unique chunks         Total chunks
-Chunk index:                       0                    0
-"""
-    info_not_exists = """
-Repository 12345@ch-s011.rsync.net:unencryptedtest2 does not exist."""
+    info_repokey = f"""{{
+    "cache": {{
+        "path": "/home/pi/.cache/borg/{fakerepo}",
+        "stats": {{
+            "total_chunks": 10,
+            "total_csize": 600,
+            "total_size": 1000,
+            "total_unique_chunks": 5,
+            "unique_csize": 300,
+            "unique_size": 500
+        }}
+    }},
+    "encryption": {{"mode": "repokey"}},
+    "repository": {{
+        "id": "{fakerepo}",
+        "last_modified": "2022-04-01T03:00:00.000000",
+        "location": "ssh://123456@ch-s011.rsync.net/./borg_repo"
+    }},
+    "security_dir": "/home/pi/.config/borg/security/{fakerepo}"
+}}"""
+    info_repokey_blake2b = info_repokey.replace('"repokey"', '"repokey-blake2"')
+    info_unencrypted = info_repokey.replace('"repokey"', '"none"')
 
-    info_wrong_pw = "passphrase supplied in BORG_PASSPHRASE, by BORG_PASSCOMMAND or via BORG_PASSPHRASE_FD is incorrect."
+    create_json = """{
+    "archive": {
+        "duration": 12.5,
+        "id": "abcdef",
+        "name": "testfolder-2022-04-01-030000",
+        "stats": {
+            "compressed_size": 700,
+            "deduplicated_size": 100,
+            "nfiles": 42,
+            "original_size": 1000
+        }
+    },
+    "repository": {"id": "1234abcde"}
+}"""
 
-    def test_repo_exists(self):
-        # check that no exception is thrown when the repo exists
-        borg._check_repo_exists(TestBorg.info_repokey)
-        self.assertRaises(
-            borg.RepoDoesNotExist, borg._check_repo_exists, TestBorg.info_not_exists
+    def log_json(msgid, message, levelname="ERROR", name="borg.archiver"):
+        return json.dumps(
+            {
+                "type": "log_message",
+                "time": 1648782000.0,
+                "message": message,
+                "levelname": levelname,
+                "name": name,
+                "msgid": msgid,
+            }
         )
 
-    def test_repo_encrypted_with_repokey(self):
-        ret = borg._repo_encrypted_with_repokey(TestBorg.info_repokey)
-        self.assertTrue(ret)
-        ret = borg._repo_encrypted_with_repokey(TestBorg.info_repokey_blake2b)
-        self.assertTrue(ret)
-        ret = borg._repo_encrypted_with_repokey(TestBorg.info_unencrypted)
-        self.assertFalse(ret)
+    info_not_exists = log_json(
+        "Repository.DoesNotExist",
+        "Repository ssh://12345@ch-s011.rsync.net/./unencryptedtest2 does not exist.",
+    )
+    info_wrong_pw = log_json(
+        "PassphraseWrong",
+        "passphrase supplied in BORG_PASSPHRASE, by BORG_PASSCOMMAND or via BORG_PASSPHRASE_FD is incorrect.",
+    )
+    info_lock = log_json("LockTimeout", "Failed to create/acquire the lock")
 
-    def test_check_password_correct(self):
-        borg._check_password_correct(TestBorg.info_repokey)
-        self.assertRaises(
-            borg.WrongRepokey, borg._check_password_correct, TestBorg.info_wrong_pw
-        )
+    def test_parse_info(self):
+        repo = borg._parse_info(TestBorg.info_repokey)
+        self.assertEqual(repo.repository_id, TestBorg.fakerepo)
+        self.assertEqual(repo.original_size, 1000)
+        self.assertEqual(repo.deduplicated_size, 300)
+        self.assertTrue(repo.encrypted_with_repokey)
+        repo = borg._parse_info(TestBorg.info_repokey_blake2b)
+        self.assertTrue(repo.encrypted_with_repokey)
+        repo = borg._parse_info(TestBorg.info_unencrypted)
+        self.assertFalse(repo.encrypted_with_repokey)
+        self.assertEqual(borg._parse_info("not json"), borg.RepoInfo())
+
+    def test_parse_create(self):
+        archive = borg._parse_create(TestBorg.create_json)
+        self.assertEqual(archive.name, "testfolder-2022-04-01-030000")
+        self.assertEqual(archive.nfiles, 42)
+        self.assertEqual(archive.deduplicated_size, 100)
+        self.assertEqual(archive.duration, 12.5)
+
+    def test_parse_prune(self):
+        messages = [
+            "Keeping archive (rule: daily #1):        a-2022-04-01  Fri, 2022-04-01 03:00:00 [ab]",
+            "Keeping archive: b-2022-03-31  Thu, 2022-03-31 03:00:00 [cd]",
+            "Pruning archive (1/1):                   c-2022-03-01  Tue, 2022-03-01 03:00:00 [ef]",
+        ]
+        pruned = borg._parse_prune(messages)
+        self.assertEqual(pruned.kept, ["a-2022-04-01", "b-2022-03-31"])
+        self.assertEqual(pruned.pruned, ["c-2022-03-01"])
+
+    def test_errors_classified_by_msgid(self):
+        cases = [
+            (TestBorg.info_not_exists, borg.RepoDoesNotExist),
+            (TestBorg.info_wrong_pw, borg.WrongRepokey),
+            (TestBorg.info_lock, borg.BorgErrorGettingLock),
+            (TestBorg.log_json("Repository.CheckNeeded", "check needed"), borg.BorgError),
+        ]
+        for line, exception in cases:
+            log = borg.LogJson()
+            log("Remote: some noise that isn't JSON")
+            log(line)
+            self.assertRaises(exception, log.raise_for_error, "Error running borg")
+
+
+class TestRepoCache(unittest.TestCase):
+    def test_full_check_only_when_stale_or_changed(self):
+        with tempfile.TemporaryDirectory() as d:
+            config = {
+                **TestBorg.config,
+                "debug": False,
+                "repo_encrypted": True,
+                "cache_dir": d,
+                "repo_check_ttl": 3600,
+            }
+            repo = borg.RepoInfo("id1", "", "repokey")
+            with mock.patch("borg.info", return_value=repo) as info, mock.patch(
+                "borg.list_last", return_value=repo
+            ) as list_last:
+                borg.repo_checks(**config)
+                borg.repo_checks(**config)
+                self.assertEqual((info.call_count, list_last.call_count), (1, 1))
+                list_last.return_value = borg.RepoInfo("id2", "", "repokey")
+                borg.repo_checks(**config)
+                self.assertEqual(info.call_count, 2)
+                borg.repo_checks(**{**config, "repo_check_ttl": 0})
+                self.assertEqual(info.call_count, 3)
+
+    def test_list_last_uses_list_parameters(self):
+        params = {"info": "--info-only", "list": "--consider-checkpoints"}
+        with mock.patch("borg.cmd_run") as run:
+            run.return_value.returncode = 0
+            run.return_value.stdout = json.dumps({"repository": {"id": "id1"}, "encryption": {"mode": "repokey"}, "archives": []})
+            borg.list_last(**{**TestBorg.config, "borg_parameters": params})
+        self.assertIn("--consider-checkpoints", run.call_args[0][0])
+        self.assertNotIn("--info-only", run.call_args[0][0])
 
 
 class TestCMDRunner(unittest.TestCase):
@@ -130,6 +294,1100 @@ class TestCMDRunner(unittest.TestCase):
             FileNotFoundError, cmdrunner.cmd_run, cmd_doesntexist, **config
         )
 
+    def test_cmd_run_streaming(self):
+        script = "for i in range(5000): print(f'line {i}'); print('progress', end='\\r')"
+        matcher = cmdrunner.LineMatcher("line 2500$")
+        p = cmdrunner.cmd_run(
+            f'python3 -c "{script}"', handlers=[matcher], tail_lines=10, debug=False
+        )
+        self.assertTrue(matcher.matched)
+        self.assertEqual(p.lines, 10000)
+        lines = p.stdout.splitlines()
+        self.assertEqual(len(lines), 10)
+        self.assertEqual(lines[-1], "line 4999")
+
+    def test_cmd_run_timeout(self):
+        p = cmdrunner.cmd_run("sleep 5", timeout=0.2, debug=False)
+        self.assertTrue(p.timed_out)
+        self.assertNotEqual(p.returncode, 0)
+
+
+class FakeContext:
+    def __init__(self, name, fail=False):
+        self.name = name
+        self.configfile = f"{name}.yaml"
+        self.fail = fail
+
+
+class TestOrchestrator(unittest.TestCase):
+    def test_collect_configs(self):
+        with tempfile.TemporaryDirectory() as d:
+            for f in ["b.yaml", "a.yml", "secrets.yaml", "README"]:
+                open(os.path.join(d, f), "w").close()
+            configs = orchestrator.collect_configs(
+                [d], exclude=[os.path.join(d, "secrets.yaml")]
+            )
+            self.assertEqual(
+                configs, [os.path.join(d, "a.yml"), os.path.join(d, "b.yaml")]
+            )
+            self.assertRaises(
+                FileNotFoundError, orchestrator.collect_configs, [d + "/missing"]
+            )
+            os.mkdir(os.path.join(d, "empty"))
+            self.assertRaises(
+                orchestrator.NoConfigsFound,
+                orchestrator.collect_configs,
+                [os.path.join(d, "empty")],
+            )
+
+    def test_limiter_caps_runs_per_repo(self):
+        limiter = orchestrator.ConcurrencyLimiter(max_per_server=2, max_per_repo=1)
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def job(repo):
+            with limiter.slot("server", repo):
+                with lock:
+                    running.append(repo)
+                    peak.append(len(running))
+                time.sleep(0.05)
+                with lock:
+                    running.remove(repo)
+
+        threads = [threading.Thread(target=job, args=(r,)) for r in "aabb"]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertLessEqual(max(peak), 2)
+        self.assertRaises(ValueError, orchestrator.ConcurrencyLimiter, 0, 1)
+
+    def test_limiter_waiting_run_holds_no_server_slot(self):
+        limiter = orchestrator.ConcurrencyLimiter(max_per_server=2, max_per_repo=1)
+        release = threading.Event()
+        started = []
+
+        def job(name, repo):
+            with limiter.slot("server", repo):
+                started.append(name)
+                release.wait(5)
+
+        threads = [threading.Thread(target=job, args=args) for args in [("a1", "a"), ("a2", "a"), ("b", "b")]]
+        threads[0].start()
+        while not started:
+            time.sleep(0.01)
+        threads[1].start()
+        time.sleep(0.1)
+        threads[2].start()
+        # a2 waits for repo a, the second server slot is left to b
+        deadline = time.monotonic() + 2
+        while "b" not in started and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(started, ["a1", "b"])
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(started), ["a1", "a2", "b"])
+
+    def test_run_parallel(self):
+        def run(ctx):
+            if ctx.fail:
+                raise RuntimeError("boom")
+
+        contexts = [FakeContext("ok"), FakeContext("broken", fail=True)]
+        results = orchestrator.run_parallel(contexts, run, jobs=2)
+        self.assertEqual([r.name for r in results], ["ok", "broken"])
+        self.assertTrue(results[0].success)
+        self.assertFalse(results[1].success)
+        report = orchestrator.format_report(results)
+        self.assertIn("1 succeeded, 1 failed", report)
+        self.assertIn("boom", report)
+
+
+class TestSnapshot(unittest.TestCase):
+    config = {
+        "debug": True,
+        "rootfolder": "/srv/docker/",
+        "foldername": "nextcloud",
+    }
+
+    def test_from_config(self):
+        config = {**TestSnapshot.config, "snapshot": {"type": "nope"}}
+        self.assertRaises(ValueError, snapshot.from_config, **config)
+        config["snapshot"] = {"type": "zfs", "dataset": "tank/docker"}
+        self.assertRaises(KeyError, snapshot.from_config, **config)
+
+    def test_snapshot_paths(self):
+        config = {
+            **TestSnapshot.config,
+            "snapshot": {"type": "zfs", "dataset": "tank/docker", "mountpoint": "/srv"},
+        }
+        snap = snapshot.from_config(**config)
+        self.assertEqual(
+            snap.create(),
+            "/srv/.zfs/snapshot/dcborgbackup-nextcloud/docker/nextcloud",
+        )
+        config["snapshot"] = {"type": "btrfs", "path": "/srv/.snapshots"}
+        snap = snapshot.from_config(**config)
+        self.assertEqual(snap.create(), "/srv/.snapshots/dcborgbackup-nextcloud")
+        config["snapshot"] = {
+            "type": "lvm",
+            "volume": "vg0/docker",
+            "mountpoint": "/opt",
+            "snapshot_mountpoint": "/mnt/snap",
+        }
+        snap = snapshot.from_config(**config)
+        self.assertRaises(snapshot.SnapshotError, snap.create)
+
+    def test_snapshot_removed_on_error(self):
+        class FakeSnapshot(snapshot.Snapshot):
+            removed = False
+
+            def exists(self):
+                return False
+
+            def create(self):
+                return "/snap"
+
+            def remove(self):
+                self.removed = True
+
+        snap = FakeSnapshot("/srv/docker/nextcloud", "nextcloud", True)
+        with self.assertRaises(RuntimeError):
+            with snapshot.taken(snap) as path:
+                self.assertEqual(path, "/snap")
+                raise RuntimeError("borg failed")
+        self.assertTrue(snap.removed)
+
+    def test_incomplete_backend_not_instantiable(self):
+        class NoRemove(snapshot.Snapshot):
+            def exists(self):
+                return False
+
+            def create(self):
+                return "/snap"
+
+        self.assertRaises(TypeError, NoRemove, "/srv/docker/nextcloud", "nextcloud")
+
+
+class TestStaging(unittest.TestCase):
+    def test_sync_is_incremental(self):
+        with tempfile.TemporaryDirectory() as d:
+            src = os.path.join(d, "stack")
+            os.makedirs(os.path.join(src, "data", "sub"))
+            with open(os.path.join(src, "data", "db"), "w") as f:
+                f.write("x" * 100)
+            os.link(os.path.join(src, "data", "db"), os.path.join(src, "data", "sub", "db"))
+            os.symlink("db", os.path.join(src, "data", "link"))
+            config = {
+                "rootfolder": d + "/",
+                "foldername": "stack",
+                "debug": False,
+                "staging": {"path": os.path.join(d, "staging")},
+            }
+            stats = staging.sync(**config)
+            self.assertEqual(stats.files_copied, 1)
+            self.assertEqual(stats.files_linked, 1)
+            dest = staging.staging_folder(**config)
+            self.assertTrue(
+                os.path.samefile(
+                    os.path.join(dest, "data", "db"), os.path.join(dest, "data", "sub", "db")
+                )
+            )
+            self.assertEqual(os.readlink(os.path.join(dest, "data", "link")), "db")
+
+            stats = staging.sync(**config)
+            self.assertEqual(stats.files_copied, 0)
+
+            os.remove(os.path.join(src, "data", "link"))
+            stats = staging.sync(**config)
+            self.assertEqual(stats.files_deleted, 1)
+            self.assertFalse(os.path.lexists(os.path.join(dest, "data", "link")))
+            self.assertGreater(stats.disk_usage, 0)
+
+            # a removed tree counts every entry in it, like rsync does
+            shutil.rmtree(os.path.join(src, "data", "sub"))
+            stats = staging.sync(**config)
+            self.assertEqual(stats.files_deleted, 2)
+
+    def test_special_files_not_staged(self):
+        with tempfile.TemporaryDirectory() as d:
+            src = os.path.join(d, "stack")
+            os.makedirs(src)
+            with open(os.path.join(src, "pipe"), "w") as f:
+                f.write("a regular file the first time")
+            config = {
+                "rootfolder": d + "/",
+                "foldername": "stack",
+                "debug": False,
+                "staging": {"path": os.path.join(d, "staging")},
+            }
+            staging.sync(**config)
+            os.remove(os.path.join(src, "pipe"))
+            os.mkfifo(os.path.join(src, "pipe"))
+            stats = staging.sync(**config)
+            # the stale file of the earlier run is gone, the fifo isn't copied
+            self.assertEqual(stats.files_deleted, 1)
+            self.assertFalse(os.path.lexists(os.path.join(staging.staging_folder(**config), "pipe")))
+
+
+class TestComposeFile(unittest.TestCase):
+    compose = """
+services:
+  proxy:
+    image: nginx
+    volumes:
+      - ./nginx.conf:/etc/nginx/nginx.conf:ro
+    depends_on:
+      - app
+  app:
+    image: nextcloud
+    volumes:
+      - ./persistant-data/html:/var/www/html
+    depends_on:
+      - db
+      - redis
+  cron:
+    image: nextcloud
+    volumes_from:
+      - app
+  db:
+    image: postgres
+    volumes:
+      - type: bind
+        source: ./persistant-data/db
+        target: /var/lib/postgresql/data
+  redis:
+    image: redis
+    volumes:
+      - redis-data:/data
+volumes:
+  redis-data:
+"""
+
+    def test_services_to_stop(self):
+        with tempfile.TemporaryDirectory() as d:
+            compose_file = os.path.join(d, "docker-compose.yaml")
+            with open(compose_file, "w") as f:
+                f.write(TestComposeFile.compose)
+            services = composefile.services_to_stop(compose_file, d)
+            # redis keeps no data in the folder, the proxy only reads from it but depends on app
+            self.assertEqual(services, ["db", "app", "cron", "proxy"])
+            services = composefile.services_to_stop(
+                compose_file, os.path.join(d, "persistant-data", "db")
+            )
+            self.assertEqual(services[0], "db")
+            self.assertNotIn("redis", services)
+            # a service mounting the parent directory writes into the project folder too
+            stack = os.path.join(d, "stack")
+            os.makedirs(stack)
+            compose_file = os.path.join(stack, "docker-compose.yaml")
+            with open(compose_file, "w") as f:
+                f.write("services:\n  files:\n    image: filebrowser\n    volumes:\n      - ..:/srv\n  web:\n    image: nginx\n")
+            self.assertEqual(composefile.services_to_stop(compose_file, stack), ["files"])
+
+    def test_interpolated_bind_mounts(self):
+        with tempfile.TemporaryDirectory() as d:
+            compose_file = os.path.join(d, "docker-compose.yaml")
+            with open(compose_file, "w") as f:
+                f.write(
+                    "services:\n  db:\n    image: postgres\n    volumes:\n      - ${DATA_DIR}/db:/var/lib/postgresql/data\n"
+                    "  app:\n    image: nginx\n    volumes:\n      - ${APP_DIR:-./app}:/app\n      - $$cache:/cache\n"
+                    "  redis:\n    image: redis\n    volumes:\n      - ${REDIS_VOLUME}:/data\n"
+                )
+            with open(os.path.join(d, ".env"), "w") as f:
+                f.write(f"# data of the stack\nDATA_DIR={d}/data\nREDIS_VOLUME='redis-data'\n")
+            with mock.patch.dict(os.environ, {"APP_DIR": ""}):
+                self.assertEqual(composefile.services_to_stop(compose_file, os.path.join(d, "data")), ["db"])
+                self.assertEqual(composefile.services_to_stop(compose_file, os.path.join(d, "app")), ["app"])
+                mounts = composefile.bind_mounts(composefile.load(compose_file)["services"]["app"], d)
+            # $$ escapes a dollar, the source isn't a volume name
+            self.assertEqual([m[0] for m in mounts], [os.path.join(d, "app"), os.path.join(d, "$cache")])
+            with mock.patch.dict(os.environ, {"DATA_DIR": os.path.join(d, "elsewhere")}):
+                self.assertEqual(composefile.services_to_stop(compose_file, os.path.join(d, "data")), [])
+
+    def test_start_order_cycle(self):
+        deps = {"a": {"b"}, "b": {"a"}}
+        self.assertRaises(
+            composefile.ComposeFileError, composefile.start_order, deps, {"a", "b"}
+        )
+
+
+class TestPreflight(unittest.TestCase):
+    def test_all_failures_collected(self):
+        def fail():
+            raise RuntimeError("broken")
+
+        checks = [
+            preflight.Check("ok", lambda: None, 1),
+            preflight.Check("fails", fail, 1),
+            preflight.Check("slow", lambda: time.sleep(1), 0.1),
+        ]
+        start = time.monotonic()
+        with self.assertRaises(preflight.PreflightError) as cm:
+            preflight.check("stack", checks)
+        self.assertLess(time.monotonic() - start, 0.9)
+        failures = {r.name: r.error for r in cm.exception.failures}
+        self.assertEqual(set(failures), {"fails", "slow"})
+        self.assertIn("timed out", failures["slow"])
+        self.assertIn("broken", str(cm.exception))
+
+    def test_tcp_reachable(self):
+        with socket.socket() as server:
+            server.bind(("127.0.0.1", 0))
+            server.listen(1)
+            port = server.getsockname()[1]
+            self.assertTrue(preflight.tcp_reachable("127.0.0.1", port, 1))
+        self.assertFalse(preflight.tcp_reachable("127.0.0.1", port, 1))
+
+
+class TestMetrics(unittest.TestCase):
+    def run_ctx(self, d, outcome):
+        ctx = RunContext("stack.yaml")
+        ctx.configuration = {
+            "foldername": "stack",
+            "metrics": {"textfile_dir": d, "json_dir": d},
+        }
+        ctx.started = time.monotonic()
+        with ctx.metrics.phase("create"):
+            ctx.archive = borg.ArchiveResult(
+                "stack-1", "a", "r", 1.0, 1000, 800, 250, 10
+            )
+        ctx.metrics.finish(outcome)
+        metrics.export(ctx)
+        return ctx
+
+    def test_export(self):
+        with tempfile.TemporaryDirectory() as d:
+            self.run_ctx(d, "success")
+            with open(os.path.join(d, "dcborgbackup_stack.prom")) as f:
+                prom = f.read()
+            self.assertIn('dcborgbackup_phase_duration_seconds{stack="stack",phase="create"}', prom)
+            self.assertIn('dcborgbackup_deduplication_ratio{stack="stack"} 0.75', prom)
+            self.assertIn('dcborgbackup_last_run_success{stack="stack"} 1', prom)
+            reports = [f for f in os.listdir(d) if f.endswith(".json")]
+            self.assertEqual(len(reports), 1)
+            with open(os.path.join(d, reports[0])) as f:
+                data = json.load(f)
+            self.assertEqual(data["outcome"], "success")
+            self.assertEqual(data["archive"]["deduplicated_size"], 250)
+
+    def test_last_success_survives_failure(self):
+        with tempfile.TemporaryDirectory() as d:
+            ctx = self.run_ctx(d, "success")
+            self.run_ctx(d, "failure")
+            last = metrics._last_success(os.path.join(d, "dcborgbackup_stack.prom"), "stack")
+            self.assertEqual(last, ctx.metrics.finished_at)
+
+    def test_run_finishes_after_maintenance(self):
+        import dcborgbackup
+
+        def start(ctx):
+            ctx.started = time.monotonic()
+            ctx.targets = [targets.Target({"borgserver": "nas", "borgrepo": "repo"}, "nas")]
+            ctx.metrics.set_outcome("success")
+
+        maintained = []
+
+        def maintain(ctx):
+            maintained.append(time.time())
+            time.sleep(0.05)
+
+        with tempfile.TemporaryDirectory() as d:
+            ctx = RunContext("stack.yaml")
+            ctx.configuration = {"foldername": "stack", "debug": False, "metrics": {"textfile_dir": d}}
+            with mock.patch("dcborgbackup._start", start), mock.patch("dcborgbackup._maintain", maintain):
+                dcborgbackup.run(ctx)
+            self.assertEqual(ctx.metrics.outcome, "success")
+            self.assertGreaterEqual(ctx.metrics.finished_at, maintained[0] + 0.05)
+            # maintenance that breaks fails the run, the metrics are still exported
+            ctx = RunContext("stack.yaml")
+            ctx.configuration = {"foldername": "stack", "debug": False, "metrics": {"textfile_dir": d}}
+            with mock.patch("dcborgbackup._start", start), mock.patch("dcborgbackup._maintain", side_effect=OSError("disk full")):
+                with self.assertRaises(OSError), self.assertLogs("dcborgbackup", "ERROR"):
+                    dcborgbackup.run(ctx)
+            self.assertEqual((ctx.metrics.outcome, ctx.metrics.error), ("failure", "OSError: disk full"))
+            with open(os.path.join(d, "dcborgbackup_stack.prom")) as f:
+                self.assertIn('dcborgbackup_last_run_success{stack="stack"} 0', f.read())
+
+
+class TestBenchmarkStandIns(unittest.TestCase):
+    def test_fake_borg(self):
+        fake = os.path.join(os.path.dirname(__file__), "..", "benchmarks", "fakebin.py")
+        with tempfile.TemporaryDirectory() as d:
+            os.symlink(os.path.abspath(fake), os.path.join(d, "borg"))
+            scenario = os.path.join(d, "scenario.json")
+            with open(scenario, "w") as f:
+                json.dump({"borg": {"create": {"original_size": 1000, "nfiles": 3}}}, f)
+            env = {
+                **os.environ,
+                "PATH": d + os.pathsep + os.environ["PATH"],
+                "DCBB_FAKE_SCENARIO": scenario,
+                "DCBB_FAKE_STATE": os.path.join(d, "state"),
+            }
+            result = cmdrunner.cmd_run(
+                "borg create --json --log-json u@h:repo::a /src",
+                env=env,
+                capture_stdout=True,
+                debug=False,
+            )
+            archive = borg._parse_create(result.stdout)
+            self.assertEqual((archive.original_size, archive.nfiles), (1000, 3))
+            # a held repo lock makes the stand-in fail like borg does
+            lock = open(os.path.join(d, "state", "lock-u@h_repo"), "a")
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with open(scenario, "w") as f:
+                json.dump({"borg": {"lock_wait": 0.1}}, f)
+            log = borg.LogJson()
+            result = cmdrunner.cmd_run(
+                "borg prune --log-json u@h:repo", env=env, handlers=[log], debug=False
+            )
+            lock.close()
+            self.assertNotEqual(result.returncode, 0)
+            self.assertRaises(borg.BorgErrorGettingLock, log.raise_for_error, "")
+            # checkpoints are hidden unless asked for, like borg 1.2 does
+            names = ["a-2024-01-01-030000.checkpoint", "a-2024-01-02-030000.checkpoint.1"]
+            with open(scenario, "w") as f:
+                json.dump({"borg": {"list": {"checkpoints": names}}}, f)
+            config = {"borgarchive": "a", "borguser": "u", "borgserver": "h", "borgrepo": "repo", "password": "", "debug": False}
+            with mock.patch.dict(os.environ, env):
+                self.assertEqual(borg.checkpoints(**config), names)
+            result = cmdrunner.cmd_run(
+                "borg list --json --log-json --glob-archives 'a-*.checkpoint*' u@h:repo", env=env, capture_stdout=True, debug=False
+            )
+            self.assertFalse(set(names) & {a["name"] for a in json.loads(result.stdout)["archives"]})
+
+
+class TestScheduler(unittest.TestCase):
+    def test_cron_next_after(self):
+        start = datetime(2021, 1, 4, 3, 30)  # a monday
+        cases = {
+            "*/15 * * * *": datetime(2021, 1, 4, 3, 45),
+            "0 3 * * *": datetime(2021, 1, 5, 3, 0),
+            "30 2 * * sat,sun": datetime(2021, 1, 9, 2, 30),
+            "0 0 1 feb *": datetime(2021, 2, 1, 0, 0),
+            "@weekly": datetime(2021, 1, 10, 0, 0),
+            "0 4 13 * 5": datetime(2021, 1, 8, 4, 0),  # the 13th or a friday
+        }
+        for expression, expected in cases.items():
+            self.assertEqual(
+                scheduler.CronExpression(expression).next_after(start), expected, expression
+            )
+        for broken in ["* * * *", "60 * * * *", "*/0 * * * *"]:
+            self.assertRaises(ValueError, scheduler.CronExpression, broken)
+
+    def test_overlapping_runs_skipped(self):
+        release = threading.Event()
+        runs = []
+
+        def run(payload):
+            runs.append(payload)
+            release.wait(5)
+
+        with tempfile.TemporaryDirectory() as d:
+            for name in ["a", "b"]:
+                with open(os.path.join(d, f"{name}.yaml"), "w") as f:
+                    f.write("x")
+            idle = threading.Event()
+
+            def on_idle():
+                # the scheduler stays usable while the ssh connections are closed
+                self.assertIsInstance(s.status(), dict)
+                idle.set()
+
+            s = scheduler.Scheduler(
+                [d],
+                lambda c: (os.path.basename(c), "* * * * *", c),
+                run,
+                jobs=1,
+                on_idle=on_idle,
+            )
+            s.reload()
+            later = datetime(2100, 1, 1)
+            self.assertEqual(s.run_due(later), ["a.yaml", "b.yaml"])
+            time.sleep(0.1)
+            status = s.status()
+            self.assertEqual(status["running"], ["a.yaml"])
+            self.assertEqual(status["queue_depth"], 1)
+            self.assertEqual(s.run_due(datetime(2100, 1, 2)), [])
+            self.assertEqual([j["skipped"] for j in s.status()["stacks"]], [1, 1])
+            release.set()
+            self.assertTrue(idle.wait(5))
+            s.stop()
+            s.serve_forever()
+        self.assertEqual(len(runs), 2)
+
+    def test_status_option(self):
+        import dcborgbackup
+
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "status.sock")
+            s = scheduler.Scheduler([d], lambda c: (c, "* * * * *", c), lambda payload: None)
+            server = s._start_status_server(path)
+            try:
+                with mock.patch("sys.argv", ["dcborgbackup.py", "--status", "--status-socket", path]):
+                    with mock.patch("builtins.print") as printed:
+                        dcborgbackup.main()
+            finally:
+                server.shutdown()
+                server.server_close()
+            status = json.loads(printed.call_args[0][0])
+            self.assertEqual((status["workers"], status["running"]), (s.jobs, []))
+            # nothing listens anymore
+            with mock.patch("sys.argv", ["dcborgbackup.py", "--status", "--status-socket", path]):
+                with self.assertRaises(SystemExit), self.assertLogs("dcborgbackup", "ERROR"):
+                    dcborgbackup.main()
+
+
+class TestStartup(unittest.TestCase):
+    def test_optional_modules_imported_lazily(self):
+        lazy = ["telegram", "yaml", "borgcache", "changes", "composefile", "dbdumps", "patterns", "profiler", "readiness", "scheduler", "slots", "snapshot", "staging", "throttle"]
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                f"import sys, dcborgbackup; print([m for m in {lazy!r} if m in sys.modules])",
+            ],
+            cwd=os.path.join(os.path.dirname(__file__), ".."),
+            stdout=subprocess.PIPE,
+            check=True,
+        )
+        self.assertEqual(result.stdout.decode().strip(), "[]")
+
+
+class FakeProvider(notifications.Provider):
+    name = "fake"
+    max_length = 100
+
+    def __init__(self, targets, fail=0, delay=0):
+        self._targets = targets
+        self.fail = fail
+        self.delay = delay
+        self.sent = []
+
+    def targets(self):
+        return self._targets
+
+    def send(self, target, message):
+        time.sleep(self.delay)
+        if self.fail:
+            self.fail -= 1
+            raise ConnectionError("api down")
+        self.sent.append((target, message.text))
+
+
+class TestNotifications(unittest.TestCase):
+    def test_incomplete_provider_not_instantiable(self):
+        class NoSend(notifications.Provider):
+            name = "nosend"
+
+        self.assertRaises(TypeError, NoSend)
+
+    def test_retry_and_combine(self):
+        provider = FakeProvider([1], fail=2, delay=0.05)
+        dispatcher = notifications.Dispatcher([provider], retries=2, backoff=0.01)
+        for text in ["a", "b", "c", "x" * 96]:
+            dispatcher.submit(notifications.Message(text))
+        self.assertTrue(dispatcher.flush(5))
+        texts = [t for _, t in provider.sent]
+        # the first message went out alone after two retries, the ones queued meanwhile were combined up to max_length
+        self.assertEqual(texts, ["a", "b\n\nc", "x" * 96])
+        self.assertEqual(dispatcher.failed, 0)
+
+    def test_targets_concurrent_and_deadline(self):
+        provider = FakeProvider([1, 2, 3], delay=0.3)
+        dispatcher = notifications.Dispatcher([provider])
+        start = time.monotonic()
+        dispatcher.submit(notifications.Message("done"))
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertFalse(dispatcher.flush(0.05))
+        self.assertTrue(dispatcher.flush(2))
+        self.assertLess(time.monotonic() - start, 0.6)
+        self.assertEqual(sorted(t for t, _ in provider.sent), [1, 2, 3])
+
+    def test_truncate_and_tail(self):
+        self.assertEqual(notifications.truncate("abc", 5), "abc")
+        self.assertEqual(len(notifications.truncate("a" * 50, 20)), 20)
+        self.assertEqual(notifications.tail("1\n2\n3\n", 2), "...\n2\n3")
+
+
+class TestChanges(unittest.TestCase):
+    def test_detects_changes(self):
+        with tempfile.TemporaryDirectory() as d:
+            root = os.path.join(d, "stack")
+            for sub in ["a", "a/b", "c"]:
+                os.makedirs(os.path.join(root, sub))
+                with open(os.path.join(root, sub, "f"), "w") as f:
+                    f.write("x")
+            first = changes.scan(root)
+            self.assertEqual((first.files, first.dirs), (3, 4))
+            self.assertEqual(changes.scan(root, workers=4).manifest, first.manifest)
+            path = os.path.join(d, "cache", "stack.manifest")
+            changes.save(path, first.manifest)
+            self.assertEqual(os.path.getsize(path), len(changes.MAGIC) + 4 * 24)
+            unchanged = changes.compare(changes.scan(root), changes.load(path))
+            self.assertFalse(unchanged.changed)
+            with open(os.path.join(root, "a", "b", "f"), "w") as f:
+                f.write("xy")
+            changed = changes.compare(changes.scan(root, workers=2), changes.load(path))
+            self.assertTrue(changed.changed)
+            self.assertEqual(changed.examples, ["a/b"])
+            self.assertTrue(changes.compare(changes.scan(root), None).changed)
+
+
+class TestTargets(unittest.TestCase):
+    config = {
+        "foldername": "stack",
+        "borg_parameters": {"create": "--compression lz4", "prune": "--keep-daily=7"},
+        "targets": [
+            {"borgserver": "nas"},
+            {"borgserver": "offsite", "borgrepo": "a", "retries": 2},
+            {"borgserver": "offsite", "borgrepo": "b", "borg_parameters": {"prune": "--keep-daily=30"}},
+        ],
+    }
+
+    def test_from_config(self):
+        nas, a, b = targets.from_config(self.config)
+        self.assertEqual((nas["name"], nas["borgrepo"]), ("nas", "stack"))
+        self.assertEqual((a["name"], a["retries"]), ("offsite:a", 2))
+        self.assertEqual(b["borg_parameters"], {"create": "--compression lz4", "prune": "--keep-daily=30"})
+        self.assertNotIn("targets", b)
+        with self.assertRaises(ValueError):
+            targets.from_config({**self.config, "targets": [{"borgserver": "nas", "rootfolder": "/"}]})
+        with self.assertRaises(ValueError):
+            targets.from_config({**self.config, "targets": [{"borgserver": "nas"}, {"borgserver": "nas"}]})
+
+    def test_fan_out(self):
+        runs = [targets.Target(c, c["name"]) for c in targets.from_config(self.config)]
+        calls = []
+
+        def create(target):
+            calls.append(target.name)
+            time.sleep(0.2)
+            if target.name != "nas":
+                raise ConnectionError("uplink down")
+
+        start = time.monotonic()
+        targets.fan_out(runs, "create", create, may_retry=lambda: True, delay=0)
+        # one after the other they would take 1s, offsite:a alone takes 0.6s
+        self.assertLess(time.monotonic() - start, 0.9)
+        self.assertEqual(calls.count("offsite:a"), 3)
+        self.assertEqual(calls.count("offsite:b"), 1)
+        self.assertEqual([t.failed for t in runs], [False, True, True])
+        targets.fan_out(runs, "prune", lambda t: calls.append("prune " + t.name))
+        self.assertEqual([c for c in calls if c.startswith("prune")], ["prune nas"])
+        with self.assertRaises(targets.TargetsFailed) as cm:
+            targets.finish(runs)
+        self.assertIn("2 of 3 targets failed", str(cm.exception))
+        self.assertEqual(runs[0].result.outcome, "success")
+        self.assertEqual(runs[1].result.attempts, {"create": 3})
+
+    def test_single_target_raises_its_error(self):
+        run = targets.Target({"borgserver": "nas", "borgrepo": "stack", "retries": 1}, "nas")
+        targets.fan_out([run], "create", mock.Mock(side_effect=borg.BorgError("boom")), may_retry=lambda: False)
+        self.assertEqual(run.result.attempts, {"create": 1})
+        with self.assertRaises(borg.BorgError):
+            targets.finish([run])
+
+
+    def test_retry_per_error_class(self):
+        policy = targets.retry_settings({"lock_wait": "5m", "network": 3, "delay": 0, "checkpoint_interval": "10m"})
+        self.assertEqual((policy["lock_wait"], policy["lock"], policy["checkpoint_interval"]), (300, None, 600))
+        self.assertTrue(policy["checkpoints"])
+        self.assertFalse(targets.retry_settings(None)["checkpoints"])
+        with self.assertRaises(ValueError):
+            targets.retry_settings({"network": -1})
+        run = targets.Target({"borgserver": "nas", "borgrepo": "stack", "retries": 1, "retry": policy}, "nas")
+        errors = [borg.BorgConnectionClosed("uplink down")] * 3 + [borg.BorgErrorGettingLock("locked"), None]
+        targets.fan_out([run], "create", mock.Mock(side_effect=errors))
+        # three network retries, the lock error falls back to 'retries'
+        self.assertFalse(run.failed)
+        self.assertEqual(run.result.retries, {"network": 3, "lock": 1})
+        run = targets.Target({"borgserver": "nas", "borgrepo": "stack", "retries": 5, "retry": policy}, "nas")
+        targets.fan_out([run], "create", mock.Mock(side_effect=borg.WrongRepokey("wrong passphrase")))
+        self.assertEqual(run.result.attempts, {"create": 1})
+
+    def test_checkpoints(self):
+        config = {**TestBorg.config, "debug": False, "dumps": [{"name": "db"}], "name": "target", "retry": targets.retry_settings(True)}
+        listed = {
+            "archives": [
+                {"name": "testfolder-2024-01-01-030000.checkpoint"},
+                {"name": "testfolder-dump-db-2024-01-01-030000.checkpoint.1"},
+                {"name": "testfolder-extra-2024-01-01-030000.checkpoint"},
+                {"name": "testfolder-2024-01-02-030000"},
+            ]
+        }
+        with mock.patch("borg.cmd_run") as run:
+            run.return_value.returncode = 0
+            run.return_value.stdout = json.dumps(listed)
+            names = borg.checkpoints(**{**config, "retry": targets.retry_settings({"lock_wait": 60})})
+            borg.delete(names, **config)
+        self.assertEqual(names, ["testfolder-2024-01-01-030000.checkpoint", "testfolder-dump-db-2024-01-01-030000.checkpoint.1"])
+        self.assertIn("--lock-wait 60 --consider-checkpoints --glob-archives 'testfolder-*.checkpoint*' ", run.call_args_list[0][0][0])
+        self.assertTrue(run.call_args[0][0].endswith("testrepo " + " ".join(names)))
+
+
+class TestMaintenance(unittest.TestCase):
+    def test_policy(self):
+        policy = maintenance.policy({"prune": 0, "compact": "7d", "check": "never"})
+        self.assertEqual(policy, {"prune": 0, "compact": 7 * 86400, "check": None})
+        self.assertEqual(maintenance.policy(None), maintenance.DEFAULT_POLICY)
+        with self.assertRaises(ValueError):
+            maintenance.policy({"vacuum": "1d"})
+
+    def test_due(self):
+        policy = maintenance.policy({"compact": "1d"})
+        with tempfile.TemporaryDirectory() as d:
+            self.assertTrue(maintenance.due(policy, maintenance.last_runs(d, "s:r"), "compact"))
+            maintenance.mark_done(d, "s:r", "compact")
+            last = maintenance.last_runs(d, "s:r")
+        self.assertTrue(maintenance.due(policy, last, "prune"))
+        self.assertFalse(maintenance.due(policy, last, "check"))
+        self.assertFalse(maintenance.due(policy, last, "compact"))
+        # yesterday's run may have ended a little later than today's starts
+        self.assertTrue(maintenance.due(policy, last, "compact", now=last["compact"] + 86400 - 60))
+
+    def test_compact_reports_freed_space(self):
+        line = TestBorg.log_json(None, "compaction freed about 1.50 GB repository space.", "INFO", "borg.repository")
+
+        def fake_run(cmd, handlers=(), **kwargs):
+            for handler in handlers:
+                handler(line)
+            return mock.Mock(returncode=0)
+
+        with mock.patch("borg.cmd_run", side_effect=fake_run) as run:
+            freed = borg.compact(**{**TestBorg.config, "debug": False})
+        self.assertEqual(freed, 1500000000)
+        self.assertIn("borg compact", run.call_args[0][0])
+
+
+class TestPatterns(unittest.TestCase):
+    def test_translate(self):
+        def matches(pattern, path):
+            return re.match(patterns.translate(pattern), path + "/") is not None
+
+        self.assertTrue(matches("data/appdata_*/preview", "data/appdata_oc1x/preview/1/a.png"))
+        self.assertFalse(matches("data/appdata_*/preview", "data/appdata_oc1x/previews"))
+        self.assertFalse(matches("data/*/preview", "data/a/b/preview"))
+        self.assertTrue(matches("**/cache", "a/b/cache/x"))
+        self.assertTrue(matches("**/cache", "cache"))
+
+    def test_image_name(self):
+        self.assertEqual(patterns.image_name("ghcr.io/immich-app/immich-server:release"), "immich-app/immich-server")
+        self.assertEqual(patterns.image_name("docker.io/library/nextcloud:28-apache"), "nextcloud")
+        self.assertEqual(patterns.image_name("localhost:5000/app@sha256:abc"), "app")
+
+    def test_build_and_report(self):
+        with tempfile.TemporaryDirectory() as root:
+            folder = os.path.join(root, "nextcloud")
+            os.makedirs(folder)
+            with open(os.path.join(folder, "docker-compose.yaml"), "w") as f:
+                f.write(TestComposeFile.compose)
+            files = {
+                "persistant-data/html/data/appdata_oc1/preview/1.png": 300,
+                "persistant-data/html/data/appdata_oc1/preview/keep/2.png": 40,
+                "persistant-data/html/data/nextcloud.log": 200,
+                "persistant-data/html/data/admin/files/a.txt": 10,
+                "persistant-data/db/base": 5,
+                "tmp/x": 7,
+            }
+            for name, size in files.items():
+                os.makedirs(os.path.join(folder, os.path.dirname(name)), exist_ok=True)
+                with open(os.path.join(folder, name), "wb") as f:
+                    f.write(b"x" * size)
+            config = {
+                "rootfolder": root + "/",
+                "foldername": "nextcloud",
+                "patterns": patterns.settings(
+                    {"include": ["persistant-data/html/data/appdata_*/preview/keep"], "exclude": ["tmp"]}
+                ),
+            }
+            rules = patterns.build(**config)
+            self.assertEqual(
+                [(r.action, r.pattern) for r in rules],
+                [
+                    ("+", "persistant-data/html/data/appdata_*/preview/keep"),
+                    ("-", "tmp"),
+                    ("-", "persistant-data/html/data/appdata_*/preview"),
+                    ("-", "persistant-data/html/data/nextcloud.log"),
+                ],
+            )
+            self.assertEqual(rules[0].line(folder), f"+ sh:{folder.strip('/')}/persistant-data/html/data/appdata_*/preview/keep")
+            result = patterns.report(rules, folder)
+            self.assertEqual([(s.files, s.bytes) for s in result.rules], [(1, 40), (1, 7), (1, 300), (1, 200)])
+            self.assertEqual((result.files, result.bytes), (7, sum(files.values()) + len(TestComposeFile.compose)))
+            self.assertEqual(result.excluded_bytes, 507)
+
+
+class TestThrottle(unittest.TestCase):
+    def test_isolation(self):
+        config = throttle.settings({"nice": 10, "ionice": "best-effort:6", "cgroup": {"cpu_weight": 10}})
+        isolation = throttle.isolation(config, which=lambda tool: f"/usr/bin/{tool}")
+        self.assertEqual(
+            isolation.prefix,
+            "systemd-run --scope --quiet --collect -p CPUWeight=10 -p IOWeight=20 -- nice -n 10 ionice -c 2 -n 6",
+        )
+        isolation = throttle.isolation(config, which=lambda tool: None if tool == "systemd-run" else tool)
+        self.assertEqual(isolation.applied, ["nice 10", "ionice best-effort:6"])
+        self.assertRaises(ValueError, throttle.settings, {"ionice": "lazy"})
+
+    def test_upload_ratelimit(self):
+        config = throttle.settings(
+            {
+                "upload_ratelimit": {
+                    "default": "20MiB",
+                    "schedule": {"08:00-22:00": "2MiB", "23:00-01:00": "0"},
+                    "load": {"above": 1.5, "rate": "1MiB"},
+                }
+            }
+        )
+        limit = throttle.upload_ratelimit(config, datetime(2024, 1, 1, 12, 0), load=0.2)
+        self.assertEqual((limit.rate, limit.reason), (2 * 2**20, "schedule 08:00-22:00"))
+        self.assertEqual(throttle.upload_ratelimit(config, datetime(2024, 1, 1, 3, 0), load=0.2).rate, 20 * 2**20)
+        # a window over midnight, 0 is no limit
+        self.assertIsNone(throttle.upload_ratelimit(config, datetime(2024, 1, 1, 0, 30), load=0.2).rate)
+        self.assertEqual(throttle.upload_ratelimit(config, datetime(2024, 1, 1, 0, 30), load=3).rate, 2**20)
+
+    def test_borg_command(self):
+        with mock.patch("borg.cmd_run") as run:
+            run.side_effect = RuntimeError("stop")
+            config = {**TestBorg.config, "isolation_prefix": "nice -n 10", "upload_ratelimit": 2 * 2**20}
+            self.assertRaises(RuntimeError, borg.create, **config)
+        cmd = run.call_args[0][0]
+        self.assertTrue(cmd.startswith("nice -n 10 borg create "))
+        self.assertIn("--upload-ratelimit 2048 ", cmd)
+
+
+class TestProfiler(unittest.TestCase):
+    def test_estimate_chunks(self):
+        sizes = [100, 2**19, 2**20 * 100]
+        self.assertEqual(profiler.estimate_chunks(sizes, "buzhash,19,23,21,4095"), 1 + 1 + 40)
+        self.assertEqual(profiler.estimate_chunks([2**30], "buzhash,10,23,16,4095"), 16132)
+
+    def test_recommend(self):
+        self.assertEqual(
+            profiler.recommend("--compression lzma,5 --exclude-caches", "auto,zstd,3", profiler.DEFAULT_CHUNKER),
+            "--compression auto,zstd,3 --exclude-caches",
+        )
+        self.assertEqual(
+            profiler.recommend("-C=lz4 --chunker-params buzhash,10,23,16,4095", "lz4", "buzhash,19,23,22,4095"),
+            "--compression lz4 --chunker-params buzhash,19,23,22,4095",
+        )
+
+    def test_profile(self):
+        with tempfile.TemporaryDirectory() as d:
+            os.makedirs(os.path.join(d, "media"))
+            os.makedirs(os.path.join(d, "db"))
+            with open(os.path.join(d, "media", "video.mp4"), "wb") as f:
+                f.write(os.urandom(2**20))
+            with open(os.path.join(d, "db", "dump.sql"), "wb") as f:
+                f.write(b"INSERT INTO t VALUES (1, 'some text');\n" * 30000)
+            result = profiler.profile(d, sample_size=2**30, uplink=2**20)
+            self.assertEqual((result.files, result.sampled_files), (2, 2))
+            self.assertEqual(result.sampled, result.total)
+            # random data doesn't compress, text does
+            self.assertGreater(result.paths["media"]["lzma,6"].compressed, 2**20)
+            self.assertLess(result.paths["db"]["zlib,6"].compressed, 30000)
+            self.assertNotEqual(result.recommended_compression(), "none")
+            self.assertIn("recommended create: --compression", result.format("test"))
+
+
+class TestDumps(unittest.TestCase):
+    def test_from_config(self):
+        self.assertRaises(ValueError, dbdumps.from_config, [{"name": "db", "type": "postgres"}])
+        self.assertRaises(ValueError, dbdumps.from_config, [{"name": "a b", "type": "command", "command": "true"}])
+        self.assertRaises(
+            ValueError, dbdumps.from_config, [{"name": "db", "type": "mysql", "container": "db", "password_env": "$(reboot)"}]
+        )
+        dumps = dbdumps.from_config([{"name": "db", "type": "postgres", "service": "db", "database": "nextcloud"}])
+        self.assertEqual(dumps[0]["user"], "postgres")
+        self.assertEqual(
+            dbdumps.command(dumps[0], compose_file="/docker/nc/docker-compose.yaml"),
+            "docker-compose -f /docker/nc/docker-compose.yaml exec -T db pg_dump --username=postgres --clean --if-exists --create nextcloud",
+        )
+        # postgres reads the password like mysql, inside the container
+        dumps = dbdumps.from_config([{"name": "db", "type": "postgres", "container": "db", "password_env": "POSTGRES_PASSWORD"}])
+        self.assertEqual(
+            dbdumps.command(dumps[0]),
+            "docker exec -i db sh -c 'PGPASSWORD=\"$POSTGRES_PASSWORD\" exec pg_dumpall --username=postgres --clean --if-exists'",
+        )
+        self.assertRaises(
+            ValueError, dbdumps.from_config, [{"name": "app", "type": "sqlite", "path": "app.db", "password_env": "PASSWORD"}]
+        )
+        for data in ["/var/lib/postgresql", "../other-stack/db", "."]:
+            self.assertRaises(
+                ValueError, dbdumps.from_config, [{"name": "db", "type": "postgres", "service": "db", "data": data}]
+            )
+        dumps = dbdumps.from_config([{"name": "db", "type": "postgres", "service": "db", "data": "./persistant-data/db/"}])
+        self.assertEqual(dbdumps.excluded(dumps), ["persistant-data/db"])
+
+    def test_create_from_command(self):
+        config = {**TestBorg.config, "name": "target", "patterns_file": "/tmp/patterns.lst"}
+        with mock.patch("borg.cmd_run") as run:
+            run.side_effect = RuntimeError("stop")
+            self.assertRaises(RuntimeError, borg.create_from_command, "db", "docker exec -i db pg_dumpall", **config)
+        cmd = run.call_args[0][0]
+        self.assertIn("--content-from-command --stdin-name db ", cmd)
+        self.assertIn("::testfolder-dump-db-{now:%Y-%m-%d-%H%M%S} -- docker exec -i db pg_dumpall", cmd)
+        self.assertNotIn("--patterns-from", cmd)
+
+    def test_prune_series(self):
+        config = {**TestBorg.config, "debug": False, "dumps": [{"name": "db"}]}
+        with mock.patch("borg.cmd_run") as run:
+            run.return_value.returncode = 0
+            borg.prune(**config)
+        globs = [c[0][0].split("--glob-archives ")[1].split()[0] for c in run.call_args_list]
+        self.assertEqual(globs, ["'testfolder-[0-9]*'", "'testfolder-dump-db-*'"])
+
+
+class TestReadiness(unittest.TestCase):
+    def test_watcher(self):
+        import http.server
+
+        server = http.server.HTTPServer(("127.0.0.1", 0), http.server.SimpleHTTPRequestHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        polls = []
+
+        def states(folder, services):
+            polls.append(services)
+            # the database becomes healthy on the third poll
+            return {"app": "", "db": "" if len(polls) >= 3 else "starting"}
+
+        settings = readiness.settings(
+            {"timeout": 5, "interval": 0.05, "probes": [{"tcp": f"127.0.0.1:{server.server_port}"}, {"http": f"http://127.0.0.1:{server.server_port}/"}]}
+        )
+        try:
+            result = readiness.Watcher(settings, "/tmp", ["db"], states=states).wait()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertTrue(result.ready)
+        self.assertEqual(
+            sorted(c.name for c in result.checks),
+            sorted(["app", "db", f"127.0.0.1:{server.server_port}", f"http://127.0.0.1:{server.server_port}/"]),
+        )
+        self.assertEqual(polls[0], ["db"])
+        db = next(c for c in result.checks if c.name == "db")
+        self.assertEqual(result.ready_after, max(c.seconds for c in result.checks))
+        self.assertGreaterEqual(db.seconds, 0.1)
+
+    def test_timeout(self):
+        settings = readiness.settings({"timeout": 0.2, "interval": 0.05})
+        alerts = []
+        start = time.monotonic()
+        watcher = readiness.Watcher(
+            settings, "/tmp", states=lambda folder, services: {"db": "unhealthy"}, on_timeout=lambda r: alerts.append(time.monotonic())
+        )
+        # the alert comes at the deadline, while the run is still busy and long before it waits for the watcher
+        while not alerts and time.monotonic() - start < 2:
+            time.sleep(0.01)
+        self.assertEqual(len(alerts), 1)
+        self.assertLess(alerts[0] - start, 1)
+        result = watcher.wait()
+        self.assertEqual(len(alerts), 1)
+        self.assertFalse(result.ready)
+        self.assertIsNone(result.ready_after)
+        self.assertIn("db (unhealthy)", result.summary())
+        ctx = RunContext()
+        ctx.stack_stopped()
+        ctx.stack_started()
+        ctx.stack_healthy(ctx.downtime_started + 42)
+        self.assertEqual(ctx.downtime(), 42)
+
+
+class TestSlots(unittest.TestCase):
+    real_run = staticmethod(subprocess.run)
+
+    def run_locally(self, cmd, **kwargs):
+        # the last argument is what ssh would run on the server
+        return self.real_run(cmd[-1], shell=True, **kwargs)
+
+    def test_settings(self):
+        settings = slots.settings({"priority": 80, "timeout": "1h", "poll": "5s"})
+        self.assertEqual((settings["priority"], settings["timeout"], settings["poll"]), (80, 3600, 5))
+        with self.assertRaises(ValueError):
+            slots.settings({"priority": 100})
+        with self.assertRaises(ValueError):
+            slots.settings({"poll": "5m", "stale": "10m"})
+
+    def test_turn(self):
+        settings = slots.settings({"max_per_server": 2, "max_per_repo": 1})
+        a, b = slots.repo_key("a"), slots.repo_key("b")
+        queue = [f"49.000000000001.{a}.h1", f"49.000000000002.{a}.h2", f"49.000000000003.{b}.h3"]
+        state = slots.QueueState(queue, {f"repo.{a}.0": "h0", "server.0": "h0"})
+        # h1 and h2 wait for repo a, they don't hold up h3 on repo b
+        self.assertEqual(slots.turn(state, settings, queue[1], "a"), (None, 1))
+        self.assertEqual(slots.turn(state, settings, queue[2], "b"), (("server.1", f"repo.{b}.0"), 2))
+        # a higher priority is sorted first
+        state = slots.parse(f"queue {queue[2]}\nqueue 19.000000000009.{b}.h4\n")
+        self.assertEqual(slots.turn(state, settings, queue[2], "b"), (None, 1))
+
+    def test_slots_shared_by_hosts(self):
+        with tempfile.TemporaryDirectory() as tmp, mock.patch("slots.subprocess.run", self.run_locally):
+            settings = slots.settings({"path": tmp, "max_per_server": 1, "timeout": 0.6, "poll": 0.1, "stale": 60})
+            first = slots.Slot(settings, "u", "nas", "a")
+            self.assertEqual(first.acquire().ahead, 0)
+            self.assertEqual(os.listdir(os.path.join(tmp, "queue")), [])
+            with self.assertRaises(slots.SlotTimeout):
+                slots.Slot(settings, "u", "nas", "b").acquire()
+            waiting = slots.Slot(settings, "u", "nas", "b")
+            threading.Timer(0.3, first.release).start()
+            wait = waiting.acquire()
+            self.assertGreaterEqual(wait.seconds, 0.2)
+            self.assertEqual(sorted(os.listdir(os.path.join(tmp, "slots"))), ["repo." + slots.repo_key("b") + ".0", "server.0"])
+            waiting.release()
+            self.assertEqual(os.listdir(os.path.join(tmp, "slots")), [])
+
+
+class TestBorgCache(unittest.TestCase):
+    def test_sync_log(self):
+        sync = borgcache.SyncLog()
+        lines = [
+            ("Synchronizing chunks cache...", 100.0),
+            ("Archives: 3, w/ cached Idx: 1, w/ outdated Idx: 0, w/o cached Idx: 2.", 100.5),
+            ("Fetching and building archive index for a ...", 101.0),
+            ("Fetching and building archive index for b ...", 110.0),
+            ("Done.", 130.0),
+            ("Done.", 140.0),
+        ]
+        for message, t in lines:
+            sync(json.dumps({"type": "log_message", "time": t, "levelname": "INFO", "name": "borg.cache", "message": message}))
+        self.assertEqual(sync.syncs, [borgcache.CacheSync(30.0, 2)])
+
+    def test_cleanup(self):
+        def make(root, name, size, last_used):
+            path = borgcache.cache_path(root, "server", name)
+            lease = borgcache.Lease(path, "server", name)
+            with open(os.path.join(path, "chunks"), "wb") as f:
+                f.write(b"x" * size)
+            with open(os.path.join(path, borgcache.META_FILE), "w") as f:
+                json.dump({"last_used": last_used}, f)
+            return path, lease
+
+        with tempfile.TemporaryDirectory() as root:
+            now = time.time()
+            gone, lease = make(root, "gone", 10, now - 90 * 86400)
+            lease.release()
+            old, lease = make(root, "old", 1000, now - 2 * 86400)
+            lease.release()
+            recent, lease = make(root, "recent", 1000, now - 86400)
+            lease.release()
+            busy, busy_lease = make(root, "busy", 1000, now - 3 * 86400)
+            removed = borgcache.cleanup(root, max_size=2500)
+            self.assertEqual(removed, [gone, old])
+            self.assertTrue(os.path.isdir(busy))
+            busy_lease.release()
+
+    def test_drop_stale(self):
+        with tempfile.TemporaryDirectory() as root:
+            lease = borgcache.Lease(os.path.join(root, "cache"), "server", "repo")
+            for repository_id in ("a" * 64, "b" * 64):
+                os.makedirs(os.path.join(lease.path, repository_id))
+            lease.drop_stale("b" * 64)
+            self.assertEqual(set(os.listdir(lease.path)), {"b" * 64, borgcache.LOCK_FILE, borgcache.META_FILE})
+            lease.release()
+
 
 # class TestMain(unittest.TestCase):
 #    def test_wrong_folder_name_throws_exception(self):
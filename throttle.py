@@ -0,0 +1,197 @@
+import logging
+import os
+import re
+import shutil
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Callable, List
+from units import format_size, parse_size
+
+logger = logging.getLogger(__name__)
+
+IONICE_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+WINDOW = re.compile(r"^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$")
+
+
+@dataclass
+class Isolation:
+    """How borg and the commands of prepost scripts are run: the prefix of their command line and what it applies."""
+
+    prefix: str = ""
+    applied: List[str] = field(default_factory=list)
+
+    def summary(self) -> str:
+        return f"Isolation: {', '.join(self.applied) or 'none'}."
+
+
+@dataclass
+class RateLimit:
+    """The upload rate limit of one borg create."""
+
+    rate: int = None
+    reason: str = ""
+
+    def summary(self) -> str:
+        if self.rate is None:
+            return "no upload limit"
+        return f"upload limit {format_size(self.rate)}/s ({self.reason})"
+
+
+def _parse_ionice(value: str) -> tuple:
+    name, _, level = str(value).partition(":")
+    if name not in IONICE_CLASSES:
+        raise ValueError(f"ionice needs to be one of {', '.join(IONICE_CLASSES)}, optionally followed by :0-7")
+    if name == "idle":
+        return name, None
+    level = int(level) if level else 4
+    if not 0 <= level <= 7:
+        raise ValueError("the ionice level needs to be between 0 and 7")
+    return name, level
+
+
+def _parse_window(window: str) -> tuple:
+    match = WINDOW.match(window.replace(" ", ""))
+    if not match:
+        raise ValueError(f"{window} isn't a time window like 08:00-22:00")
+    h1, m1, h2, m2 = (int(g) for g in match.groups())
+    if h1 > 24 or h2 > 24 or m1 > 59 or m2 > 59:
+        raise ValueError(f"{window} isn't a time window like 08:00-22:00")
+    return h1 * 60 + m1, h2 * 60 + m2
+
+
+def _rate(value) -> int:
+    """Parses a rate per second, 0 or nothing is no limit."""
+    if value is None or value is False:
+        return None
+    return parse_size(str(value)) or None
+
+
+def settings(value) -> dict:
+    """Turns the 'isolation' part of the configuration into nice, ionice, cgroup and upload_ratelimit.
+
+    Args:
+        value (dict): f.ex. {"nice": 10, "ionice": "idle", "upload_ratelimit": {"default": "20MB", "schedule": {"08:00-22:00": "2MB"}}}
+
+    Raises:
+        ValueError: Raised if a key is unknown or a value can't be parsed.
+
+    Returns:
+        dict: The settings, rates in bytes per second, schedule windows in minutes after midnight.
+    """
+    value = value or {}
+    unknown = [k for k in value if k not in ("nice", "ionice", "cgroup", "upload_ratelimit")]
+    if unknown:
+        raise ValueError(f"unknown keys {', '.join(unknown)}")
+    result = {"nice": None, "ionice": None, "cgroup": None, "upload_ratelimit": None}
+    if value.get("nice") is not None:
+        result["nice"] = int(value["nice"])
+        if not -20 <= result["nice"] <= 19:
+            raise ValueError("nice needs to be between -20 and 19")
+    if value.get("ionice"):
+        result["ionice"] = _parse_ionice(value["ionice"])
+    if value.get("cgroup"):
+        cgroup = value["cgroup"] if isinstance(value["cgroup"], dict) else {}
+        result["cgroup"] = {
+            "cpu_weight": int(cgroup.get("cpu_weight", 20)),
+            "io_weight": int(cgroup.get("io_weight", 20)),
+        }
+    limit = value.get("upload_ratelimit")
+    if limit:
+        if not isinstance(limit, dict):
+            limit = {"default": limit}
+        load = limit.get("load")
+        if load and ("above" not in load or "rate" not in load):
+            raise ValueError("upload_ratelimit.load needs 'above' (load per CPU) and 'rate'")
+        result["upload_ratelimit"] = {
+            "default": _rate(limit.get("default")),
+            "schedule": [(*_parse_window(w), _rate(r), w) for w, r in (limit.get("schedule") or {}).items()],
+            "load": {"above": float(load["above"]), "rate": _rate(load["rate"])} if load else None,
+        }
+    return result
+
+
+def isolation(settings: dict, which: Callable[[str], str] = shutil.which) -> Isolation:
+    """Builds the command prefix that runs a command in a transient cgroup or under nice/ionice.
+
+    A cgroup needs systemd-run, without it nice/ionice are used if they are set. Tools that aren't installed are left out.
+
+    Args:
+        settings (dict): The result of settings()
+        which (Callable[[str], str], optional): Finds a tool. Defaults to shutil.which.
+
+    Returns:
+        Isolation: The prefix and what it applies.
+    """
+    result = Isolation()
+    parts = []
+    cgroup = settings["cgroup"]
+    if cgroup and which("systemd-run"):
+        parts.append(
+            f"systemd-run --scope --quiet --collect -p CPUWeight={cgroup['cpu_weight']} -p IOWeight={cgroup['io_weight']} --"
+        )
+        result.applied.append(f"cgroup CPUWeight={cgroup['cpu_weight']} IOWeight={cgroup['io_weight']}")
+    elif cgroup:
+        logger.warning("systemd-run not found, can't run borg in a cgroup")
+    if settings["nice"] is not None:
+        if which("nice"):
+            parts.append(f"nice -n {settings['nice']}")
+            result.applied.append(f"nice {settings['nice']}")
+        else:
+            logger.warning("nice not found, running borg with the default priority")
+    if settings["ionice"]:
+        name, level = settings["ionice"]
+        if which("ionice"):
+            parts.append(f"ionice -c {IONICE_CLASSES[name]}" + (f" -n {level}" if level is not None else ""))
+            result.applied.append(f"ionice {name}" + (f":{level}" if level is not None else ""))
+        else:
+            logger.warning("ionice not found, running borg with the default I/O priority")
+    result.prefix = " ".join(parts)
+    return result
+
+
+def _in_window(minute: int, start: int, end: int) -> bool:
+    if start <= end:
+        return start <= minute < end
+    return minute >= start or minute < end  # over midnight, f.ex. 22:00-06:00
+
+
+def upload_ratelimit(settings: dict, now: datetime = None, load: float = None) -> RateLimit:
+    """Picks the upload rate limit for a borg create starting now.
+
+    The first schedule window containing the current time wins over the default. If the load average per CPU is above 'load.above'
+    the limit is lowered to 'load.rate'. borg can't change the limit while it runs, so it's picked again for every attempt.
+
+    Args:
+        settings (dict): The result of settings()
+        now (datetime, optional): The current time. Defaults to datetime.now().
+        load (float, optional): The 1-minute load average per CPU. Defaults to the host's.
+
+    Returns:
+        RateLimit: The limit in bytes per second, None for no limit.
+    """
+    limit = settings["upload_ratelimit"]
+    if not limit:
+        return RateLimit()
+    now = now or datetime.now()
+    minute = now.hour * 60 + now.minute
+    result = RateLimit(limit["default"], "default")
+    for start, end, rate, window in limit["schedule"]:
+        if _in_window(minute, start, end):
+            result = RateLimit(rate, f"schedule {window}")
+            break
+    if limit["load"]:
+        if load is None:
+            load = os.getloadavg()[0] / (os.cpu_count() or 1)
+        lowered = limit["load"]["rate"]
+        if load > limit["load"]["above"] and lowered and (result.rate is None or lowered < result.rate):
+            result = RateLimit(lowered, f"load {load:.2f} per CPU")
+    return result
+
+
+def throughput(size: int, seconds: float) -> str:
+    """Returns f.ex. '12.0 MiB/s'."""
+    return f"{format_size(size / seconds if seconds else 0)}/s"
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,73 @@
+import re
+
+
+def format_size(size: float) -> str:
+    """Formats a number of bytes for humans.
+
+    Args:
+        size (float): Bytes
+
+    Returns:
+        str: f.ex. '1.5 GiB'
+    """
+    if size < 1024:
+        return f"{int(size)} B"
+    for unit in ["KiB", "MiB", "GiB", "TiB"]:
+        size /= 1024
+        if size < 1024 or unit == "TiB":
+            return f"{size:.1f} {unit}"
+
+
+SIZE_UNITS = {
+    "B": 1,
+    "kB": 1000,
+    "MB": 1000**2,
+    "GB": 1000**3,
+    "TB": 1000**4,
+    "PB": 1000**5,
+    "KiB": 1024,
+    "MiB": 1024**2,
+    "GiB": 1024**3,
+    "TiB": 1024**4,
+    "PiB": 1024**5,
+}
+
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+
+
+def parse_size(text: str) -> int:
+    """Parses a size like borg prints it.
+
+    Args:
+        text (str): f.ex. '1.50 GB' or '12 B'
+
+    Raises:
+        ValueError: Raised if the unit is unknown.
+
+    Returns:
+        int: Bytes
+    """
+    match = re.fullmatch(r"([\d.]+)\s*([A-Za-z]*)", text.strip())
+    if not match or (match.group(2) or "B") not in SIZE_UNITS:
+        raise ValueError(f"Not a size: {text}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2) or "B"])
+
+
+def parse_duration(value) -> float:
+    """Parses a duration given in seconds or with a unit.
+
+    Args:
+        value (int, float or str): f.ex. 3600, '12h', '7d' or '4w'
+
+    Raises:
+        ValueError: Raised if the value isn't a duration.
+
+    Returns:
+        float: Seconds
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    text = str(value).strip()
+    if text and text[-1] in DURATION_UNITS:
+        return float(text[:-1]) * DURATION_UNITS[text[-1]]
+    return float(text)